@@ -1,8 +1,62 @@
+"""Python API for Alazar Technologies digitizers.
+
+The board extension, which is linked against the Alazar SDK, and the mock
+board are only imported the first time one of their names is used, so the
+processors and the pure-Python board helpers can be imported on machines
+without the SDK.
+"""
+import importlib
+import sys
+import types
+
 from alazar import processor
 
-from board import (Alazar, get_systems_and_boards, AlazarException,
-                          channels, trigger_sources, clock_sources,
-                          sample_rates, ranges, input_couplings,
-                          ext_trig_range,)
+from alazar.exceptions import AlazarException
+from alazar.board_common import (channels, trigger_sources, clock_sources,
+                                 sample_rates, ranges, input_couplings,
+                                 ext_trig_range,)
+
+# names which are imported from a submodule on first access
+_lazy_names = {"Alazar": "board",
+               "get_systems_and_boards": "board",
+               "MockAlazar": "board_mock",
+               "MockAlazarException": "board_mock",}
+
+# a star import must not need the SDK, so it leaves out the names of the
+# board extension; import them by name
+__all__ = ["processor", "AlazarException", "channels", "trigger_sources",
+           "clock_sources", "sample_rates", "ranges", "input_couplings",
+           "ext_trig_range",] + sorted(name for (name, submodule) in _lazy_names.items()
+                                       if submodule != "board")
+
+def _import_submodule(name):
+    """Import a submodule of this package."""
+    try:
+        return importlib.import_module("alazar." + name)
+    except ImportError:
+        if name != "board":
+            raise
+        # setup.py builds the extension as a top-level module
+        return importlib.import_module(name)
+
+class _LazyModule(types.ModuleType):
+    """Package module which imports the heavy submodules on first access."""
+    def __getattr__(self, name):
+        try:
+            submodule = _lazy_names[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '{}'".format(name))
+        value = getattr(_import_submodule(submodule), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(_lazy_names.keys()))
 
-from board_mock import MockAlazar, MockAlazarException
\ No newline at end of file
+# Python 2 modules can't define __getattr__, so replace this module with a
+# _LazyModule holding the same namespace.  Keep a reference to the original
+# module, or Python 2 clears its globals when it is garbage collected.
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
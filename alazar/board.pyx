@@ -17,11 +17,20 @@ cimport c_alazar_api
 import numpy as np
 cimport numpy as np
 
-import multiprocessing as mp
+import timeit
 
 from alazar import params
-from alazar.process import _process_buffers
+from alazar.process import _acquire_sequence
+from alazar.budget import check_memory_budget
+from alazar.buffer_pool import BufferPool
+from alazar.placement import apply_placement
+from alazar.transport import LocalTransport
 from alazar.exceptions import AlazarException
+from alazar.board_common import (def_acq_params, buffer_telemetry, channels,
+                                 trigger_sources, clock_sources, sample_rates, ranges,
+                                 input_couplings, ext_trig_range, max_decimation,
+                                 _check_decimation, _check_buffer_alignment,
+                                 _make_channel_mask, is_9870, is_9360)
 from alazar.processor import BufferProcessor
 
 # C wrapper class to represent an Alazar digitizer
@@ -32,15 +41,21 @@ cdef class Alazar(object):
     cdef int board_type
     cdef int systemID
     cdef int boardID
+    # buffer timing of the last acquisition
+    cdef object telemetry
+    # DMA buffers reused across acquisitions
+    cdef object buffer_pool
 
     # use __cinit__ to make sure this is run
-    def __cinit__(self, systemID, boardID):
+    def __cinit__(self, systemID, boardID, huge_pages=False):
         """Initialize a new Alazar digitizer wrapper.
 
         Constructing more than one wrapper to a board at once is not recommended.
 
         Args:
             systemID, boardID: numeric IDs for board and system to wrap.
+            huge_pages (bool): if True, back the DMA buffers with transparent
+                huge pages where supported.
 
         Raises:
             AlazarException if the board cannot be connected to or identified.
@@ -57,6 +72,7 @@ cdef class Alazar(object):
 
         self.systemID = systemID
         self.boardID = boardID
+        self.buffer_pool = BufferPool(huge_pages)
 
     # need a getter to access this from python
     def get_board_type(self):
@@ -65,6 +81,40 @@ cdef class Alazar(object):
     def get_board_model(self):
         return params.board_types[self.board_type]
 
+    def prewarm_buffers(self,
+                        samples_per_record,
+                        records_per_buffer,
+                        channels_to_acquire="all",
+                        buffer_count = 64):
+        """Allocate and fault in the DMA buffers for an acquisition geometry.
+
+        The buffers are kept and reused by every later acquisition which fits
+        in them, so the first acquisition doesn't pay for allocating them.
+
+        Raises:
+            AlazarException if the channel selection is invalid or a board
+                error occurred.
+        """
+        (_, channel_count) = _make_channel_mask(self.board_type, channels_to_acquire)
+        (_, sample_type) = self._sample_format()
+        self.buffer_pool.prewarm(buffer_count,
+                                 records_per_buffer * samples_per_record * channel_count,
+                                 sample_type)
+
+    def release_buffers(self):
+        """Release the DMA buffers kept for reuse."""
+        self.buffer_pool.release()
+
+    def get_telemetry(self):
+        """Return the buffer timing of the last acquisition.
+
+        Returns:
+            Dictionary from board_common.buffer_telemetry, or None if nothing
+            has been acquired.  The jitter of the intervals between buffers
+            shows how steadily the acquisition process drained the board.
+        """
+        return self.telemetry
+
     def setup_capture_clock(self, clock_source, sample_rate, decimation=0, edge="rising"):
         """Set the capture clock for this alazar board.
 
@@ -334,7 +384,12 @@ cdef class Alazar(object):
                 channels_to_acquire="all",
                 processors = [BufferProcessor()],
                 buffer_count = 64,
-                timeout = 5000):
+                timeout = 5000,
+                memory_budget = None,
+                on_over_budget = "raise",
+                acquisition_placement = None,
+                processing_placement = None,
+                transport = None):
         """Perform an acquisition using two-port NPT DMA mode.
 
         Args:
@@ -349,10 +404,25 @@ cdef class Alazar(object):
             buffer_count (int): The number of DMA buffers to allocate; default is 64, min is 2.
             timeout (int): (ms) The time to wait for a buffer to be filled by the board;
                 default is 5000.
+            memory_budget (int): The most memory in bytes the acquisition may use,
+                including DMA buffers, the buffer queue and the processors; defaults
+                to most of the physical memory.
+            on_over_budget (str): "raise" to refuse an acquisition over the memory
+                budget, or "spill" to move processor results to disk until it fits.
+            acquisition_placement (Placement): The CPUs, priority and NUMA node for
+                the calling thread while it drains the DMA buffers; restored afterwards.
+            processing_placement (Placement): The CPUs, priority and NUMA node for
+                the processing worker.
+            transport: Where the buffers are processed; a LocalTransport worker
+                process by default, or a RemoteTransport to processing servers.
 
         Notes:
             records_per_acquisition must be a multiple of records_per_buffer
 
+            If any processors have a convergence target, the acquisition stops
+            early once all of them have reached it; the number of records
+            actually used is then in the records_processed of each processor.
+
         Returns:
             List of processors containing results.
             If processors encountered errors, they will not be raised until the
@@ -360,7 +430,65 @@ cdef class Alazar(object):
                 for their result.
 
         Raises:
-            AlazarException if an acquisition error occurred.
+            AlazarException if an acquisition error occurred, or the acquisition
+                does not fit in the memory budget.
+        """
+        comm = self._acquire_buffers(samples_per_record,
+                                     records_per_acquisition,
+                                     records_per_buffer,
+                                     channels_to_acquire,
+                                     processors,
+                                     buffer_count,
+                                     timeout,
+                                     memory_budget,
+                                     on_over_budget,
+                                     acquisition_placement,
+                                     processing_placement,
+                                     transport)
+        # get the processors and return them
+        return comm.get()
+
+    def acquire_sequence(self, acquisitions):
+        """Perform a series of back-to-back acquisitions.
+
+        Each acquisition is armed as soon as the DMA for the previous one is
+        finished, so the board keeps acquiring while the previous acquisition
+        is still being post-processed by its worker.
+
+        Args:
+            acquisitions: an iterable of dicts of keyword arguments to acquire(),
+                one for each acquisition; each should supply its own set of
+                processors.
+
+        Returns:
+            A generator which yields the list of processors for each
+            acquisition, in the order the acquisitions were given.
+
+        Raises:
+            AlazarException if an acquisition error occurred.  Acquisitions
+                which finished before the error are still yielded first.
+        """
+        return _acquire_sequence(self._acquire_buffers, acquisitions)
+
+    def _acquire_buffers(self,
+                         samples_per_record,
+                         records_per_acquisition,
+                         records_per_buffer,
+                         channels_to_acquire="all",
+                         processors = [BufferProcessor()],
+                         buffer_count = 64,
+                         timeout = 5000,
+                         memory_budget = None,
+                         on_over_budget = "raise",
+                         acquisition_placement = None,
+                         processing_placement = None,
+                         transport = None):
+        """Run the DMA for an acquisition, without waiting for the processors.
+
+        The arguments are the same as for acquire().
+
+        Returns:
+            The queue on which the worker will put the finished processors.
         """
         # validate inputs
         if records_per_acquisition < 1:
@@ -386,14 +514,8 @@ cdef class Alazar(object):
         # all input has been validated
 
         cdef int buffers_per_acquisition = records_per_acquisition / records_per_buffer
-        cdef c_alazar_api.U8 bits_per_sample
-        cdef c_alazar_api.U32 max_samples_per_channel
 
-        # get channel info
-        ret_code = c_alazar_api.AlazarGetChannelInfo(self.board,
-                                                     &max_samples_per_channel,
-                                                     &bits_per_sample,)
-        _check_return_code(ret_code, "Get channel info failed:")
+        (bits_per_sample, sample_type) = self._sample_format()
 
         bytes_per_sample = (bits_per_sample + 7) / 8
         bytes_per_record = bytes_per_sample * samples_per_record
@@ -404,10 +526,6 @@ cdef class Alazar(object):
         ret_code = c_alazar_api.AlazarSetRecordSize(self.board, 0, samples_per_record)
         _check_return_code(ret_code,
                            "Set record size failed for {} samples:".format(samples_per_record))
-        if bytes_per_sample <= 1:
-            sample_type = np.uint8
-        else:
-            sample_type = np.uint16
         acq_params = def_acq_params(samples_per_record,
                                     records_per_acquisition,
                                     records_per_buffer,
@@ -415,13 +533,20 @@ cdef class Alazar(object):
                                     sample_type,
                                     bits_per_sample,)
 
+        # refuse to arm the board if the acquisition would run out of memory
+        check_memory_budget(acq_params, processors, buffer_count,
+                            memory_budget, on_over_budget)
+
         # configure the board to make an NPT AutoDMA acquisition
         # first flag is the value of ADMA_EXTERNAL_STARTCAPTURE
         # second flag is the value of ADMA_NPT and sets no pretrigger sample acquisition
         if self.board_type == 13: #9870:
-            autoDMA_flags = 0x00000001 | 0x00000200 | 0x00001000
-            # third flag commands the 9870 to return interleaved samples, to match
-            # the buffer formatting of the 9360
+            autoDMA_flags = 0x00000001 | 0x00000200
+            if channel_count > 1:
+                # commands the 9870 to return interleaved samples, to match
+                # the buffer formatting of the 9360; a single channel is
+                # returned as contiguous records on both boards
+                autoDMA_flags |= 0x00001000
         elif self.board_type == 25: #9360:
             autoDMA_flags = 0x00000001 | 0x00000200 | 0x00000800
             # third flag is ADMA_FIFO_ONLY_STREAMING
@@ -436,25 +561,41 @@ cdef class Alazar(object):
                                                       records_per_acquisition,
                                                       autoDMA_flags)
         _check_return_code(ret_code,"Setup NPT AutoDMA acquisition failed:")
-        # get a queue to send buffers to the buffer processor
-        buf_queue = mp.Queue()
-        # get a queue to receive messages back from the processors
-        comm = mp.Queue()
-        # start a buffer processor to do the acquisition:
-        buf_processor = mp.Process(target = _process_buffers,
-                                   args = (buf_queue,
-                                           comm,
-                                           processors,
-                                           acq_params,))
-        buf_processor.start()
+        # start the buffer processor, in a local worker unless a transport is given
+        if transport is None:
+            transport = LocalTransport()
+        try:
+            (buf_queue, comm, stop) = transport.start(processors, acq_params,
+                                                      processing_placement)
+        except Exception:
+            # nothing is processing yet, but the board is set up for the DMA
+            self._abort_acquisition()
+            raise
         # enure that from this point on, if we throw any exceptions we send them
         # to the processor or it will never return
 
-        # allocate list of NumPy arrays as data buffers
-        # indexing this will cost a Python overhead, but this probably isn't important
-        # these are refcounted so we don't need to manually manage their memory
-        cdef list buffers = [np.empty(samples_per_buffer, dtype=sample_type)
-                             for n in xrange(buffer_count)]
+        cdef list buffers
+        restore_placement = None
+        try:
+            # place this thread after starting the worker, so it isn't inherited
+            restore_placement = apply_placement(acquisition_placement)
+
+            # get the list of NumPy arrays used as data buffers from the pool
+            # indexing this will cost a Python overhead, but this probably isn't important
+            # the pool keeps them allocated for the next acquisition; its pages may
+            # already be faulted in, so they are moved to the preferred NUMA node
+            numa_node = (None if acquisition_placement is None
+                         else acquisition_placement.numa_node)
+            buffers = self.buffer_pool.get(buffer_count, samples_per_buffer, sample_type,
+                                           numa_node)
+        except Exception as err:
+            if restore_placement is not None:
+                restore_placement()
+            self._abort_acquisition()
+            buf_queue.put((None, err))
+            raise
+        buffer_times = []
+
         # make a list of the address of each buffer to pass to the digitizer
         cdef list buffer_addresses = []
 
@@ -496,6 +637,10 @@ cdef class Alazar(object):
                                               buf_queue)
                 # handle each buffer
                 for buf_num in xrange(buffers_per_acquisition):
+                    # the processors have converged, tell them no more buffers are coming
+                    if stop.is_set():
+                        buf_queue.put( (None, None) )
+                        break
                     buffer_index = buf_num % buffer_count
                     buf_view_char = buffer_addresses[buffer_index]
                     ret_code = c_alazar_api.AlazarWaitAsyncBufferComplete(self.board,
@@ -507,6 +652,7 @@ cdef class Alazar(object):
                                                   buf_queue)
                     # pickles the buffer and sends to the worker
                     buf_queue.put( (buffers[buffer_index], None) )
+                    buffer_times.append(timeit.default_timer())
                     # hand the buffer back to the board
                     ret_code = c_alazar_api.AlazarPostAsyncBuffer(self.board,
                                                                   &buf_view_char[0],
@@ -515,12 +661,17 @@ cdef class Alazar(object):
                                                   "Failed to send buffer address back "
                                                   "to board during acquisition:",
                                                   buf_queue)
+                # the queue pickles buffers in a background thread; wait until
+                # it is done before the pool's buffers are reused
+                buf_queue.close()
+                buf_queue.join_thread()
                 # done with acquisition
             finally:
                 # make sure we abort the acquisition so the board doesn't get stuck
                 self._abort_acquisition()
-            # get the processors and return them
-            return comm.get()
+                restore_placement()
+                self.telemetry = buffer_telemetry(buffer_times)
+            return comm
 
         else:
             # 16-bit buffer branch
@@ -547,6 +698,10 @@ cdef class Alazar(object):
                                               buf_queue)
                 # handle each buffer
                 for buf_num in xrange(buffers_per_acquisition):
+                    # the processors have converged, tell them no more buffers are coming
+                    if stop.is_set():
+                        buf_queue.put( (None, None) )
+                        break
                     buffer_index = buf_num % buffer_count
                     buf_view_short = buffer_addresses[buffer_index]
                     ret_code = c_alazar_api.AlazarWaitAsyncBufferComplete(self.board,
@@ -558,6 +713,7 @@ cdef class Alazar(object):
                                                   buf_queue)
                     # pickles the buffer and sends to the worker
                     buf_queue.put( (buffers[buffer_index], None) )
+                    buffer_times.append(timeit.default_timer())
                     # hand the buffer back to the board
                     ret_code = c_alazar_api.AlazarPostAsyncBuffer(self.board,
                                                                   &buf_view_short[0],
@@ -566,12 +722,36 @@ cdef class Alazar(object):
                                                   "Failed to send buffer address back "
                                                   "to board during acquisition:",
                                                   buf_queue)
+                # the queue pickles buffers in a background thread; wait until
+                # it is done before the pool's buffers are reused
+                buf_queue.close()
+                buf_queue.join_thread()
                 # done with acquisition
             finally:
                 # make sure we abort the acquisition so the board doesn't get stuck
                 self._abort_acquisition()
-            # get the processors and return them
-            return comm.get()
+                restore_placement()
+                self.telemetry = buffer_telemetry(buffer_times)
+            return comm
+
+    def _sample_format(self):
+        """Return the bits per sample and the sample dtype of this board.
+
+        Raises:
+            AlazarException if a board error occurred.
+        """
+        cdef c_alazar_api.U8 bits_per_sample
+        cdef c_alazar_api.U32 max_samples_per_channel
+
+        # get channel info
+        ret_code = c_alazar_api.AlazarGetChannelInfo(self.board,
+                                                     &max_samples_per_channel,
+                                                     &bits_per_sample,)
+        _check_return_code(ret_code, "Get channel info failed:")
+        if bits_per_sample <= 8:
+            return (bits_per_sample, np.uint8)
+        else:
+            return (bits_per_sample, np.uint16)
 
     def _abort_acquisition(self):
         """Command the board to abort a running acquisition.
@@ -586,23 +766,6 @@ cdef class Alazar(object):
 
 # end of Alazar() class definition
 
-def def_acq_params(samples_per_record,
-                   records_per_acquisition,
-                   records_per_buffer,
-                   channel_count,
-                   dtype,
-                   bit_depth):
-    """Return a dictionary containing useful acquisition parameters."""
-    return dict(samples_per_record=samples_per_record,
-                records_per_acquisition = records_per_acquisition,
-                records_per_buffer = records_per_buffer,
-                channel_count = channel_count,
-                samples_per_buffer = samples_per_record * records_per_buffer * channel_count,
-                channel_chunk_size = samples_per_record * records_per_buffer,
-                buffers_per_acquisition = records_per_acquisition / records_per_buffer,
-                dtype = dtype,
-                bit_depth = bit_depth)
-
 def get_systems_and_boards():
     """Return a dict of the number of boards in each Alazar system detected.
 
@@ -638,169 +801,3 @@ def _return_code_to_string(return_code):
     This function assumes a valid return code.
     """
     return <bytes> c_alazar_api.AlazarErrorToText(return_code)
-
-# --- valid parameter settings by board type
-
-def channels(board_type):
-    """Get the dictionary of channel names.
-
-    board_type can be the numerical ID or the string "ATS####"
-    """
-    if is_9870(board_type) or is_9360(board_type):
-        return params.channels
-    else:
-        raise AlazarException("Could not get channels for board type " + str(board_type))
-
-def trigger_sources(board_type):
-    """Get the dictionary of trigger sources.
-
-    board_type can be the numerical ID or the string "ATS####"
-    """
-    if is_9870(board_type) or is_9360(board_type):
-        return params.trig_sources
-    else:
-        raise AlazarException("Could not get trigger sources for board type " + str(board_type))
-
-def clock_sources(board_type):
-    """Get the dictionary of valid clock sources for this board type.
-
-    board_type can be the numerical ID or the string "ATS####"
-    At present, only the ATS9870 and ATS9360 are supported.
-    """
-    if is_9870(board_type) or is_9360(board_type):
-        return params.clock_sources
-    else:
-        raise AlazarException("Could not get clock sources for board type " + str(board_type))
-
-def sample_rates(board_type):
-    """Get the dictionary of valid sample rates for this board type.
-
-    board_type can be the numerical ID or the string "ATS####"
-    At present, only the ATS9870 and ATS9360 are supported.
-    """
-    if is_9870(board_type):
-        return params.sample_rates_9870
-    elif is_9360(board_type):
-        return params.sample_rates_9360
-    else:
-        raise AlazarException("Could not get sample rates for board type " + str(board_type))
-
-def ranges(board_type):
-    """Get the dictionary of valid range names.
-
-    board_type can be the numerical ID or the string "ATS####"
-    At present, only the ATS9870 and ATS9360 are supported.
-    """
-    if is_9870(board_type):
-        return params.ranges_9870
-    elif is_9360(board_type):
-        return params.ranges_9360
-    else:
-        raise AlazarException("Could not get input ranges for board type " + str(board_type))
-
-def input_couplings(board_type):
-    """Get the dictionary of valid input coupings.
-
-    board_type can be the numerical ID or the string "ATS####"
-    At present, only the ATS9870 and ATS9360 are supported.
-    """
-    if is_9870(board_type):
-        return params.couplings_9870
-    elif is_9360(board_type):
-        return params.couplings_9360
-    else:
-        raise AlazarException("Could not get input couplings for board type " + str(board_type))
-
-def ext_trig_range(board_type):
-    """Get the dictionary of valid external trigger ranges.
-
-    board_type can be the numerical ID or the string "ATS####"
-    At present, only the ATS9870 and ATS9360 are supported.
-    The SDK guide does specify which ranges are valid for which board.
-    """
-    if is_9870(board_type):
-        return params.trig_ranges_9870
-    elif is_9360(board_type):
-        return params.trig_ranges_9360
-    else:
-        raise AlazarException("Could not get trigger input ranges for board type " + str(board_type))
-
-# --- parameter validation
-
-max_decimation = 100000
-
-def _check_decimation(board_type, decimation):
-    """Check the decimation parameter given a board type.
-
-    This function does not raise an exception.
-    This function currently only supports the ATS9870.
-    """
-    if decimation >= max_decimation:
-        return False
-
-    if is_9870(board_type):
-        if decimation in [1,2,4] or (decimation >= 0 and decimation % 10 == 0):
-            # 10 MHz ref requires decimation of 1, 2, 4, or mult. of 10
-            return True
-        else:
-            return False
-    else:
-        return False
-
-def _check_buffer_alignment(board_type, n_samples):
-    """Check the record length for minimum length and buffer alignment.
-
-    This function currently only supports the ATS9870.
-    """
-    if is_9870(board_type):
-        # ATS9870: min record size is 256, n_samples must be a multiple of 64.
-        min_record_size = 256
-        buffer_alignment = 64
-    elif is_9360(board_type):
-        # ATS9360: min record size is 256, n_samples must be a multiple of 128.
-        min_record_size = 256
-        buffer_alignment = 128
-    else:
-        raise AlazarException("Could not validate record length for board type {}."
-                              .format(board_type))
-
-    if n_samples < min_record_size:
-        raise AlazarException("Minimum record length is {}. Provided: {}"
-                              .format(min_record_size,n_samples))
-    elif n_samples % buffer_alignment != 0:
-        raise AlazarException("Sample size must be a multiple of {}. Provided: {}"
-                              .format(buffer_alignment, n_samples))
-
-# build the channel mask
-# channels interface will require refactoring to support boards with
-# more than two channels.
-def _make_channel_mask(board_type, channels):
-    """Make the channel mask for a channel selection.
-
-    This function currently only supports the ATS9870 and ATS9360.
-    Support for boards with more than two channels will require
-        refactoring the channel selection interface.
-
-    Raises an AlazarException for invalid input or unsupported board type.
-
-    Returns a tuple with the channel mask and channel count.
-    """
-    if is_9870(board_type) or is_9360(board_type):
-        if channels == "all":
-            return (3,2)
-        else:
-            try:
-                channel_mask = channels(board_type)[channels]
-            except KeyError:
-                raise AlazarException("Invalid channel selection: '{}'".format(channels))
-            return (channel_mask,1)
-    else:
-        raise AlazarException("Could not make channel mask for board type {}.".format(board_type))
-
-# --- helper functions
-
-def is_9870(board_type):
-    return board_type == 13 or board_type == "ATS9870"
-
-def is_9360(board_type):
-    return board_type == 25 or board_type == "ATS9360"
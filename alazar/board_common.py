@@ -0,0 +1,308 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Pure-Python parts of the board API.
+
+These helpers do not need the compiled board extension or the Alazar SDK, so
+they can be used on machines which only process or mock acquisitions.
+"""
+import numpy as np
+
+from alazar import params
+from alazar.exceptions import AlazarException
+
+def def_acq_params(samples_per_record,
+                   records_per_acquisition,
+                   records_per_buffer,
+                   channel_count,
+                   dtype,
+                   bit_depth):
+    """Return a dictionary containing useful acquisition parameters."""
+    return dict(samples_per_record=samples_per_record,
+                records_per_acquisition = records_per_acquisition,
+                records_per_buffer = records_per_buffer,
+                channel_count = channel_count,
+                samples_per_buffer = samples_per_record * records_per_buffer * channel_count,
+                channel_chunk_size = samples_per_record * records_per_buffer,
+                buffers_per_acquisition = records_per_acquisition / records_per_buffer,
+                dtype = dtype,
+                bit_depth = bit_depth)
+
+class AcquisitionPlan(object):
+    """Precomputed layout of an acquisition for the buffer processing loop.
+
+    A plan is built once per acquisition from the dictionary returned by
+    def_acq_params, so that processing a buffer does not need to look up or
+    recompute anything from the parameters.
+
+    Attributes:
+        samples_per_record, records_per_acquisition, records_per_buffer,
+            channel_count, buffers_per_acquisition, dtype, bit_depth: as in
+            the acquisition parameters
+        shift: the number of bits to right-shift the samples by, since the
+            12-bit digitizers write into the most significant bits
+        buffer_shape: the shape of a buffer as (records, samples, channels)
+        record_offsets: the acquisition record number of the first record in
+            each buffer
+    """
+    __slots__ = ("samples_per_record", "records_per_acquisition", "records_per_buffer",
+                 "channel_count", "buffers_per_acquisition", "dtype", "bit_depth",
+                 "shift", "buffer_shape", "record_offsets", "_rec_type_tables")
+
+    def __init__(self, params):
+        self.samples_per_record = params["samples_per_record"]
+        self.records_per_acquisition = params["records_per_acquisition"]
+        self.records_per_buffer = params["records_per_buffer"]
+        self.channel_count = params["channel_count"]
+        self.buffers_per_acquisition = params["buffers_per_acquisition"]
+        self.dtype = params["dtype"]
+        self.bit_depth = params["bit_depth"]
+        self.shift = 16 - self.bit_depth if self.bit_depth > 8 else 0
+        self.buffer_shape = (self.records_per_buffer,
+                             self.samples_per_record,
+                             self.channel_count)
+        self.record_offsets = tuple(buf_num*self.records_per_buffer
+                                    for buf_num in xrange(self.buffers_per_acquisition))
+        # (rec_type, offset) tables, by number of record types and buffer phase
+        self._rec_type_tables = {}
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for (name, val) in state.iteritems():
+            setattr(self, name, val)
+
+    def rec_type_offsets(self, buf_num, n_rec_types, n_bufs=1):
+        """Return the (rec_type, offset) pairs of a buffer.
+
+        offset is the index in the buffer of the first record of rec_type,
+        when each consecutive set of n_rec_types records in the acquisition
+        contains one of each type, in order.  Record types which do not occur
+        in the buffer are left out.  If n_bufs is given, the pairs are for a
+        batch of that many buffers starting at buf_num.  The table for each
+        buffer phase is only computed once.
+        """
+        phase = (buf_num*self.records_per_buffer) % n_rec_types
+        key = (n_rec_types, phase, n_bufs)
+        try:
+            return self._rec_type_tables[key]
+        except KeyError:
+            pass
+        table = []
+        for rec_type in xrange(n_rec_types):
+            offset = (rec_type - phase) % n_rec_types
+            if offset < n_bufs*self.records_per_buffer:
+                table.append((rec_type, offset))
+        self._rec_type_tables[key] = table
+        return table
+
+    def rec_type_counts(self, n_records, n_rec_types):
+        """Return the number of records of each type in the first n_records.
+
+        Returns:
+            numpy array of shape (n_rec_types,)
+        """
+        return np.array([(n_records - rec_type + n_rec_types - 1) / n_rec_types
+                         for rec_type in xrange(n_rec_types)], np.int64)
+
+# --- valid parameter settings by board type
+
+def channels(board_type):
+    """Get the dictionary of channel names.
+
+    board_type can be the numerical ID or the string "ATS####"
+    """
+    if is_9870(board_type) or is_9360(board_type):
+        return params.channels
+    else:
+        raise AlazarException("Could not get channels for board type " + str(board_type))
+
+def trigger_sources(board_type):
+    """Get the dictionary of trigger sources.
+
+    board_type can be the numerical ID or the string "ATS####"
+    """
+    if is_9870(board_type) or is_9360(board_type):
+        return params.trig_sources
+    else:
+        raise AlazarException("Could not get trigger sources for board type " + str(board_type))
+
+def clock_sources(board_type):
+    """Get the dictionary of valid clock sources for this board type.
+
+    board_type can be the numerical ID or the string "ATS####"
+    At present, only the ATS9870 and ATS9360 are supported.
+    """
+    if is_9870(board_type) or is_9360(board_type):
+        return params.clock_sources
+    else:
+        raise AlazarException("Could not get clock sources for board type " + str(board_type))
+
+def sample_rates(board_type):
+    """Get the dictionary of valid sample rates for this board type.
+
+    board_type can be the numerical ID or the string "ATS####"
+    At present, only the ATS9870 and ATS9360 are supported.
+    """
+    if is_9870(board_type):
+        return params.sample_rates_9870
+    elif is_9360(board_type):
+        return params.sample_rates_9360
+    else:
+        raise AlazarException("Could not get sample rates for board type " + str(board_type))
+
+def ranges(board_type):
+    """Get the dictionary of valid range names.
+
+    board_type can be the numerical ID or the string "ATS####"
+    At present, only the ATS9870 and ATS9360 are supported.
+    """
+    if is_9870(board_type):
+        return params.ranges_9870
+    elif is_9360(board_type):
+        return params.ranges_9360
+    else:
+        raise AlazarException("Could not get input ranges for board type " + str(board_type))
+
+def input_couplings(board_type):
+    """Get the dictionary of valid input coupings.
+
+    board_type can be the numerical ID or the string "ATS####"
+    At present, only the ATS9870 and ATS9360 are supported.
+    """
+    if is_9870(board_type):
+        return params.couplings_9870
+    elif is_9360(board_type):
+        return params.couplings_9360
+    else:
+        raise AlazarException("Could not get input couplings for board type " + str(board_type))
+
+def ext_trig_range(board_type):
+    """Get the dictionary of valid external trigger ranges.
+
+    board_type can be the numerical ID or the string "ATS####"
+    At present, only the ATS9870 and ATS9360 are supported.
+    The SDK guide does specify which ranges are valid for which board.
+    """
+    if is_9870(board_type):
+        return params.trig_ranges_9870
+    elif is_9360(board_type):
+        return params.trig_ranges_9360
+    else:
+        raise AlazarException("Could not get trigger input ranges for board type " + str(board_type))
+
+# --- parameter validation
+
+max_decimation = 100000
+
+def _check_decimation(board_type, decimation):
+    """Check the decimation parameter given a board type.
+
+    This function does not raise an exception.
+    This function currently only supports the ATS9870.
+    """
+    if decimation >= max_decimation:
+        return False
+
+    if is_9870(board_type):
+        if decimation in [1,2,4] or (decimation >= 0 and decimation % 10 == 0):
+            # 10 MHz ref requires decimation of 1, 2, 4, or mult. of 10
+            return True
+        else:
+            return False
+    else:
+        return False
+
+def _check_buffer_alignment(board_type, n_samples):
+    """Check the record length for minimum length and buffer alignment.
+
+    This function currently only supports the ATS9870.
+    """
+    if is_9870(board_type):
+        # ATS9870: min record size is 256, n_samples must be a multiple of 64.
+        min_record_size = 256
+        buffer_alignment = 64
+    elif is_9360(board_type):
+        # ATS9360: min record size is 256, n_samples must be a multiple of 128.
+        min_record_size = 256
+        buffer_alignment = 128
+    else:
+        raise AlazarException("Could not validate record length for board type {}."
+                              .format(board_type))
+
+    if n_samples < min_record_size:
+        raise AlazarException("Minimum record length is {}. Provided: {}"
+                              .format(min_record_size,n_samples))
+    elif n_samples % buffer_alignment != 0:
+        raise AlazarException("Sample size must be a multiple of {}. Provided: {}"
+                              .format(buffer_alignment, n_samples))
+
+# build the channel mask
+# channels interface will require refactoring to support boards with
+# more than two channels.
+def _make_channel_mask(board_type, selection):
+    """Make the channel mask for a channel selection.
+
+    This function currently only supports the ATS9870 and ATS9360.
+    Support for boards with more than two channels will require
+        refactoring the channel selection interface.
+
+    Raises an AlazarException for invalid input or unsupported board type.
+
+    Returns a tuple with the channel mask and channel count.
+    """
+    if is_9870(board_type) or is_9360(board_type):
+        if selection == "all":
+            return (3,2)
+        else:
+            try:
+                channel_mask = channels(board_type)[selection]
+            except (KeyError, TypeError):
+                raise AlazarException("Invalid channel selection: '{}'".format(selection))
+            return (channel_mask,1)
+    else:
+        raise AlazarException("Could not make channel mask for board type {}.".format(board_type))
+
+# --- helper functions
+
+def is_9870(board_type):
+    return board_type == 13 or board_type == "ATS9870"
+
+def is_9360(board_type):
+    return board_type == 25 or board_type == "ATS9360"
+
+def buffer_telemetry(buffer_times):
+    """Summarize when the DMA buffers of an acquisition were received.
+
+    Args:
+        buffer_times: the time in seconds at which each buffer completed
+
+    Returns:
+        Dictionary with the entries
+            buffers: the number of buffers received
+            intervals: numpy array of the times between consecutive buffers
+            mean_interval, jitter, max_interval: the mean, standard deviation
+                and maximum of the intervals; NaN for fewer than two buffers
+    """
+    intervals = np.diff(np.asarray(buffer_times, np.float))
+    if len(intervals):
+        stats = (np.mean(intervals), np.std(intervals), np.max(intervals))
+    else:
+        stats = (np.nan, np.nan, np.nan)
+    return dict(buffers=len(buffer_times),
+                intervals=intervals,
+                mean_interval=stats[0],
+                jitter=stats[1],
+                max_interval=stats[2])
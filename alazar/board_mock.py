@@ -13,16 +13,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Mock of a board for testing purposes."""
-import multiprocessing as mp
+import timeit
 from itertools import izip
 
 import numpy as np
 
-from board import (def_acq_params, AlazarException, is_9870, is_9360,
-                   _make_channel_mask)
+from board_common import (def_acq_params, buffer_telemetry, is_9870, is_9360,
+                          _make_channel_mask)
+from exceptions import AlazarException
 import params
 
-from process import _process_buffers, _reshape_buffer
+from budget import check_memory_budget
+from placement import apply_placement
+from transport import LocalTransport
+from process import _acquire_sequence
 from processor import BufferProcessor
 
 
@@ -38,6 +42,10 @@ class MockAlazar(object):
         self.board_type = board_type
         self.systemID = 1
         self.boardID = 1
+        self.telemetry = None
+        # the mock buffer of the last geometry, reused like the board's pool
+        self._buffer_key = None
+        self._buffer = None
 
     # Cython needs a getter to access this, imitate the same API
     def get_board_type(self):
@@ -46,6 +54,23 @@ class MockAlazar(object):
     def get_board_model(self):
         return params.board_types[self.board_type]
 
+    def prewarm_buffers(self,
+                        samples_per_record,
+                        records_per_buffer,
+                        channels_to_acquire="all",
+                        buffer_count = 64):
+        """Build the mock buffer for an acquisition geometry ahead of time."""
+        self._mock_buffer(samples_per_record, records_per_buffer, channels_to_acquire)
+
+    def release_buffers(self):
+        """Release the cached mock buffer."""
+        self._buffer_key = None
+        self._buffer = None
+
+    def get_telemetry(self):
+        """Return the buffer timing of the last acquisition; see Alazar.get_telemetry."""
+        return self.telemetry
+
     def setup_capture_clock(self, clock_source, sample_rate, decimation=0, edge="rising"):
         """Set the capture clock for this alazar board.
 
@@ -89,79 +114,154 @@ class MockAlazar(object):
                 channels_to_acquire="all",
                 processors = [BufferProcessor()],
                 buffer_count = 64,
-                timeout = 5000):
+                timeout = 5000,
+                memory_budget = None,
+                on_over_budget = "raise",
+                acquisition_placement = None,
+                processing_placement = None,
+                transport = None):
         """Perform an acquisition using two-port NPT DMA mode.
 
         This mock function operates on the processors like a real board.  Each
         mock record is a rising sawtooth where each successive sample rises by
-        one digitizer unit, wrapping back to zero.  It does not do any validation
-        of the inputs, and never raises an exception.  It actually does pickle
-        and unpickle the processors to mimic the behavior of the real processing
-        function, to avoid possible confusion of mutating the input buffers.
+        one digitizer unit, wrapping back to zero.  It only validates the channel
+        selection and the memory budget, and raises no other exceptions.  It
+        actually does pickle and unpickle the processors to mimic the behavior of
+        the real processing function, to avoid possible confusion of mutating the
+        input buffers.
         """
+        comm = self._acquire_buffers(samples_per_record,
+                                     records_per_acquisition,
+                                     records_per_buffer,
+                                     channels_to_acquire,
+                                     processors,
+                                     buffer_count,
+                                     timeout,
+                                     memory_budget,
+                                     on_over_budget,
+                                     acquisition_placement,
+                                     processing_placement,
+                                     transport)
+        # get the processors and return them
+        return comm.get()
+
+    def acquire_sequence(self, acquisitions):
+        """Perform a series of back-to-back acquisitions.
+
+        This mock function pipelines the acquisitions like a real board; see
+        Alazar.acquire_sequence.
+        """
+        return _acquire_sequence(self._acquire_buffers, acquisitions)
+
+    def _acquire_buffers(self,
+                         samples_per_record,
+                         records_per_acquisition,
+                         records_per_buffer,
+                         channels_to_acquire="all",
+                         processors = [BufferProcessor()],
+                         buffer_count = 64,
+                         timeout = 5000,
+                         memory_budget = None,
+                         on_over_budget = "raise",
+                         acquisition_placement = None,
+                         processing_placement = None,
+                         transport = None):
+        """Send the mock buffers to a worker and return its result queue."""
         buffers_per_acquisition = records_per_acquisition / records_per_buffer
 
-        if is_9870(self.board_type):
-            bits_per_sample = 8
-            interleave = False
-        elif is_9360(self.board_type):
-            bits_per_sample = 12
-            interleave = True
-        else:
-            raise MockAlazarException("MockAlazar only can mimic the "
-                                      "9870 and 9360; got board type of {}"
-                                      .format(self.board_type))
+        (bits_per_sample, sample_type) = mock_sample_format(self.board_type)
 
         (_, channel_count) = _make_channel_mask(self.board_type, channels_to_acquire)
 
-        bytes_per_sample = (bits_per_sample + 7) / 8
-
-        if bytes_per_sample <= 1:
-            sample_type = np.uint8
-        else:
-            sample_type = np.uint16
         acq_params = def_acq_params(samples_per_record,
                                     records_per_acquisition,
                                     records_per_buffer,
                                     channel_count,
                                     sample_type,
                                     bits_per_sample)
-        # get a queue to send buffers to the buffer processor
-        buf_queue = mp.Queue()
-        # get a queue to receive messages back from the processors
-        comm = mp.Queue()
-        # start a buffer processor to do the acquisition:
-        buf_processor = mp.Process(target = _process_buffers,
-                                   args = (buf_queue,
-                                           comm,
-                                           processors,
-                                           acq_params,))
-        buf_processor.start()
+        check_memory_budget(acq_params, processors, buffer_count,
+                            memory_budget, on_over_budget)
+        # start the buffer processor, in a local worker unless a transport is given
+        if transport is None:
+            transport = LocalTransport()
+        (buf_queue, comm, stop) = transport.start(processors, acq_params,
+                                                  processing_placement)
+
+        # place this thread after starting the worker, so it isn't inherited
+        try:
+            restore_placement = apply_placement(acquisition_placement)
+        except Exception as err:
+            buf_queue.put((None, err))
+            raise
 
+        buffer_times = []
         try:
-            buf = make_mock_buffer(records_per_buffer, samples_per_record,
-                                   bits_per_sample, sample_type, channel_count)
+            buf = self._mock_buffer(samples_per_record, records_per_buffer,
+                                    channels_to_acquire)
             # handle each buffer
             for _ in xrange(buffers_per_acquisition):
+                # the processors have converged, tell them no more buffers are coming
+                if stop.is_set():
+                    buf_queue.put( (None, None) )
+                    break
                 # pickles the buffer and sends to the worker
                 buf_queue.put( (buf, None) )
+                buffer_times.append(timeit.default_timer())
         except Exception as err:
             buf_queue.put((None, err))
             raise
+        finally:
+            restore_placement()
+            self.telemetry = buffer_telemetry(buffer_times)
+
+        return comm
+
+    def _mock_buffer(self, samples_per_record, records_per_buffer, channels_to_acquire):
+        """Return the mock buffer for a geometry, reusing it if the geometry is unchanged."""
+        key = (samples_per_record, records_per_buffer, channels_to_acquire)
+        if key != self._buffer_key:
+            (bits_per_sample, sample_type) = mock_sample_format(self.board_type)
+            (_, channel_count) = _make_channel_mask(self.board_type, channels_to_acquire)
+            # the mock records depend on which board channel is acquired
+            first_chan = 1 if channels_to_acquire == "B" else 0
+            self._buffer = make_mock_buffer(records_per_buffer, samples_per_record,
+                                            bits_per_sample, sample_type, channel_count,
+                                            first_chan)
+            self._buffer_key = key
+        return self._buffer
+
+
+def mock_sample_format(board_type):
+    """Return the bit depth and sample dtype of a mocked board type.
+
+    Raises a MockAlazarException if the board type can't be mocked.
+    """
+    if is_9870(board_type):
+        bits_per_sample = 8
+    elif is_9360(board_type):
+        bits_per_sample = 12
+    else:
+        raise MockAlazarException("MockAlazar only can mimic the "
+                                  "9870 and 9360; got board type of {}"
+                                  .format(board_type))
+    bytes_per_sample = (bits_per_sample + 7) / 8
 
-        # get the processors and return them
-        return comm.get()
-
+    if bytes_per_sample <= 1:
+        sample_type = np.uint8
+    else:
+        sample_type = np.uint16
+    return (bits_per_sample, sample_type)
 
 def make_mock_buffer(records_per_buffer, record_len, bit_depth, dtype,
-                     chan_count):
+                     chan_count, first_chan=0):
     """Return a buffer of sawtooth records.
 
     Each record has the form [0, 1, 2, 3, ... 2**bit_depth - 1, 0, 1, ...];
     however, for sample depths greater than 8 bits, this value is bit-shifted
     into the most significant bits to fully mimic the behavior of the Alazar
     boards.  The records for channel A are rising sawtooths, while the records
-    for channel B are falling sawtooths.
+    for channel B are falling sawtooths.  Two channels are interleaved sample by
+    sample, while a single channel is stored as contiguous records.
 
     Args:
         records_per_buffer: the number of records in the buffer, also the first
@@ -171,17 +271,17 @@ def make_mock_buffer(records_per_buffer, record_len, bit_depth, dtype,
         bit_depth: the bit depth of the board to emulate
         dtype: the dtype of the resulting numpy array
         chan_count: the number of acquisition channels
+        first_chan: the index of the first acquired channel; 1 to mock a
+            single-channel acquisition of channel B
     """
-    buffer_length = records_per_buffer * record_len * chan_count
-    buff = np.empty(buffer_length, dtype=dtype)
-    
-    for chan in xrange(chan_count):
-        for rec in xrange(records_per_buffer):
-            record_vals = mock_record(record_len, reverse=(chan==1), bit_depth=bit_depth)
-            record = np.fromiter(record_vals, dtype=dtype, count=record_len)
+    buff = np.empty((records_per_buffer, record_len, chan_count), dtype=dtype)
 
-            rec_start = 2*rec*record_len + chan
-            buff[rec_start:rec_start+2*record_len:2] = record
+    for chan in xrange(chan_count):
+        record_vals = mock_record(record_len, reverse=(first_chan+chan==1),
+                                  bit_depth=bit_depth)
+        # every record of a channel is the same
+        buff[:,:,chan] = np.fromiter(record_vals, dtype=dtype, count=record_len)
+    buff.shape = (buff.size,)
 
     if bit_depth > 8:
         return buff << (16 - bit_depth)
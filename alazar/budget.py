@@ -0,0 +1,165 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Check that an acquisition fits in memory before the board is armed.
+
+An acquisition needs memory for the DMA buffers, for the copies of those
+buffers waiting in the queue to the worker, for the processors' own state and
+results, and for the pickled results sent back to the caller.  If the total is
+over budget, acquire() raises before anything is allocated, or moves the
+results of processors that support it into memory-mapped files on disk.
+"""
+import ctypes
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from alazar import shared
+from alazar.exceptions import AlazarException
+
+# the fraction of physical memory used as the default budget
+DEFAULT_FRACTION = 0.8
+
+def physical_memory():
+    """Return the physical memory of this machine in bytes, or None if unknown."""
+    if sys.platform == "win32":
+        return _windows_physical_memory()
+    try:
+        return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def default_budget():
+    """Return the default memory budget in bytes, or None if unknown."""
+    total = physical_memory()
+    if total is None:
+        return None
+    return int(total*DEFAULT_FRACTION)
+
+def spill_dir():
+    """Return the directory for results spilled to disk."""
+    return tempfile.gettempdir()
+
+def memory_plan(acq_params, processors, buffer_count):
+    """Return the memory in bytes an acquisition is expected to need.
+
+    The buffer queue to the worker is assumed to hold at most buffer_count
+    buffers, which it does as long as the worker keeps up with the board.
+
+    Returns:
+        Dictionary with the entries
+            dma: the DMA buffers
+            transport: the buffers in the queue to the worker and the pickled
+                results of processors which are not shared
+            processors: the state and results of the processors
+            total: the sum of the above
+    """
+    bytes_per_buffer = (acq_params["records_per_buffer"]*acq_params["samples_per_record"]*
+                        acq_params["channel_count"]*np.dtype(acq_params["dtype"]).itemsize)
+    processor_bytes = 0
+    result_bytes = 0
+    for proc in processors:
+        if not hasattr(proc, "memory_footprint"):
+            continue
+        footprint = proc.memory_footprint(acq_params)
+        processor_bytes += footprint
+        if not getattr(proc, "shared", False):
+            # results which are not shared are pickled back to the caller
+            result_bytes += footprint
+    plan = dict(dma=buffer_count*bytes_per_buffer,
+                transport=buffer_count*bytes_per_buffer + result_bytes,
+                processors=processor_bytes)
+    plan["total"] = plan["dma"] + plan["transport"] + plan["processors"]
+    return plan
+
+def check_memory_budget(acq_params, processors, buffer_count, memory_budget=None,
+                        on_over_budget="raise"):
+    """Check an acquisition against a memory budget.
+
+    Args:
+        acq_params: the acquisition parameter dictionary from def_acq_params
+        processors ([BufferProcessor]): the processors for the acquisition
+        buffer_count (int): the number of DMA buffers
+        memory_budget (int): the budget in bytes; defaults to default_budget().
+            If no budget is given or known, nothing is checked.
+        on_over_budget (str): "raise" to raise an AlazarException, or "spill"
+            to store the results of the largest processors in memory-mapped
+            files in spill_dir() until the acquisition fits.  Spilled
+            processors have their shared attribute set to that directory.
+
+    Returns:
+        The memory_plan of the acquisition, after spilling.
+
+    Raises:
+        AlazarException if the acquisition does not fit in the budget.
+    """
+    if on_over_budget not in ("raise", "spill"):
+        raise AlazarException("Invalid on_over_budget: '{}'; must be 'raise' or"
+                              " 'spill'.".format(on_over_budget))
+    if memory_budget is None:
+        memory_budget = default_budget()
+    plan = memory_plan(acq_params, processors, buffer_count)
+    if memory_budget is None or plan["total"] <= memory_budget:
+        return plan
+
+    if on_over_budget == "spill" and not shared.is_ram_backed(spill_dir()):
+        candidates = sorted((proc for proc in processors
+                             if hasattr(proc, "memory_footprint") and hasattr(proc, "shared")),
+                            key=lambda proc: proc.memory_footprint(acq_params),
+                            reverse=True)
+        for proc in candidates:
+            old_shared = proc.shared
+            proc.shared = spill_dir()
+            new_plan = memory_plan(acq_params, processors, buffer_count)
+            if new_plan["total"] >= plan["total"]:
+                # this processor has no results which can be spilled
+                proc.shared = old_shared
+                continue
+            plan = new_plan
+            if plan["total"] <= memory_budget:
+                return plan
+
+    raise AlazarException("Acquisition needs {:.1f} MiB of memory ({:.1f} MiB DMA buffers,"
+                          " {:.1f} MiB transport, {:.1f} MiB processors), over the budget"
+                          " of {:.1f} MiB."
+                          .format(*[_mib(size) for size in (plan["total"], plan["dma"],
+                                                            plan["transport"],
+                                                            plan["processors"],
+                                                            memory_budget)]))
+
+def _mib(size):
+    return size / float(2**20)
+
+def _windows_physical_memory():
+    """Return the physical memory from GlobalMemoryStatusEx, or None."""
+    class MEMORYSTATUSEX(ctypes.Structure):
+        _fields_ = [("dwLength", ctypes.c_ulong),
+                    ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong),
+                    ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong),
+                    ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong),
+                    ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+    status = MEMORYSTATUSEX()
+    status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+    try:
+        if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return None
+    except (AttributeError, OSError):
+        return None
+    return status.ullTotalPhys
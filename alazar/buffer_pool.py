@@ -0,0 +1,128 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""A pool of DMA buffers reused from one acquisition to the next.
+
+Allocating fresh buffers for every acquisition costs an allocation and a page
+fault for every page the board writes, which dominates short acquisitions.
+A BufferPool keeps one block of page-aligned memory, sized to the largest
+geometry requested so far, and hands out views into it.  The pages can be
+faulted in ahead of time with prewarm(), and on Linux the block can be backed
+by transparent huge pages to reduce TLB misses.  Since the pages may already
+be faulted in, get() moves them to the NUMA node it is asked for.
+"""
+import ctypes
+import ctypes.util
+import mmap
+import sys
+
+import numpy as np
+
+from alazar.placement import move_to_numa_node
+
+# the size of a transparent huge page on x86-64 Linux
+HUGE_PAGE_SIZE = 2*2**20
+# madvise advice to back a range with transparent huge pages
+_MADV_HUGEPAGE = 14
+
+class BufferPool(object):
+    """Page-aligned DMA buffers which are reused across acquisitions."""
+    def __init__(self, huge_pages=False):
+        """Create a new, empty buffer pool.
+
+        Args:
+            huge_pages (bool): if True, align the buffers to huge pages and ask
+                the kernel to back them with transparent huge pages.  Ignored
+                where this is not supported.
+        """
+        self.huge_pages = huge_pages
+        self._map = None
+        self._slot_size = 0
+        self._slot_count = 0
+        self._data = None
+        self._numa_node = None
+
+    def get(self, buffer_count, samples_per_buffer, dtype, numa_node=None):
+        """Return a list of buffers from the pool, growing it if needed.
+
+        The buffers are views into the pool and are overwritten by the next
+        acquisition which uses the pool.
+
+        Args:
+            numa_node (int): the NUMA node the pool's memory should be on; its
+                pages are moved there if needed, and stay there until another
+                node is asked for.  None leaves the memory where it is.
+
+        Raises:
+            AlazarException if the memory could not be moved to the node.
+        """
+        nbytes = samples_per_buffer*np.dtype(dtype).itemsize
+        self._reserve(buffer_count, nbytes)
+        if numa_node is not None and numa_node != self._numa_node:
+            move_to_numa_node(self._data.ctypes.data, self._data.nbytes, numa_node)
+            self._numa_node = numa_node
+        return [self._data[slot*self._slot_size:slot*self._slot_size + nbytes].view(dtype)
+                for slot in xrange(buffer_count)]
+
+    def prewarm(self, buffer_count, samples_per_buffer, dtype):
+        """Grow the pool for a geometry and fault in all of its pages."""
+        self._reserve(buffer_count, samples_per_buffer*np.dtype(dtype).itemsize)
+        # touching one byte of each page maps it
+        self._data[::mmap.PAGESIZE] = 0
+
+    def release(self):
+        """Drop the pool's memory.
+
+        The memory is returned to the system once no buffers from the pool are
+        referenced any more; the next get() allocates it again.
+        """
+        self._map = None
+        self._data = None
+        self._slot_size = 0
+        self._slot_count = 0
+        self._numa_node = None
+
+    def nbytes(self):
+        """Return the size of the pool in bytes."""
+        return self._slot_size*self._slot_count
+
+    def _reserve(self, buffer_count, nbytes):
+        """Make sure the pool has buffer_count slots of at least nbytes."""
+        alignment = HUGE_PAGE_SIZE if self.huge_pages else mmap.PAGESIZE
+        slot_size = -(-nbytes // alignment)*alignment
+        if slot_size <= self._slot_size and buffer_count <= self._slot_count:
+            return
+        # grow to the largest geometry seen so far
+        slot_size = max(slot_size, self._slot_size)
+        slot_count = max(buffer_count, self._slot_count)
+        size = slot_size*slot_count
+        # anonymous maps are page-aligned; map extra to align to a huge page
+        block = mmap.mmap(-1, size + alignment - mmap.PAGESIZE)
+        data = np.frombuffer(block, np.uint8)
+        offset = -data.ctypes.data % alignment
+        data = data[offset:offset + size]
+        if self.huge_pages:
+            _advise_huge_pages(data)
+        (self._map, self._data) = (block, data)
+        self._numa_node = None
+        (self._slot_size, self._slot_count) = (slot_size, slot_count)
+
+def _advise_huge_pages(data):
+    """Ask the kernel to back an array with transparent huge pages, if possible."""
+    if not sys.platform.startswith("linux"):
+        return
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    # a failure only means the pages stay small
+    libc.madvise(ctypes.c_void_p(data.ctypes.data), ctypes.c_size_t(data.nbytes),
+                 _MADV_HUGEPAGE)
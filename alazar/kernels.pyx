@@ -0,0 +1,138 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Compiled reductions for the built-in processors.
+
+Each kernel reads the records of one channel straight out of the interleaved
+DMA buffer, shifts the samples down to the bit depth of the board and adds
+them into a processor's accumulator in a single pass, without the temporary
+arrays the equivalent NumPy expression needs.  The loops run without the GIL.
+
+The records are a 2D view of samples (records x samples per record) with any
+strides, so a channel can be passed without deinterleaving it first.  The
+processors fall back to NumPy if this module is not built.
+"""
+cimport cython
+from libc.stdint cimport uint8_t, uint16_t, int64_t
+
+ctypedef fused sample_t:
+    uint8_t
+    uint16_t
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sum_records(sample_t[:, :] recs, int shift, int64_t[:] sums,
+                int64_t[:] sumsqs=None):
+    """Add every record, shifted right by shift, into sums.
+
+    Args:
+        recs: the records, of shape (records, samples)
+        shift (int): the number of bits to shift each sample right
+        sums: the accumulator, of shape (samples,)
+        sumsqs: if given, the squares of the samples are added into this
+            accumulator, of shape (samples,)
+    """
+    cdef Py_ssize_t n_recs = recs.shape[0]
+    cdef Py_ssize_t n_samples = recs.shape[1]
+    cdef Py_ssize_t rec, samp
+    cdef int64_t val
+    _check_length(sums.shape[0], n_samples)
+    if sumsqs is None:
+        with nogil:
+            for rec in range(n_recs):
+                for samp in range(n_samples):
+                    sums[samp] += recs[rec, samp] >> shift
+    else:
+        _check_length(sumsqs.shape[0], n_samples)
+        with nogil:
+            for rec in range(n_recs):
+                for samp in range(n_samples):
+                    val = recs[rec, samp] >> shift
+                    sums[samp] += val
+                    sumsqs[samp] += val*val
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def sum_record_types(sample_t[:, :] recs, int shift, int first_type,
+                     int64_t[:, :] sums, int64_t[:, :] sumsqs=None):
+    """Add every record, shifted right by shift, into the sum for its type.
+
+    The record types repeat in order, starting from first_type.
+
+    Args:
+        recs: the records, of shape (records, samples)
+        shift (int): the number of bits to shift each sample right
+        first_type (int): the record type of the first record
+        sums: the accumulators, of shape (record types, samples)
+        sumsqs: if given, the squares of the samples are added into these
+            accumulators, of shape (record types, samples)
+    """
+    cdef Py_ssize_t n_recs = recs.shape[0]
+    cdef Py_ssize_t n_samples = recs.shape[1]
+    cdef Py_ssize_t n_types = sums.shape[0]
+    cdef Py_ssize_t rec, samp, rec_type
+    cdef int64_t val
+    _check_length(sums.shape[1], n_samples)
+    if n_types < 1 or first_type < 0 or first_type >= n_types:
+        raise ValueError("Invalid first record type {} for {} record types."
+                         .format(first_type, n_types))
+    if sumsqs is not None:
+        _check_length(sumsqs.shape[0], n_types)
+        _check_length(sumsqs.shape[1], n_samples)
+    with nogil:
+        rec_type = first_type
+        for rec in range(n_recs):
+            if sumsqs is None:
+                for samp in range(n_samples):
+                    sums[rec_type, samp] += recs[rec, samp] >> shift
+            else:
+                for samp in range(n_samples):
+                    val = recs[rec, samp] >> shift
+                    sums[rec_type, samp] += val
+                    sumsqs[rec_type, samp] += val*val
+            rec_type += 1
+            if rec_type == n_types:
+                rec_type = 0
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def chunk_means(sample_t[:, :] recs, int shift, Py_ssize_t start, Py_ssize_t stop,
+                double[:] means):
+    """Store the mean of samples start:stop of each record, shifted right by shift.
+
+    Args:
+        recs: the records, of shape (records, samples)
+        shift (int): the number of bits to shift each sample right
+        start, stop (int): the range of samples to average
+        means: the output, of shape (records,)
+    """
+    cdef Py_ssize_t n_recs = recs.shape[0]
+    cdef Py_ssize_t rec, samp
+    cdef int64_t total
+    _check_length(means.shape[0], n_recs)
+    if start < 0 or stop > recs.shape[1] or start >= stop:
+        raise ValueError("Invalid sample range {}:{} for records of {} samples."
+                         .format(start, stop, recs.shape[1]))
+    with nogil:
+        for rec in range(n_recs):
+            total = 0
+            for samp in range(start, stop):
+                total += recs[rec, samp] >> shift
+            means[rec] = <double>total / (stop - start)
+
+cdef _check_length(Py_ssize_t length, Py_ssize_t expected):
+    if length != expected:
+        raise ValueError("Accumulator has length {}; expected {}.".format(length, expected))
@@ -0,0 +1,270 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Pin the acquisition and processing processes to chosen cores and memory.
+
+A Placement names the CPUs a process may run on, its scheduling priority and
+the NUMA node its memory should come from.  acquire() applies one placement to
+the calling thread, which drains the DMA buffers, for the duration of the
+acquisition, and another to the processing worker.
+
+On Linux the affinity, the niceness and the memory policy all belong to a
+thread, so a placement only moves the thread which applies it, and the threads
+it starts afterwards; other threads of the process keep running where they
+were.  On Windows the affinity and the priority class apply to the whole
+process.
+
+The settings use the C library and libnuma on Linux and kernel32 on Windows
+through ctypes; a setting which is not supported on a platform raises an
+AlazarException when it is applied.
+"""
+import ctypes
+import ctypes.util
+import os
+import sys
+
+from alazar.exceptions import AlazarException
+
+class Placement(object):
+    """Where and how urgently a process should run.
+
+    On Linux only the thread which applies the placement is placed; see the
+    module docstring.
+    """
+    def __init__(self, cpus=None, priority=None, numa_node=None):
+        """Create a new placement.
+
+        Args:
+            cpus ([int]): the CPUs the process may run on; None leaves the
+                affinity unchanged.
+            priority (int): the niceness of the process, from -20 (most
+                urgent) to 19; on Windows, negative values select the high
+                priority class.  Raising the priority usually needs
+                administrator rights.  None leaves it unchanged.
+            numa_node (int): the NUMA node to allocate memory from, and to run
+                on if no cpus are given.  Linux only, and needs libnuma.
+        """
+        self.cpus = None if cpus is None else sorted(set(cpus))
+        self.priority = priority
+        self.numa_node = numa_node
+
+    def __repr__(self):
+        return "Placement(cpus={}, priority={}, numa_node={})".format(self.cpus,
+                                                                    self.priority,
+                                                                    self.numa_node)
+
+def apply_placement(placement):
+    """Apply a placement to the calling thread; on Windows, to the whole process.
+
+    Args:
+        placement (Placement): the placement; None does nothing.
+
+    Returns:
+        A function which restores the previous affinity, priority and memory
+        policy.  Call it from the same thread.
+
+    Raises:
+        AlazarException if a setting could not be applied.  Settings applied
+            before the failure are restored first.
+    """
+    restores = []
+    def restore():
+        for undo in reversed(restores):
+            try:
+                undo()
+            except AlazarException:
+                # an unprivileged process can't raise its priority back
+                pass
+    if placement is None:
+        return restore
+    try:
+        if placement.cpus is not None:
+            previous = get_affinity()
+            set_affinity(placement.cpus)
+            restores.append(lambda: set_affinity(previous))
+        if placement.priority is not None:
+            previous_priority = get_priority()
+            set_priority(placement.priority)
+            restores.append(lambda: set_priority(previous_priority))
+        if placement.numa_node is not None:
+            set_numa_node(placement.numa_node, run_on_node=placement.cpus is None)
+            restores.append(reset_numa_node)
+    except Exception:
+        restore()
+        raise
+    return restore
+
+# --- affinity
+
+def get_affinity():
+    """Return the list of CPUs the current process may run on."""
+    if sys.platform == "win32":
+        process_mask = ctypes.c_size_t()
+        system_mask = ctypes.c_size_t()
+        kernel32 = _kernel32()
+        if not kernel32.GetProcessAffinityMask(kernel32.GetCurrentProcess(),
+                                               ctypes.byref(process_mask),
+                                               ctypes.byref(system_mask)):
+            raise AlazarException("Could not get the CPU affinity: {}"
+                                  .format(ctypes.FormatError()))
+        return _mask_to_cpus(process_mask.value)
+    mask = _CpuSet()
+    if _libc().sched_getaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        raise AlazarException("Could not get the CPU affinity: {}"
+                              .format(os.strerror(ctypes.get_errno())))
+    return [cpu for cpu in xrange(_CpuSet.n_cpus) if mask.is_set(cpu)]
+
+def set_affinity(cpus):
+    """Restrict the current process to a list of CPUs."""
+    if not cpus:
+        raise AlazarException("At least one CPU must be given.")
+    if sys.platform == "win32":
+        kernel32 = _kernel32()
+        if not kernel32.SetProcessAffinityMask(kernel32.GetCurrentProcess(),
+                                               ctypes.c_size_t(_cpus_to_mask(cpus))):
+            raise AlazarException("Could not set the CPU affinity to {}: {}"
+                                  .format(cpus, ctypes.FormatError()))
+        return
+    mask = _CpuSet()
+    for cpu in cpus:
+        if cpu < 0 or cpu >= _CpuSet.n_cpus:
+            raise AlazarException("Invalid CPU: {}".format(cpu))
+        mask.set(cpu)
+    if _libc().sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        raise AlazarException("Could not set the CPU affinity to {}: {}"
+                              .format(cpus, os.strerror(ctypes.get_errno())))
+
+class _CpuSet(ctypes.Structure):
+    """The Linux cpu_set_t."""
+    n_cpus = 1024
+    _fields_ = [("bits", ctypes.c_ulong*(n_cpus / (8*ctypes.sizeof(ctypes.c_ulong))))]
+
+    def _word(self, cpu):
+        word_bits = 8*ctypes.sizeof(ctypes.c_ulong)
+        return (cpu / word_bits, 1 << (cpu % word_bits))
+
+    def set(self, cpu):
+        (word, bit) = self._word(cpu)
+        self.bits[word] |= bit
+
+    def is_set(self, cpu):
+        (word, bit) = self._word(cpu)
+        return bool(self.bits[word] & bit)
+
+def _cpus_to_mask(cpus):
+    mask = 0
+    for cpu in cpus:
+        mask |= 1 << cpu
+    return mask
+
+def _mask_to_cpus(mask):
+    return [cpu for cpu in xrange(mask.bit_length()) if mask & (1 << cpu)]
+
+# --- priority
+
+# the Windows priority classes
+_NORMAL_PRIORITY_CLASS = 0x20
+_HIGH_PRIORITY_CLASS = 0x80
+
+def get_priority():
+    """Return the niceness of the current process."""
+    if sys.platform == "win32":
+        kernel32 = _kernel32()
+        priority_class = kernel32.GetPriorityClass(kernel32.GetCurrentProcess())
+        return -10 if priority_class == _HIGH_PRIORITY_CLASS else 0
+    return os.nice(0)
+
+def set_priority(priority):
+    """Set the niceness of the current process."""
+    if sys.platform == "win32":
+        priority_class = _HIGH_PRIORITY_CLASS if priority < 0 else _NORMAL_PRIORITY_CLASS
+        kernel32 = _kernel32()
+        if not kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), priority_class):
+            raise AlazarException("Could not set the priority to {}: {}"
+                                  .format(priority, ctypes.FormatError()))
+        return
+    # PRIO_PROCESS is 0, and who=0 is the calling thread under Linux threads
+    if _libc().setpriority(0, 0, priority) != 0:
+        raise AlazarException("Could not set the priority to {}: {}"
+                              .format(priority, os.strerror(ctypes.get_errno())))
+
+# --- NUMA
+
+# mbind mode and flag from numaif.h
+_MPOL_PREFERRED = 1
+_MPOL_MF_MOVE = 1 << 1
+
+def set_numa_node(node, run_on_node=False):
+    """Prefer memory from a NUMA node for the current process.
+
+    Args:
+        node (int): the NUMA node
+        run_on_node (bool): if True, also run only on the CPUs of that node
+    """
+    numa = _libnuma()
+    if node < 0 or node > numa.numa_max_node():
+        raise AlazarException("Invalid NUMA node: {}".format(node))
+    numa.numa_set_preferred(node)
+    if run_on_node and numa.numa_run_on_node(node) != 0:
+        raise AlazarException("Could not run on NUMA node {}: {}"
+                              .format(node, os.strerror(ctypes.get_errno())))
+
+def move_to_numa_node(address, nbytes, node):
+    """Prefer a NUMA node for a page-aligned range of memory.
+
+    Unlike set_numa_node, this also moves pages which were already faulted in
+    elsewhere, and the policy stays with the memory, whichever thread touches
+    it later.
+
+    Args:
+        address (int): the page-aligned start of the range
+        nbytes (int): the length of the range in bytes
+        node (int): the NUMA node
+    """
+    numa = _libnuma()
+    if node < 0 or node > numa.numa_max_node():
+        raise AlazarException("Invalid NUMA node: {}".format(node))
+    word_bits = 8*ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong*(node / word_bits + 1))()
+    mask[node / word_bits] = 1 << (node % word_bits)
+    # the kernel ignores the last bit of maxnode
+    if numa.mbind(ctypes.c_void_p(address), ctypes.c_ulong(nbytes), _MPOL_PREFERRED,
+                  mask, ctypes.c_ulong(len(mask)*word_bits + 1), _MPOL_MF_MOVE) != 0:
+        raise AlazarException("Could not move memory to NUMA node {}: {}"
+                              .format(node, os.strerror(ctypes.get_errno())))
+
+def reset_numa_node():
+    """Go back to allocating memory on the local node and running anywhere."""
+    numa = _libnuma()
+    numa.numa_set_localalloc()
+    numa.numa_run_on_node(-1)
+
+# --- library loading
+
+def _libc():
+    if not sys.platform.startswith("linux"):
+        raise AlazarException("CPU affinity and priority need Linux or Windows.")
+    return ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+def _kernel32():
+    return ctypes.WinDLL("kernel32", use_last_error=True)
+
+def _libnuma():
+    name = ctypes.util.find_library("numa") if sys.platform.startswith("linux") else None
+    if name is None:
+        raise AlazarException("NUMA placement needs libnuma.")
+    numa = ctypes.CDLL(name, use_errno=True)
+    if numa.numa_available() < 0:
+        raise AlazarException("NUMA is not available on this system.")
+    return numa
@@ -0,0 +1,145 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Live record envelopes shared through a memory-mapped file.
+
+The Preview processor writes the min/max/mean envelope of the latest records
+into a small slot file while the acquisition runs; any process can open the
+same file with PreviewSlot and poll it for display:
+
+    preview = Preview(n_points=512)
+    # start the acquisition in another thread or process; the worker creates
+    # the slot file when the acquisition starts, then
+    slot = PreviewSlot(preview.filename)
+    envelope = slot.read()
+
+The writer bumps a sequence number to an odd value before it writes and to
+the next even value after, so a reader which sees the same even number before
+and after copying the envelope knows the copy is consistent.
+"""
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+from alazar.shared import default_dir
+
+# the boards have at most two channels
+MAX_CHANNELS = 2
+
+# int64 header fields
+(_SEQ, _CHANNELS, _POINTS, _BUF_NUM, _RECORDS, _SAMPLES) = range(6)
+_HEADER_LEN = 8
+
+def slot_filename(directory=None):
+    """Return a new name for a slot file, without creating it.
+
+    Args:
+        directory: the directory for the file; defaults to shared.default_dir()
+    """
+    if directory is None:
+        directory = default_dir()
+    return os.path.join(directory, "pyalazar-preview-{}.dat".format(uuid.uuid4().hex))
+
+def create_slot(n_points, filename):
+    """Create an empty slot file for envelopes of up to n_points points.
+
+    The file is filled in under another name and then renamed, so a reader
+    never maps it half made.
+
+    Args:
+        n_points (int): the most points in an envelope.
+        filename (str): the name of the file, as from slot_filename.
+    """
+    (fd, tmp_name) = tempfile.mkstemp(prefix="pyalazar-preview-", suffix=".tmp",
+                                      dir=os.path.dirname(filename))
+    os.close(fd)
+    try:
+        size = 8*(_HEADER_LEN + MAX_CHANNELS*3*n_points)
+        slot_map = np.memmap(tmp_name, dtype=np.uint8, mode="w+", shape=(size,))
+        slot_map[:] = 0
+        slot_map.flush()
+        del slot_map
+        os.rename(tmp_name, filename)
+    except Exception:
+        os.remove(tmp_name)
+        raise
+
+class PreviewSlot(object):
+    """Reader and writer of the envelope in a slot file."""
+
+    def __init__(self, filename):
+        """Map a slot file made by create_slot."""
+        self.filename = filename
+        self._map = np.memmap(filename, dtype=np.uint8, mode="r+")
+        self._header = self._map[:8*_HEADER_LEN].view(np.int64)
+        max_points = (len(self._map)/8 - _HEADER_LEN) / (MAX_CHANNELS*3)
+        self._data = self._map[8*_HEADER_LEN:].view(np.float64).reshape((MAX_CHANNELS, 3,
+                                                                          max_points))
+
+    @property
+    def max_points(self):
+        return self._data.shape[2]
+
+    def write(self, mins, maxs, means, buf_num, n_records, samples_per_record):
+        """Publish the envelope of each channel.
+
+        Args:
+            mins, maxs, means: lists with an array of points for each channel.
+            buf_num (int): the last buffer in the envelope.
+            n_records (int): the number of records in the envelope.
+            samples_per_record (int): the record length the points span.
+        """
+        n_chans = len(mins)
+        n_points = len(mins[0])
+        seq = self._header[_SEQ]
+        self._header[_SEQ] = seq + 1
+        for (chan, envelope) in enumerate(zip(mins, maxs, means)):
+            self._data[chan,:,:n_points] = envelope
+        self._header[_CHANNELS] = n_chans
+        self._header[_POINTS] = n_points
+        self._header[_BUF_NUM] = buf_num
+        self._header[_RECORDS] = n_records
+        self._header[_SAMPLES] = samples_per_record
+        self._header[_SEQ] = seq + 2
+
+    def read(self, retries=100):
+        """Return a consistent copy of the latest envelope.
+
+        Returns:
+            Dictionary with lists of per-channel arrays "min", "max" and
+            "mean", and "buf_num", "records", "samples_per_record" and the
+            sequence number "seq", which increases with each update.  None if
+            nothing has been published yet, or the writer kept updating the
+            envelope during every try.
+        """
+        for _ in xrange(retries):
+            seq = int(self._header[_SEQ])
+            if seq == 0:
+                return None
+            if seq % 2:
+                continue
+            header = self._header.copy()
+            data = self._data[:header[_CHANNELS],:,:header[_POINTS]].copy()
+            if int(self._header[_SEQ]) != seq:
+                continue
+            return {"min": list(data[:,0]),
+                    "max": list(data[:,1]),
+                    "mean": list(data[:,2]),
+                    "buf_num": int(header[_BUF_NUM]),
+                    "records": int(header[_RECORDS]),
+                    "samples_per_record": int(header[_SAMPLES]),
+                    "seq": seq / 2}
+        return None
@@ -13,57 +13,262 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Move this function to a separate module to work around cython packaging issue."""
+import copy
+import sys
+from Queue import Empty
 
 import numpy as np
 
+from alazar import shared
+from alazar.board_common import AcquisitionPlan
+from alazar.exceptions import AlazarException
+from alazar.placement import apply_placement
+
+# the most buffers waiting in the queue which are processed as one batch
+MAX_BATCH_BUFFERS = 16
+
 def _process_buffers(buf_queue,
                      comm,
                      processors,
-                     acq_params,):
-    """Process buffers from the board."""
-    # initialize the buffer processors
-    for processor in processors:
-        processor.initialize(acq_params)
+                     acq_params,
+                     stop=None,
+                     placement=None,
+                     max_batch=MAX_BATCH_BUFFERS):
+    """Process buffers from the board.
+
+    If stop is given, it is set once every processor with a convergence target
+    has converged; the board then sends (None, None) instead of its next buffer.
+    If placement is given, it is applied to this process before the processors
+    are initialized.  Buffers already waiting in the queue, up to max_batch of
+    them, are joined and given to the processors' process_batch in one call.
+    """
+    plan = AcquisitionPlan(acq_params)
+    # place this process first, so the processors allocate on the right node
+    placement_error = None
+    try:
+        apply_placement(placement)
+    except AlazarException as err:
+        placement_error = err
     failure = False
+    n_processed = 0
+    # the buffers taken from the queue, and if the board is still sending more
+    n_received = 0
+    receiving = True
+    try:
+        # initialize the buffer processors
+        for processor in processors:
+            processor.initialize(acq_params, plan)
+        if placement_error is not None:
+            # the processors report the error; the buffers are still drained
+            for proc in processors:
+                proc.abort(placement_error)
+        # only the samples the processors ask for are extracted from each buffer
+        window = _sample_window(processors)
+        # the processors which can stop the acquisition early
+        voters = [proc for proc in processors if getattr(proc, "target", None) is not None]
 
-    # loop over all the buffers we expect to receive
-    for buf_num in xrange(acq_params["buffers_per_acquisition"]):
-        # get the next buffer from the queue
-        (buf, err) = buf_queue.get()
-        # check for error condition
-        if err is not None:
-            # tell the data processors to abort
+        # loop until we have all the buffers we expect to receive
+        while n_processed < plan.buffers_per_acquisition:
+            # get the next buffer, and any others already waiting, from the queue
+            (bufs, err, ended) = _get_batch(buf_queue,
+                                            min(max_batch,
+                                                plan.buffers_per_acquisition - n_processed))
+            n_bufs = len(bufs)
+            n_received += n_bufs
+            receiving = not ended
+            if n_bufs:
+                _process_batch(processors, bufs, plan, window, n_processed)
+                n_processed += n_bufs
+            # check for error condition
+            if err is not None:
+                # tell the data processors to abort
+                for proc in processors:
+                    proc.abort(err)
+                failure = True
+                # end processing
+                break
+            if ended:
+                # end marker from the board
+                break
+            if stop is not None and voters and all(proc.converged() for proc in voters):
+                stop.set()
+                _drain_buffers(buf_queue, plan.buffers_per_acquisition - n_processed)
+                break
+        receiving = False
+        # acquisition was successful, do post-processing
+        if not failure:
             for proc in processors:
-                proc.abort(err)
-            failure = True
-            # end processing
-            break
-        # reshape the buffer
-        chan_bufs = [_reshape_buffer(buf, chan, acq_params)
-                     for chan in xrange(acq_params["channel_count"])]
-        for proc in processors:
-            proc.process(chan_bufs, buf_num)
-            # TODO: exception handling for processor failure?
-    # acquisition was successful, do post-processing
-    if not failure:
+                proc.records_processed = n_processed*plan.records_per_buffer
+                proc.post_process()
+    except Exception as err:
+        # a processor raised; report it instead of leaving the caller waiting
         for proc in processors:
-            proc.post_process()
+            proc.abort(err)
+        # the caller may never map the result files, so don't leave them behind
+        shared.remove_owned_files()
+        if receiving:
+            _drain_buffers(buf_queue, plan.buffers_per_acquisition - n_received)
     # send the finished processors back
     comm.put(processors)
     # done with buffer processing
 
 # helper function for processing
-def _reshape_buffer(buf, chan, acq_params):
-    """Reshape a interleaved buffer into n_records x m_samples."""
-    chan_dat = buf[chan::2]
-
-    chan_dat.shape = (acq_params["records_per_buffer"],
-                      acq_params["samples_per_record"])
-
-    # the 12-bit digitizers always write into the MSB; bit shift
-    # the buffer back towards 0
-    bit_depth = acq_params["bit_depth"]
-    if bit_depth > 8:
-        return chan_dat >> (16 - bit_depth)
-    else:
-        return chan_dat
\ No newline at end of file
+def _process_batch(processors, bufs, plan, window, first_buf_num):
+    """Give a batch of consecutive buffers to every processor."""
+    n_bufs = len(bufs)
+    batch = bufs[0] if n_bufs == 1 else np.concatenate(bufs)
+    # channels are reshaped when a processor first reads them
+    chan_bufs = _ChannelBuffers(batch, plan, window, n_bufs)
+    for proc in processors:
+        if n_bufs == 1:
+            proc.process(chan_bufs, first_buf_num)
+        else:
+            proc.process_batch(chan_bufs, first_buf_num, n_bufs)
+
+def _get_batch(buf_queue, max_bufs):
+    """Return up to max_bufs buffers from the queue, any error, and if it ended.
+
+    Only waits for the first buffer; the rest are those already in the queue.
+    Collection stops at an error or an end marker, which hold no buffer; the
+    buffers before it are still returned.
+    """
+    bufs = []
+    while len(bufs) < max_bufs:
+        try:
+            (buf, err) = buf_queue.get_nowait() if bufs else buf_queue.get()
+        except Empty:
+            break
+        if buf is None or err is not None:
+            return (bufs, err, True)
+        bufs.append(buf)
+    return (bufs, None, False)
+
+def _drain_buffers(buf_queue, n_remaining):
+    """Discard buffers already sent until the board acknowledges a stop."""
+    for _ in xrange(n_remaining):
+        (buf, _) = buf_queue.get()
+        if buf is None:
+            # end marker from the board, or it failed after the stop
+            return
+
+def _sample_window(processors):
+    """Return the smallest (start, stop) covering every declared sample range.
+
+    Returns None if no processor declares a range.
+    """
+    windows = [proc.samples_needed() for proc in processors
+               if hasattr(proc, "samples_needed")]
+    windows = [window for window in windows if window is not None]
+    if not windows:
+        return None
+    return (min(start for (start, _) in windows), max(stop for (_, stop) in windows))
+
+class _ChannelBuffers(object):
+    """The channels of one interleaved buffer, extracted on demand.
+
+    Indexing returns the n_records x m_samples array of a channel like the
+    list of channel buffers it replaces, but a channel is only deinterleaved
+    and bit-shifted when a processor first reads it, and then only once.
+    Processors which only need some samples can ask for window(), which only
+    shifts the samples inside the window shared by all processors.  A batch of
+    n_bufs buffers joined end to end holds the records of all of them.
+    """
+    def __init__(self, buf, plan, window=None, n_bufs=1):
+        (recs_per_buf, samples, chans) = plan.buffer_shape
+        if plan.channel_count == 1:
+            # a single channel is not interleaved; use the records as they are
+            self._records = buf.reshape((n_bufs*recs_per_buf, samples))
+        else:
+            self._records = buf.reshape((n_bufs*recs_per_buf, samples, chans))
+        self._shift = plan.shift
+        self._window = window
+        self._chans = [None]*plan.channel_count
+        self._windows = [None]*plan.channel_count
+
+    def __len__(self):
+        return len(self._chans)
+
+    def __getitem__(self, chan):
+        if isinstance(chan, slice):
+            return [self[i] for i in xrange(*chan.indices(len(self)))]
+        if self._chans[chan] is None:
+            self._chans[chan] = self._extract(chan, 0, None)
+        return self._chans[chan]
+
+    def __iter__(self):
+        for chan in xrange(len(self._chans)):
+            yield self[chan]
+
+    def raw(self, chan):
+        """Return the records of a channel before the bit shift, and the shift."""
+        return (self._extract_raw(chan, 0, None), self._shift)
+
+    def split(self, n_bufs):
+        """Return the channel buffers of each of n_bufs equal parts of the records."""
+        recs_per_buf = len(self._records) / n_bufs
+        parts = []
+        for i in xrange(n_bufs):
+            part = copy.copy(self)
+            part._records = self._records[i*recs_per_buf:(i+1)*recs_per_buf]
+            part._chans = [None]*len(self._chans)
+            part._windows = [None]*len(self._windows)
+            parts.append(part)
+        return parts
+
+    def window(self, chan, start, stop):
+        """Return samples start:stop of every record of a channel."""
+        if self._chans[chan] is not None or self._window is None:
+            return self[chan][:,start:stop]
+        (win_start, win_stop) = self._window
+        if start < win_start or stop > win_stop:
+            return self[chan][:,start:stop]
+        if self._windows[chan] is None:
+            self._windows[chan] = self._extract(chan, win_start, win_stop)
+        return self._windows[chan][:,start-win_start:stop-win_start]
+
+    def _extract_raw(self, chan, start, stop):
+        if self._records.ndim == 2:
+            return self._records[:,start:stop]
+        return self._records[:,start:stop,chan]
+
+    def _extract(self, chan, start, stop):
+        chan_dat = self._extract_raw(chan, start, stop)
+        # the 12-bit digitizers always write into the MSB; bit shift
+        # the buffer back towards 0
+        if self._shift:
+            return chan_dat >> self._shift
+        return chan_dat
+
+
+def _acquire_sequence(acquire_buffers, acquisitions):
+    """Run acquisitions back to back and yield their processors in order.
+
+    acquire_buffers is called with each dict of acquisition arguments; it must
+    run the DMA for that acquisition and return the queue on which its worker
+    will put the finished processors.  The result of each acquisition is only
+    collected once the next acquisition has been captured, so post-processing
+    overlaps with the next capture.  If the generator is closed early, the
+    results already acquired are still collected, so their shared result files
+    are removed.
+    """
+    # queues of the acquisitions whose results have not been collected
+    pending = []
+    try:
+        for acquisition in acquisitions:
+            try:
+                pending.append(acquire_buffers(**acquisition))
+            except Exception:
+                # a bare raise after the yield could re-raise an exception the
+                # consumer handled meanwhile, so keep this one with its traceback
+                exc_info = sys.exc_info()
+                # deliver the acquisition that already finished before failing
+                while pending:
+                    yield pending.pop(0).get()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if len(pending) > 1:
+                yield pending.pop(0).get()
+        while pending:
+            yield pending.pop(0).get()
+    finally:
+        for comm in pending:
+            comm.get()
@@ -17,10 +17,23 @@
 This module defines various buffer processors for Alazar acquisitions,
 as well as their companion future object to get their result."""
 
+import os
+import timeit
+
 import numpy as np
 
 from itertools import izip
 
+from alazar import shared
+from alazar.board_common import AcquisitionPlan
+from alazar.preview import MAX_CHANNELS, PreviewSlot, create_slot, slot_filename
+
+# the compiled reductions are optional; NumPy is used if they are not built
+try:
+    from alazar import kernels
+except ImportError:
+    kernels = None
+
 # base class for buffer processors
 class BufferProcessor(object):
     """Example class for alazar buffer processors.
@@ -41,15 +54,58 @@ class BufferProcessor(object):
     abort is called if the acquisition failed; the processor should safely clean
         up if this happens, and store and re-raise the acquisition error if it
         is later queried for its result.
+    reset is called by the user to clear results which a processor accumulates
+        over repeated acquisitions.
+    convergence may return a metric of how uncertain the result still is; if
+        target is set, the acquisition stops early once the metric of every
+        processor with a target is at or below its target.  records_processed
+        is then set to the number of records received before post_process is
+        called, so processors should only use that many records.
+
+    Processors with large results should allocate them with _result_array, so
+    that if shared is set they are returned to the caller through memory-mapped
+    files instead of being copied through the result queue.
     """
-    def __init__(self, name=None):
+    def __init__(self, name=None, shared=False):
+        """Create a new processor.
+
+        Args:
+            name: an optional name for this processor.
+            shared: if True, result arrays are kept in memory-mapped files in
+                shared.default_dir(), and only a handle to them is pickled when
+                the processor is sent back from the worker.  If a directory,
+                the files are kept in that directory.
+        """
         self.name = name
+        self.shared = shared
         self.params = None
+        self.plan = None
         self.error = None
+        self.target = None
+        self.records_processed = 0
 
-    def initialize(self, params):
-        """Called by the board to initialize the acquisition parameters."""
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared:
+            state = shared.pack(state)
+        return state
+
+    def __setstate__(self, state):
+        if state.get("shared"):
+            state = shared.unpack(state)
+        self.__dict__.update(state)
+
+    def initialize(self, params, plan=None):
+        """Called by the board to initialize the acquisition parameters.
+
+        Args:
+            params: the acquisition parameter dictionary from def_acq_params
+            plan: the AcquisitionPlan for params; built from params if omitted
+        """
         self.params = params
+        self.plan = plan if plan is not None else AcquisitionPlan(params)
+        # reduced by the worker if the acquisition stops early
+        self.records_processed = params["records_per_acquisition"]
         # call the initialize_proc method for proc-specific setup
         self.initialize_proc(params)
 
@@ -64,6 +120,18 @@ class BufferProcessor(object):
         """Process a list of channel buffers."""
         pass
 
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Process n_bufs consecutive buffers at once.
+
+        chan_bufs holds the records of every buffer in the batch, in order, as
+        for process.  The default passes each buffer to process in turn;
+        processors override this to handle the whole batch with larger
+        vectorized operations.
+        """
+        for (buf_num, buf_chans) in enumerate(_split_buffers(chan_bufs, n_bufs),
+                                              first_buf_num):
+            self.process(buf_chans, buf_num)
+
     def post_process(self):
         """Do any post-processing."""
         pass
@@ -72,6 +140,40 @@ class BufferProcessor(object):
         """Return the result of the acquisition."""
         self.check_error()
 
+    def reset(self):
+        """Clear any results accumulated over previous acquisitions."""
+        pass
+
+    def samples_needed(self):
+        """Return the (start, stop) range of samples this processor reads.
+
+        None means the whole record.  Processors which declare a range should
+        read it with _window so the worker only extracts those samples.
+        """
+        return None
+
+    def memory_footprint(self, params):
+        """Return the bytes of memory this processor needs for an acquisition.
+
+        Args:
+            params: the acquisition parameter dictionary from def_acq_params
+
+        Results allocated with _result_array should be counted with
+        _result_size, so that results spilled to disk are not counted.
+        """
+        return 0
+
+    def convergence(self):
+        """Return the current uncertainty of the result, or None if unknown."""
+        return None
+
+    def converged(self):
+        """Return True if this processor has a target which has been reached."""
+        if self.target is None or self.error:
+            return False
+        metric = self.convergence()
+        return metric is not None and metric <= self.target
+
     def abort(self, error):
         """If the acquisition failed, clean up."""
         # If this processor already failed, do not overwrite the internal error
@@ -83,30 +185,60 @@ class BufferProcessor(object):
         if self.error:
             raise ProcessorException("Acquisition failed: " + str(self.error))
 
+    def _result_array(self, shape, dtype):
+        """Return a new uninitialized result array, shared if requested."""
+        if not self.shared:
+            return np.empty(shape, dtype)
+        directory = None if self.shared is True else self.shared
+        return shared.shared_empty(shape, dtype, directory)
+
+    def _result_size(self, shape, dtype):
+        """Return the bytes of memory used by a result array from _result_array."""
+        if self.shared:
+            directory = None if self.shared is True else self.shared
+            if not shared.is_ram_backed(directory):
+                return 0
+        return _nbytes(shape, dtype)
+
 class Raw(BufferProcessor):
     """Simple processor to return the raw acquisition data."""
-    def __init__(self, name=None):
-        super(Raw, self).__init__(name)
+    def __init__(self, name=None, shared=False):
+        super(Raw, self).__init__(name, shared)
         self.dat_bufs = None
 
     def initialize_proc(self, params):
         """Initialize the data buffer."""
         # create list of channel buffers to store the data
         # initial shape is 1D for simplicity
-        self.dat_bufs = [np.empty((params["records_per_acquisition"], params["samples_per_record"]),
-                                  params["dtype"],)
+        self.dat_bufs = [self._result_array((params["records_per_acquisition"],
+                                             params["samples_per_record"]),
+                                            params["dtype"],)
                          for _ in xrange(params["channel_count"])]
 
+    def memory_footprint(self, params):
+        """Every record of every channel is kept."""
+        return params["channel_count"]*self._result_size((params["records_per_acquisition"],
+                                                          params["samples_per_record"]),
+                                                         params["dtype"])
+
     def process(self, chan_bufs, buf_num):
         """Dump the buffer into the data buffer."""
-        recs_per_buf = self.params["records_per_buffer"]
+        self.process_batch(chan_bufs, buf_num, 1)
+
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Dump the buffers into the data buffer with one copy per channel."""
+        rec_offset = self.plan.record_offsets[first_buf_num]
+        rec_end = rec_offset + n_bufs*self.plan.records_per_buffer
 
         # copy each channel into the appropriate buffer
         for (chan_buf, dat_buf) in izip(chan_bufs, self.dat_bufs):
-            dat_buf[buf_num*recs_per_buf: (buf_num+1)*recs_per_buf,:] = chan_buf
+            dat_buf[rec_offset:rec_end,:] = chan_buf
 
     def post_process(self):
-        pass
+        """Drop the records which were not acquired, if stopped early."""
+        if self.error:
+            return
+        self.dat_bufs = [dat_buf[:self.records_processed] for dat_buf in self.dat_bufs]
 
     def get_result(self):
         """Return the data.
@@ -117,46 +249,102 @@ class Raw(BufferProcessor):
 
 
 class Average(BufferProcessor):
-    """Simple processor to average all buffers together."""
-    def __init__(self, name=None):
+    """Simple processor to average all buffers together.
+
+    The records are summed into integer accumulators, which are only
+    normalized when the result is read.
+    """
+    def __init__(self, name=None, accumulate=False, target=None):
+        """Create a new Average processor.
+
+        Args:
+            accumulate (bool): If True, the sums carry over from one acquisition
+                to the next when this processor is reused, so the result is the
+                average of all of them.  Call reset() to start over.
+            target (float): If provided, the acquisition may stop once the
+                standard error of every averaged sample is at most this.
+        """
         super(Average, self).__init__(name)
-        self.ave_bufs = None
+        self.accumulate = accumulate
+        self.target = target
+        self.sum_bufs = None
+        self.sumsq_bufs = None
+        self.n_records = 0
 
     def initialize_proc(self, params):
         """Initialize the averaging buffer."""
+        if self.accumulate and self.sum_bufs is not None:
+            if (len(self.sum_bufs) != params["channel_count"] or
+                    self.sum_bufs[0].shape != (params["samples_per_record"],)):
+                self.error = ProcessorException("Cannot accumulate acquisitions with"
+                                                " different channels or record lengths.")
+            return
         # create list of channel buffers to sum the results
-        self.ave_bufs = [np.zeros((params["samples_per_record"],), np.float)
+        self.sum_bufs = [np.zeros((params["samples_per_record"],), np.int64)
                          for _ in xrange(params["channel_count"])]
+        # the sums of squares are only needed to check convergence
+        if self.target is not None:
+            self.sumsq_bufs = [np.zeros((params["samples_per_record"],), np.int64)
+                               for _ in xrange(params["channel_count"])]
+        self.n_records = 0
 
     def process(self, chan_bufs, buf_num):
         """Average the channel records together and add them to the averaging buffer."""
-        if self.error:
-            return
-        for (chan_buf, ave_buf) in izip(chan_bufs, self.ave_bufs):
-            ave_buf += np.sum(chan_buf,axis=0, dtype=np.int64)
+        self.process_batch(chan_bufs, buf_num, 1)
 
-    def post_process(self):
-        """Normalize the averages."""
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Add the records of a batch of buffers to the averaging buffer."""
         if self.error:
             return
-        for ave_buf in self.ave_bufs:
-            ave_buf /= self.params["records_per_acquisition"]
+        for (chan, sum_buf) in enumerate(self.sum_bufs):
+            sumsq_buf = None if self.sumsq_bufs is None else self.sumsq_bufs[chan]
+            raw = _kernel_records(chan_bufs, chan)
+            if raw is not None:
+                kernels.sum_records(raw[0], raw[1], sum_buf, sumsq_buf)
+                continue
+            chan_buf = chan_bufs[chan]
+            sum_buf += np.sum(chan_buf,axis=0, dtype=np.int64)
+            if sumsq_buf is not None:
+                sumsq_buf += np.sum(np.square(chan_buf, dtype=np.int64), axis=0)
+        self.n_records += n_bufs*self.plan.records_per_buffer
+
+    def reset(self):
+        """Clear the accumulated sums and any error."""
+        self.sum_bufs = None
+        self.sumsq_bufs = None
+        self.n_records = 0
+        self.error = None
+
+    def memory_footprint(self, params):
+        """One sum, and one sum of squares if converging, per channel."""
+        n_sums = 1 if self.target is None else 2
+        return n_sums*params["channel_count"]*_nbytes((params["samples_per_record"],),
+                                                      np.int64)
+
+    def convergence(self):
+        """Return the largest standard error of any averaged sample."""
+        if self.sumsq_bufs is None:
+            return None
+        return max(_max_standard_error(sum_buf, sumsq_buf, self.n_records)
+                   for (sum_buf, sumsq_buf) in izip(self.sum_bufs, self.sumsq_bufs))
 
     def get_result(self):
         """Return the averages.
 
         Raises a ProcessorException if an error occurred."""
         self.check_error()
-        return self.ave_bufs
+        return [sum_buf / float(self.n_records) for sum_buf in self.sum_bufs]
 
 class AverageN(BufferProcessor):
     """Processor to average all buffers into N types of records.
 
     This processor expects each consecutive set of N records
         to contain one of each of the N types, in order.
+    The records are summed into integer accumulators, which are only
+    normalized when the result is read.
     """
 
-    def __init__(self, n_rec_types, name=None):
+    def __init__(self, n_rec_types, name=None, accumulate=False, target=None):
         """Create a new AverageN processor.
 
         Args:
@@ -164,13 +352,22 @@ class AverageN(BufferProcessor):
                 be a positive non-zero integer.  The number of records in the
                 acquisition must be a multiple of this or this processor will
                 return an error condition.
+            accumulate (bool): If True, the sums carry over from one acquisition
+                to the next when this processor is reused, so the result is the
+                average of all of them.  Call reset() to start over.
+            target (float): If provided, the acquisition may stop once the
+                standard error of every averaged sample is at most this.
         """
         super(AverageN, self).__init__(name)
         if n_rec_types < 1:
             raise ProcessorException("n_rec_types must be greater than 0."
                                      " Provided: {}".format(n_rec_types))
-        self.ave_bufs = None
         self.n_rec_types = n_rec_types
+        self.accumulate = accumulate
+        self.target = target
+        self.sum_bufs = None
+        self.sumsq_bufs = None
+        self.counts = None
 
     def initialize_proc(self, params):
         """Initialize the averaging buffers."""
@@ -180,35 +377,391 @@ class AverageN(BufferProcessor):
                                             .format(params["records_per_acquisition"],
                                                     self.n_rec_types))
             return
+        if self.accumulate and self.sum_bufs is not None:
+            if (len(self.sum_bufs) != params["channel_count"] or
+                    self.sum_bufs[0].shape[1] != params["samples_per_record"]):
+                self.error = ProcessorException("Cannot accumulate acquisitions with"
+                                                " different channels or record lengths.")
+            return
         # create list of channel buffers to sum the results
-        self.ave_bufs = [np.zeros((self.n_rec_types,params["samples_per_record"],), np.float)
+        self.sum_bufs = [np.zeros((self.n_rec_types,params["samples_per_record"],), np.int64)
                          for _ in xrange(params["channel_count"])]
+        # the sums of squares are only needed to check convergence
+        if self.target is not None:
+            self.sumsq_bufs = [np.zeros((self.n_rec_types,params["samples_per_record"],),
+                                        np.int64)
+                               for _ in xrange(params["channel_count"])]
+        # the number of records of each type collected
+        self.counts = np.zeros((self.n_rec_types,), np.int64)
 
     def process(self, chan_bufs, buf_num):
         """Average the channel records together and add them to the averaging buffers."""
+        self.process_batch(chan_bufs, buf_num, 1)
+
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Add the records of a batch of buffers to the averaging buffers."""
         if self.error:
             return
-        # figure out what the type of the first record in the buffer is
-        first_rec_type = (buf_num*self.params["records_per_buffer"]) % self.n_rec_types
+        # index of the first record of each type present in this batch
+        rec_offsets = self.plan.rec_type_offsets(first_buf_num, self.n_rec_types, n_bufs)
 
-        for (chan_buf, ave_buf) in izip(chan_bufs, self.ave_bufs):
-            for rec_type in xrange(self.n_rec_types):
-                # calculate the offset needed to index the channel buffer into this record type
-                offset = (rec_type + first_rec_type) % self.n_rec_types
-                # if records_per_buffer is less than n_rec_types this record may lack this type
-                if offset < self.params["records_per_buffer"]:
-                    ave_buf[rec_type] += np.sum(chan_buf[offset::self.n_rec_types], axis=0, dtype=np.int64)
+        for (chan, sum_buf) in enumerate(self.sum_bufs):
+            sumsq_buf = None if self.sumsq_bufs is None else self.sumsq_bufs[chan]
+            raw = _kernel_records(chan_bufs, chan)
+            if raw is not None:
+                first_type = self.plan.record_offsets[first_buf_num] % self.n_rec_types
+                kernels.sum_record_types(raw[0], raw[1], first_type, sum_buf, sumsq_buf)
+                continue
+            chan_buf = chan_bufs[chan]
+            for (rec_type, offset) in rec_offsets:
+                sum_buf[rec_type] += np.sum(chan_buf[offset::self.n_rec_types], axis=0, dtype=np.int64)
+            if sumsq_buf is not None:
+                for (rec_type, offset) in rec_offsets:
+                    sumsq_buf[rec_type] += np.sum(np.square(chan_buf[offset::self.n_rec_types],
+                                                            dtype=np.int64), axis=0)
+        n_records = n_bufs*self.plan.records_per_buffer
+        for (rec_type, offset) in rec_offsets:
+            self.counts[rec_type] += (n_records - offset - 1) / self.n_rec_types + 1
 
-    def post_process(self):
-        """Normalize the averages."""
+    def reset(self):
+        """Clear the accumulated sums and any error."""
+        self.sum_bufs = None
+        self.sumsq_bufs = None
+        self.counts = None
+        self.error = None
+
+    def memory_footprint(self, params):
+        """One sum, and one sum of squares if converging, per channel and type."""
+        n_sums = 1 if self.target is None else 2
+        return n_sums*params["channel_count"]*_nbytes((self.n_rec_types,
+                                                       params["samples_per_record"]),
+                                                      np.int64)
+
+    def convergence(self):
+        """Return the largest standard error of any averaged sample."""
+        if self.sumsq_bufs is None:
+            return None
+        counts = self.counts[:,np.newaxis]
+        return max(_max_standard_error(sum_buf, sumsq_buf, counts)
+                   for (sum_buf, sumsq_buf) in izip(self.sum_bufs, self.sumsq_bufs))
+
+    def get_result(self):
+        """Return the averages.
+
+        Returns:
+            List of channel results for the acquisition; each entry is a numpy
+            array of shape (n_rec_types, samples_per_record).
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        counts = self.counts[:,np.newaxis].astype(np.float)
+        return [sum_buf / counts for sum_buf in self.sum_bufs]
+
+class HeraldedAverageN(BufferProcessor):
+    """Processor to average N types of records, keeping only heralded records.
+
+    Each record is accepted if the mean of a window of samples on the herald
+    channel passes a threshold.  The herald is either in the same record or in
+    the record just before it; in the latter case the first record of the
+    acquisition has no herald and is rejected.  Accepted records are averaged
+    into N types like AverageN, and the accepted records of each type are
+    counted so each average is normalized by its own number of records.
+    """
+
+    def __init__(self, n_rec_types, herald_start, herald_stop, threshold, herald_chan=0,
+                 previous_record=False, accept_above=True, name=None):
+        """Create a new HeraldedAverageN processor.
+
+        Args:
+            n_rec_types (int): The number of record types to average into.  Must
+                be a positive non-zero integer.  The number of records in the
+                acquisition must be a multiple of this or this processor will
+                return an error condition.
+            herald_start (int): The first sample of the herald window (inclusive).
+            herald_stop (int): The last sample of the herald window (exclusive).
+            threshold (float): The threshold on the mean of the herald window, in
+                digitizer units.
+            herald_chan (int): The index of the acquired channel with the herald.
+            previous_record (bool): If True, each record is heralded by the
+                record before it instead of itself.
+            accept_above (bool): If True, records are accepted if the herald is
+                above the threshold, otherwise if it is below.
+        """
+        super(HeraldedAverageN, self).__init__(name)
+        if n_rec_types < 1:
+            raise ProcessorException("n_rec_types must be greater than 0."
+                                     " Provided: {}".format(n_rec_types))
+        if herald_start < 0 or herald_start >= herald_stop:
+            raise ProcessorException("Invalid herald start ({}) and stop ({}) parameters."
+                                     .format(herald_start, herald_stop))
+        self.n_rec_types = n_rec_types
+        self.herald_start = herald_start
+        self.herald_stop = herald_stop
+        self.threshold = threshold
+        self.herald_chan = herald_chan
+        self.previous_record = previous_record
+        self.accept_above = accept_above
+        self.sum_bufs = None
+        self.counts = None
+        self.totals = None
+        self._last_passed = False
+
+    def initialize_proc(self, params):
+        """Initialize the averaging buffers and acceptance counts."""
+        if params["records_per_acquisition"] % self.n_rec_types != 0:
+            self.error = ProcessorException("Records per acquisition ({}) must be a"
+                                            " multiple of n_rec_types ({})"
+                                            .format(params["records_per_acquisition"],
+                                                    self.n_rec_types))
+            return
+        if self.herald_stop > params["samples_per_record"]:
+            self.error = ProcessorException("Herald stop ({}) is greater than "
+                                            "samples per record ({})"
+                                            .format(self.herald_stop,
+                                                    params["samples_per_record"]))
+            return
+        if self.herald_chan >= params["channel_count"]:
+            self.error = ProcessorException("Herald channel ({}) is not acquired; acquiring"
+                                            " {} channels".format(self.herald_chan,
+                                                                  params["channel_count"]))
+            return
+        self.sum_bufs = [np.zeros((self.n_rec_types,params["samples_per_record"],), np.int64)
+                         for _ in xrange(params["channel_count"])]
+        # the number of records of each type accepted and seen
+        self.counts = np.zeros((self.n_rec_types,), np.int64)
+        self.totals = np.zeros((self.n_rec_types,), np.int64)
+        self._last_passed = False
+
+    def process(self, chan_bufs, buf_num):
+        """Add the accepted records to the averaging buffers."""
+        self.process_batch(chan_bufs, buf_num, 1)
+
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Add the accepted records of a batch of buffers to the averaging buffers."""
         if self.error:
             return
-        # normalize by the total number of each record type collected
-        for ave_buf in self.ave_bufs:
-            ave_buf /= (self.params["records_per_acquisition"] / self.n_rec_types)
+        herald = np.mean(_window(chan_bufs, self.herald_chan, self.herald_start,
+                                 self.herald_stop), axis=1)
+        if self.accept_above:
+            passed = herald > self.threshold
+        else:
+            passed = herald < self.threshold
+        if self.previous_record:
+            # the herald of the first record is the last one of the previous batch
+            accepted = np.empty_like(passed)
+            accepted[0] = self._last_passed
+            accepted[1:] = passed[:-1]
+            self._last_passed = passed[-1]
+        else:
+            accepted = passed
+
+        rec_offsets = self.plan.rec_type_offsets(first_buf_num, self.n_rec_types, n_bufs)
+        for (chan, sum_buf) in enumerate(self.sum_bufs):
+            chan_buf = chan_bufs[chan]
+            for (rec_type, offset) in rec_offsets:
+                mask = accepted[offset::self.n_rec_types]
+                sum_buf[rec_type] += np.sum(chan_buf[offset::self.n_rec_types][mask], axis=0,
+                                            dtype=np.int64)
+        for (rec_type, offset) in rec_offsets:
+            mask = accepted[offset::self.n_rec_types]
+            self.counts[rec_type] += np.count_nonzero(mask)
+            self.totals[rec_type] += len(mask)
+
+    def memory_footprint(self, params):
+        """One sum per channel and type."""
+        return params["channel_count"]*_nbytes((self.n_rec_types,
+                                                params["samples_per_record"]),
+                                               np.int64)
+
+    def get_acceptance(self):
+        """Return the fraction of records of each type which were accepted.
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        return self.counts / self.totals.astype(np.float)
 
     def get_result(self):
-        """Return the averages.
+        """Return the averages of the accepted records.
+
+        Returns:
+            List of channel results for the acquisition; each entry is a numpy
+            array of shape (n_rec_types, samples_per_record).  Record types with
+            no accepted records are NaN.
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        counts = self.counts[:,np.newaxis].astype(np.float)
+        counts[counts == 0] = np.nan
+        return [sum_buf / counts for sum_buf in self.sum_bufs]
+
+class AlignedAverageN(BufferProcessor):
+    """Processor to average N types of records after removing trigger jitter.
+
+    The offset of each record is the lag of the peak of its cross-correlation
+    with a template record, which is computed for a whole buffer at once with
+    FFTs.  Every channel of a record is shifted back by the offset of the
+    alignment channel before it is averaged.  Samples shifted past one end of
+    the record wrap around to the other end, so only the part of the record
+    at least max_shift samples from either end is aligned exactly.  The
+    offsets found are counted in a histogram.
+    """
+
+    def __init__(self, n_rec_types, template=None, max_shift=16, subsample=False,
+                 align_chan=0, name=None):
+        """Create a new AlignedAverageN processor.
+
+        Args:
+            n_rec_types (int): The number of record types to average into.  Must
+                be a positive non-zero integer.  The number of records in the
+                acquisition must be a multiple of this or this processor will
+                return an error condition.
+            template: The reference record of the alignment channel, of length
+                samples_per_record, in digitizer units.  If None, the average
+                of the first buffer is used.
+            max_shift (int): The largest offset searched, in samples; must be
+                less than half the record length.
+            subsample (bool): If True, offsets are refined between samples by
+                fitting a parabola to the peak of the cross-correlation, and
+                records are shifted by fractions of a sample in the frequency
+                domain.
+            align_chan (int): The index of the acquired channel to align on.
+        """
+        super(AlignedAverageN, self).__init__(name)
+        if n_rec_types < 1:
+            raise ProcessorException("n_rec_types must be greater than 0."
+                                     " Provided: {}".format(n_rec_types))
+        if max_shift < 0:
+            raise ProcessorException("max_shift must not be negative. Provided: {}"
+                                     .format(max_shift))
+        self.n_rec_types = n_rec_types
+        self.template = None if template is None else np.asarray(template, np.float)
+        self.max_shift = max_shift
+        self.subsample = subsample
+        self.align_chan = align_chan
+        self.sum_bufs = None
+        self.counts = None
+        self.offset_counts = None
+
+    def initialize_proc(self, params):
+        """Initialize the averaging buffers, the template and the offset histogram."""
+        spr = params["samples_per_record"]
+        if params["records_per_acquisition"] % self.n_rec_types != 0:
+            self.error = ProcessorException("Records per acquisition ({}) must be a"
+                                            " multiple of n_rec_types ({})"
+                                            .format(params["records_per_acquisition"],
+                                                    self.n_rec_types))
+            return
+        if 2*self.max_shift >= spr:
+            self.error = ProcessorException("max_shift ({}) must be less than half the"
+                                            " samples per record ({})"
+                                            .format(self.max_shift, spr))
+            return
+        if self.align_chan >= params["channel_count"]:
+            self.error = ProcessorException("Alignment channel ({}) is not acquired;"
+                                            " acquiring {} channels"
+                                            .format(self.align_chan,
+                                                    params["channel_count"]))
+            return
+        if self.template is not None and self.template.shape != (spr,):
+            self.error = ProcessorException("The template has {} samples; expected {}"
+                                            .format(len(self.template), spr))
+            return
+        self.sum_bufs = [np.zeros((self.n_rec_types, spr), np.float)
+                         for _ in xrange(params["channel_count"])]
+        self.counts = np.zeros((self.n_rec_types,), np.int64)
+        self.offset_counts = np.zeros((2*self.max_shift + 1,), np.int64)
+        # zero padding to twice the record length keeps the correlation linear
+        self._n_fft = 2*spr
+        self._lags = np.arange(-self.max_shift, self.max_shift + 1)
+        self._template_fft = None
+        if self.template is not None:
+            self._set_template(self.template)
+
+    def process(self, chan_bufs, buf_num):
+        """Align the records and add them to the averaging buffers."""
+        self.process_batch(chan_bufs, buf_num, 1)
+
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Align the records of a batch of buffers and add them to the averaging buffers."""
+        if self.error:
+            return
+        recs = np.asarray(chan_bufs[self.align_chan], np.float)
+        if self._template_fft is None:
+            self._set_template(np.mean(recs[:self.plan.records_per_buffer], axis=0))
+        offsets = self._find_offsets(recs)
+        shifts = np.round(offsets).astype(np.int64)
+        self.offset_counts += np.bincount(shifts + self.max_shift,
+                                          minlength=len(self.offset_counts))
+
+        rec_offsets = self.plan.rec_type_offsets(first_buf_num, self.n_rec_types, n_bufs)
+        for (chan, sum_buf) in enumerate(self.sum_bufs):
+            aligned = self._shift(chan_bufs[chan], offsets, shifts)
+            for (rec_type, offset) in rec_offsets:
+                sum_buf[rec_type] += np.sum(aligned[offset::self.n_rec_types], axis=0)
+        n_records = n_bufs*self.plan.records_per_buffer
+        for (rec_type, offset) in rec_offsets:
+            self.counts[rec_type] += (n_records - offset - 1) / self.n_rec_types + 1
+
+    def _set_template(self, template):
+        self._template_fft = np.conj(np.fft.rfft(template - np.mean(template), self._n_fft))
+
+    def _find_offsets(self, recs):
+        """Return the offset of each record from the template, in samples."""
+        recs = recs - np.mean(recs, axis=1)[:,np.newaxis]
+        xcorr = np.fft.irfft(np.fft.rfft(recs, self._n_fft, axis=1)*self._template_fft,
+                             self._n_fft, axis=1)
+        # negative lags are at the end of the correlation
+        peaks = xcorr[:,self._lags % self._n_fft]
+        best = np.argmax(peaks, axis=1)
+        offsets = self._lags[best].astype(np.float)
+        if self.subsample:
+            # vertex of the parabola through the peak and its neighbours
+            rows = np.nonzero((best > 0) & (best < len(self._lags) - 1))[0]
+            (before, peak, after) = (peaks[rows, best[rows] - 1], peaks[rows, best[rows]],
+                                     peaks[rows, best[rows] + 1])
+            curvature = before - 2*peak + after
+            curved = curvature < 0
+            offsets[rows[curved]] += (0.5*(before - after)[curved] / curvature[curved])
+        return offsets
+
+    def _shift(self, chan_buf, offsets, shifts):
+        """Return the records of a channel shifted back by their offsets."""
+        spr = chan_buf.shape[1]
+        if self.subsample:
+            freqs = np.fft.rfftfreq(spr)
+            phases = np.exp(2j*np.pi*freqs[np.newaxis,:]*offsets[:,np.newaxis])
+            return np.fft.irfft(np.fft.rfft(chan_buf, axis=1)*phases, spr, axis=1)
+        samples = (np.arange(spr)[np.newaxis,:] + shifts[:,np.newaxis]) % spr
+        return chan_buf[np.arange(len(chan_buf))[:,np.newaxis], samples]
+
+    def memory_footprint(self, params):
+        """One sum per channel and type."""
+        return params["channel_count"]*_nbytes((self.n_rec_types,
+                                                params["samples_per_record"]),
+                                               np.float)
+
+    def get_offset_histogram(self):
+        """Return the histogram of record offsets.
+
+        Returns:
+            (lags, counts): the offsets in samples from -max_shift to
+            max_shift, and the number of records found at each, rounded to
+            the nearest sample.
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        return (self._lags.copy(), self.offset_counts.copy())
+
+    def get_result(self):
+        """Return the aligned averages.
 
         Returns:
             List of channel results for the acquisition; each entry is a numpy
@@ -218,11 +771,12 @@ class AverageN(BufferProcessor):
             ProcessorException if an error occurred.
         """
         self.check_error()
-        return self.ave_bufs
+        counts = self.counts[:,np.newaxis].astype(np.float)
+        return [sum_buf / counts for sum_buf in self.sum_bufs]
 
 class Chunk(BufferProcessor):
     """Processor to collect a chunk of N record types."""
-    def __init__(self, n_rec_types, start, stop, name=None):
+    def __init__(self, n_rec_types, start, stop, name=None, shared=False):
         """Create a new Chunk processor.
 
         A Chunk is defined as the record-by-record average over a specified
@@ -236,8 +790,9 @@ class Chunk(BufferProcessor):
 
             start (int): The sample number at the start of the chunk (inclusive).
             stop (int): The sample number at the end of the chunk (exclusive).
+            shared: see BufferProcessor.
         """
-        super(Chunk, self).__init__(name)
+        super(Chunk, self).__init__(name, shared)
         if n_rec_types < 1:
             raise ProcessorException("n_rec_types must be greater than 0."
                                      " Provided: {}".format(n_rec_types))
@@ -261,28 +816,48 @@ class Chunk(BufferProcessor):
                                             "samples per record ({})"
                                             .format(self.stop,
                                                     params["samples_per_record"]))
-        self.chunk_bufs = [np.empty((params["records_per_acquisition"],), dtype=np.float)
+        self.chunk_bufs = [self._result_array((params["records_per_acquisition"],), np.float)
                            for _ in xrange(params["channel_count"])]
 
     def process(self, chan_bufs, buf_num):
         """Collect all of the chunks."""
+        self.process_batch(chan_bufs, buf_num, 1)
+
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Collect the chunks of a batch of buffers."""
         if self.error:
             return
-        recs_per_buf = self.params["records_per_buffer"]
-        rec_offset = buf_num*recs_per_buf
-        for (chan_buf, chunk_buf) in izip(chan_bufs, self.chunk_bufs):
-                chunk_buf_view = chunk_buf[rec_offset:rec_offset+recs_per_buf]
+        n_records = n_bufs*self.plan.records_per_buffer
+        rec_offset = self.plan.record_offsets[first_buf_num]
+        for (chan, chunk_buf) in enumerate(self.chunk_bufs):
+                chunk_buf_view = chunk_buf[rec_offset:rec_offset+n_records]
                 # integrate this chunk and put result into the data array
-                chunk_buf_view[:] = np.mean(chan_buf[:,self.start:self.stop], axis=1)
+                raw = _kernel_records(chan_bufs, chan)
+                if raw is not None:
+                    kernels.chunk_means(raw[0], raw[1], self.start, self.stop, chunk_buf_view)
+                    continue
+                chunk_buf_view[:] = np.mean(_window(chan_bufs, chan, self.start, self.stop),
+                                            axis=1)
+
+    def samples_needed(self):
+        """Only the chunk is read."""
+        return (self.start, self.stop)
+
+    def memory_footprint(self, params):
+        """One value per record and channel."""
+        return params["channel_count"]*self._result_size((params["records_per_acquisition"],),
+                                                         np.float)
 
     def post_process(self):
         """Reshape the data into record types."""
         if self.error:
             return
+        # keep only whole sets of record types if the acquisition stopped early
+        n_sets = self.records_processed / self.n_rec_types
         # reshape the linear buffer into (rec type, records) in place
         for chan, chunk_buf in enumerate(self.chunk_bufs):
-            chunk_buf.shape = (self.params["records_per_acquisition"] / self.n_rec_types,
-                               self.n_rec_types)
+            chunk_buf = chunk_buf[:n_sets*self.n_rec_types]
+            chunk_buf.shape = (n_sets, self.n_rec_types)
             self.chunk_bufs[chan] = np.swapaxes(chunk_buf,0,1)
 
     def get_result(self):
@@ -298,6 +873,760 @@ class Chunk(BufferProcessor):
         self.check_error()
         return self.chunk_bufs
 
+class Decimate(BufferProcessor):
+    """Processor to low-pass filter and downsample every record."""
+    def __init__(self, factor, taps=None, n_rec_types=None, continuous=False, name=None,
+                 shared=False):
+        """Create a new Decimate processor.
+
+        Each output sample j is the FIR filter output at input sample
+        factor*(j+1) - 1, so the default boxcar filter returns the mean of
+        each consecutive block of factor samples.
+
+        Args:
+            factor (int): The integer downsampling factor.  Must be a positive
+                non-zero integer, and samples per record must be a multiple of
+                this or this processor will return an error.
+            taps: The FIR filter coefficients; defaults to a boxcar of length
+                factor.
+            n_rec_types (int): If provided, the decimated records are averaged
+                into this many record types as with AverageN.  Otherwise, every
+                decimated record is returned as with Raw.
+            continuous (bool): If True, consecutive records are treated as one
+                contiguous stream and the filter state is carried from each
+                record into the next, including across buffers.  Otherwise each
+                record is filtered on its own, starting from zero state.
+            shared: see BufferProcessor.
+        """
+        super(Decimate, self).__init__(name, shared)
+        if factor < 1:
+            raise ProcessorException("factor must be greater than 0."
+                                     " Provided: {}".format(factor))
+        if n_rec_types is not None and n_rec_types < 1:
+            raise ProcessorException("n_rec_types must be greater than 0."
+                                     " Provided: {}".format(n_rec_types))
+        if taps is None:
+            taps = np.ones(factor) / factor
+        taps = np.array(taps, dtype=np.float)
+        if taps.ndim != 1 or len(taps) == 0:
+            raise ProcessorException("taps must be a non-empty 1D sequence.")
+        self.factor = factor
+        self.taps = taps
+        self.n_rec_types = n_rec_types
+        self.continuous = continuous
+        self.dat_bufs = None
+
+    def initialize_proc(self, params):
+        """Initialize the filter state and output buffers."""
+        spr = params["samples_per_record"]
+        if spr % self.factor != 0:
+            self.error = ProcessorException("Samples per record ({}) must be a"
+                                            " multiple of the decimation factor ({})"
+                                            .format(spr, self.factor))
+            return
+        if (self.n_rec_types is not None and
+                params["records_per_acquisition"] % self.n_rec_types != 0):
+            self.error = ProcessorException("Records per acquisition ({}) must be a"
+                                            " multiple of n_rec_types ({})"
+                                            .format(params["records_per_acquisition"],
+                                                    self.n_rec_types))
+            return
+        recs_per_buf = params["records_per_buffer"]
+        n_out = spr / self.factor
+        # in continuous mode the whole buffer is filtered as a single row
+        if self.continuous:
+            (n_rows, row_len) = (1, recs_per_buf*spr)
+        else:
+            (n_rows, row_len) = (recs_per_buf, spr)
+        n_state = len(self.taps) - 1
+        # the filter input is the state followed by the new samples; the state
+        # stays zero unless it is carried over in continuous mode
+        self._inputs = [np.zeros((n_rows, n_state + row_len), np.float)
+                        for _ in xrange(params["channel_count"])]
+        self._outputs = [np.empty((n_rows, row_len / self.factor), np.float)
+                         for _ in xrange(params["channel_count"])]
+        self._scratch = np.empty((n_rows, row_len / self.factor), np.float)
+
+        if self.n_rec_types is None:
+            self.dat_bufs = [self._result_array((params["records_per_acquisition"], n_out),
+                                                np.float)
+                             for _ in xrange(params["channel_count"])]
+        else:
+            self.dat_bufs = [np.zeros((self.n_rec_types, n_out), np.float)
+                             for _ in xrange(params["channel_count"])]
+
+    def memory_footprint(self, params):
+        """The filter state and the decimated records or their averages."""
+        (recs_per_buf, spr) = (params["records_per_buffer"], params["samples_per_record"])
+        if self.continuous:
+            (n_rows, row_len) = (1, recs_per_buf*spr)
+        else:
+            (n_rows, row_len) = (recs_per_buf, spr)
+        n_state = len(self.taps) - 1
+        n_out = spr / self.factor
+        filter_state = (params["channel_count"]*(_nbytes((n_rows, n_state + row_len), np.float) +
+                                                 _nbytes((n_rows, row_len / self.factor),
+                                                         np.float)) +
+                        _nbytes((n_rows, row_len / self.factor), np.float))
+        if self.n_rec_types is None:
+            results = self._result_size((params["records_per_acquisition"], n_out), np.float)
+        else:
+            results = _nbytes((self.n_rec_types, n_out), np.float)
+        return filter_state + params["channel_count"]*results
+
+    def process(self, chan_bufs, buf_num):
+        """Filter and downsample the records, then store or average them."""
+        if self.error:
+            return
+        recs_per_buf = self.plan.records_per_buffer
+        rec_offset = self.plan.record_offsets[buf_num]
+        n_state = len(self.taps) - 1
+        for (chan_buf, filt_in, filt_out, dat_buf) in izip(chan_bufs, self._inputs,
+                                                            self._outputs, self.dat_bufs):
+            filt_in[:,n_state:] = chan_buf.reshape(filt_in.shape[0], -1)
+            n_out = filt_out.shape[1]
+            filt_out[:] = 0.0
+            # accumulate one tap at a time over the whole buffer
+            for (tap_num, tap) in enumerate(self.taps):
+                start = n_state + self.factor - 1 - tap_num
+                np.multiply(filt_in[:,start:start + n_out*self.factor:self.factor], tap,
+                            out=self._scratch)
+                filt_out += self._scratch
+            if self.continuous and n_state > 0:
+                # carry the end of this buffer over into the next one
+                filt_in[:,:n_state] = filt_in[:,-n_state:]
+
+            dec_recs = filt_out.reshape(recs_per_buf, -1)
+            if self.n_rec_types is None:
+                dat_buf[rec_offset:rec_offset+recs_per_buf] = dec_recs
+            else:
+                for (rec_type, offset) in self.plan.rec_type_offsets(buf_num,
+                                                                     self.n_rec_types):
+                    dat_buf[rec_type] += np.sum(dec_recs[offset::self.n_rec_types], axis=0)
+
+    def post_process(self):
+        """Normalize the averages, if averaging."""
+        if self.error:
+            return
+        # the filter scratch space is not needed anymore
+        self._inputs = self._outputs = self._scratch = None
+        if self.n_rec_types is None:
+            self.dat_bufs = [dat_buf[:self.records_processed] for dat_buf in self.dat_bufs]
+        else:
+            counts = self.plan.rec_type_counts(self.records_processed, self.n_rec_types)
+            for dat_buf in self.dat_bufs:
+                dat_buf /= counts[:,np.newaxis]
+
+    def get_result(self):
+        """Return the decimated records.
+
+        Returns:
+            List of channel results for the acquisition; each entry is a numpy
+            array of shape (records_per_acquisition, samples_per_record/factor),
+            or (n_rec_types, samples_per_record/factor) if averaging.
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        return self.dat_bufs
+
+class PowerSpectrum(BufferProcessor):
+    """Processor to average the power spectra of N types of records."""
+
+    windows = {"boxcar": np.ones,
+               "hann": np.hanning,
+               "hamming": np.hamming,
+               "blackman": np.blackman,}
+
+    def __init__(self, n_rec_types=1, window="hann", cross_spectrum=False, name=None):
+        """Create a new PowerSpectrum processor.
+
+        The power spectrum of each record is |X|**2 / sum(window**2), where X
+        is the real FFT of the windowed record.
+
+        Args:
+            n_rec_types (int): The number of record types to average into.  Must
+                be a positive non-zero integer.  The number of records in the
+                acquisition must be a multiple of this or this processor will
+                return an error condition.
+            window: The name of a window in PowerSpectrum.windows, or an array of
+                samples_per_record window values.
+            cross_spectrum (bool): If True, also average the cross spectrum
+                X_A * conj(X_B) of the two channels.
+        """
+        super(PowerSpectrum, self).__init__(name)
+        if n_rec_types < 1:
+            raise ProcessorException("n_rec_types must be greater than 0."
+                                     " Provided: {}".format(n_rec_types))
+        if isinstance(window, basestring) and window not in self.windows:
+            raise ProcessorException("Unknown window '{}'; valid windows are {}"
+                                     .format(window, sorted(self.windows.keys())))
+        self.n_rec_types = n_rec_types
+        self.window = window
+        self.cross_spectrum = cross_spectrum
+        self.spec_bufs = None
+        self.cross_buf = None
+        self._cross_sum = None
+
+    def initialize_proc(self, params):
+        """Precompute the window and initialize the spectrum buffers."""
+        spr = params["samples_per_record"]
+        if params["records_per_acquisition"] % self.n_rec_types != 0:
+            self.error = ProcessorException("Records per acquisition ({}) must be a"
+                                            " multiple of n_rec_types ({})"
+                                            .format(params["records_per_acquisition"],
+                                                    self.n_rec_types))
+            return
+        if self.cross_spectrum and params["channel_count"] != 2:
+            self.error = ProcessorException("The cross spectrum requires two channels;"
+                                            " acquiring {}".format(params["channel_count"]))
+            return
+        if isinstance(self.window, basestring):
+            self._window_vals = self.windows[self.window](spr).astype(np.float)
+        else:
+            self._window_vals = np.array(self.window, dtype=np.float)
+            if self._window_vals.shape != (spr,):
+                self.error = ProcessorException("Window length ({}) must equal samples"
+                                                " per record ({})"
+                                                .format(len(self._window_vals), spr))
+                return
+        self._norm = 1.0 / np.sum(self._window_vals**2)
+
+        n_freqs = spr / 2 + 1
+        # scratch space reused for every buffer
+        self._windowed = np.empty((params["channel_count"], params["records_per_buffer"], spr),
+                                  np.float)
+        self._power = np.empty((params["records_per_buffer"], n_freqs), np.float)
+        self._type_sum = np.empty((n_freqs,), np.float)
+        self.spec_bufs = [np.zeros((self.n_rec_types, n_freqs), np.float)
+                          for _ in xrange(params["channel_count"])]
+        if self.cross_spectrum:
+            self._cross_sum = np.empty((n_freqs,), np.complex)
+            self.cross_buf = np.zeros((self.n_rec_types, n_freqs), np.complex)
+
+    def memory_footprint(self, params):
+        """The per-buffer scratch space and spectra, and the spectrum sums."""
+        (recs_per_buf, spr) = (params["records_per_buffer"], params["samples_per_record"])
+        chans = params["channel_count"]
+        n_freqs = spr / 2 + 1
+        total = (_nbytes((chans, recs_per_buf, spr), np.float) +
+                 _nbytes((chans, recs_per_buf, n_freqs), np.complex) +
+                 _nbytes((recs_per_buf, n_freqs), np.float) +
+                 chans*_nbytes((self.n_rec_types, n_freqs), np.float))
+        if self.cross_spectrum:
+            total += _nbytes((self.n_rec_types, n_freqs), np.complex)
+        return total
+
+    def process(self, chan_bufs, buf_num):
+        """Add the power spectra of the records to the spectrum buffers."""
+        if self.error:
+            return
+        rec_offsets = self.plan.rec_type_offsets(buf_num, self.n_rec_types)
+        for (chan, chan_buf) in enumerate(chan_bufs):
+            np.multiply(chan_buf, self._window_vals, out=self._windowed[chan])
+        # NumPy's FFT can't write into an existing array, so transform every
+        # channel in one call; everything else reuses the scratch space
+        specs = np.fft.rfft(self._windowed, axis=2)
+        for (spec, spec_buf) in izip(specs, self.spec_bufs):
+            np.absolute(spec, out=self._power)
+            np.square(self._power, out=self._power)
+            for (rec_type, offset) in rec_offsets:
+                spec_buf[rec_type] += np.sum(self._power[offset::self.n_rec_types], axis=0,
+                                             out=self._type_sum)
+
+        if self.cross_spectrum:
+            # the cross spectrum overwrites the spectrum of channel B
+            cross = np.conjugate(specs[1], out=specs[1])
+            np.multiply(specs[0], cross, out=cross)
+            for (rec_type, offset) in rec_offsets:
+                self.cross_buf[rec_type] += np.sum(cross[offset::self.n_rec_types], axis=0,
+                                                   out=self._cross_sum)
+
+    def post_process(self):
+        """Normalize the spectra."""
+        if self.error:
+            return
+        counts = self.plan.rec_type_counts(self.records_processed, self.n_rec_types)
+        scale = self._norm / counts[:,np.newaxis].astype(np.float)
+        for spec_buf in self.spec_bufs:
+            spec_buf *= scale
+        if self.cross_spectrum:
+            self.cross_buf *= scale
+        self._windowed = self._power = self._type_sum = self._cross_sum = None
+
+    def get_frequencies(self, sample_rate=1.0):
+        """Return the frequency of each spectrum bin.
+
+        Args:
+            sample_rate (float): The sample rate of the acquisition; the
+                frequencies are returned in the same units.
+        """
+        return np.fft.rfftfreq(self.params["samples_per_record"], 1.0/sample_rate)
+
+    def get_result(self):
+        """Return the averaged power spectra.
+
+        Returns:
+            List of channel results for the acquisition; each entry is a numpy
+            array of shape (n_rec_types, samples_per_record/2 + 1).
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        return self.spec_bufs
+
+    def get_cross_spectrum(self):
+        """Return the averaged cross spectrum of channels A and B.
+
+        Returns:
+            A complex numpy array of shape (n_rec_types, samples_per_record/2 + 1).
+
+        Raises:
+            ProcessorException if an error occurred or the cross spectrum was
+                not requested.
+        """
+        self.check_error()
+        if not self.cross_spectrum:
+            raise ProcessorException("This processor was not asked for the cross spectrum.")
+        return self.cross_buf
+
+class Correlation(BufferProcessor):
+    """Processor to find the means and covariance of channels A and B.
+
+    The first and second moments are accumulated per sample and per record
+    type, so memory use does not depend on the number of records.
+    """
+    def __init__(self, n_rec_types=1, name=None):
+        """Create a new Correlation processor.
+
+        Args:
+            n_rec_types (int): The number of record types.  Must be a positive
+                non-zero integer.  The number of records in the acquisition must
+                be a multiple of this, with at least two records of each type,
+                or this processor will return an error.
+        """
+        super(Correlation, self).__init__(name)
+        if n_rec_types < 1:
+            raise ProcessorException("n_rec_types must be greater than 0."
+                                     " Provided: {}".format(n_rec_types))
+        self.n_rec_types = n_rec_types
+        self.result = None
+
+    def initialize_proc(self, params):
+        """Initialize the moment accumulators."""
+        if params["channel_count"] != 2:
+            self.error = ProcessorException("Correlation requires two channels;"
+                                            " acquiring {}".format(params["channel_count"]))
+            return
+        if params["records_per_acquisition"] % self.n_rec_types != 0:
+            self.error = ProcessorException("Records per acquisition ({}) must be a"
+                                            " multiple of n_rec_types ({})"
+                                            .format(params["records_per_acquisition"],
+                                                    self.n_rec_types))
+            return
+        if params["records_per_acquisition"] / self.n_rec_types < 2:
+            self.error = ProcessorException("Correlation requires at least two records"
+                                            " of each record type.")
+            return
+        # centering the samples on mid-scale keeps the integer sums small,
+        # which avoids cancellation when the moments are combined
+        self._offset = 2**(params["bit_depth"] - 1)
+        shape = (params["records_per_buffer"], params["samples_per_record"])
+        self._centered = [np.empty(shape, np.int64), np.empty(shape, np.int64)]
+        self._prod = np.empty(shape, np.int64)
+        acc_shape = (self.n_rec_types, params["samples_per_record"])
+        # sums of A, B, A*A, B*B and A*B
+        self._sums = [np.zeros(acc_shape, np.int64) for _ in xrange(5)]
+        self.result = None
+
+    def memory_footprint(self, params):
+        """The per-buffer scratch space and the five moment sums."""
+        return (3*_nbytes((params["records_per_buffer"], params["samples_per_record"]),
+                          np.int64) +
+                5*_nbytes((self.n_rec_types, params["samples_per_record"]), np.int64))
+
+    def process(self, chan_bufs, buf_num):
+        """Add the buffer to the moment accumulators."""
+        if self.error:
+            return
+        (a, b) = self._centered
+        np.subtract(chan_bufs[0], self._offset, out=a, dtype=np.int64)
+        np.subtract(chan_bufs[1], self._offset, out=b, dtype=np.int64)
+        rec_offsets = self.plan.rec_type_offsets(buf_num, self.n_rec_types)
+        for (moment, (x, y)) in enumerate([(a, None), (b, None), (a, a), (b, b), (a, b)]):
+            if y is None:
+                prod = x
+            else:
+                prod = np.multiply(x, y, out=self._prod)
+            for (rec_type, offset) in rec_offsets:
+                self._sums[moment][rec_type] += np.sum(prod[offset::self.n_rec_types], axis=0)
+
+    def post_process(self):
+        """Compute the means and covariances from the moments."""
+        if self.error:
+            return
+        n = self.plan.rec_type_counts(self.records_processed,
+                                      self.n_rec_types)[:,np.newaxis].astype(np.float)
+        (sum_a, sum_b, sum_aa, sum_bb, sum_ab) = [s.astype(np.float) for s in self._sums]
+        # moments of the centered data
+        (mean_a, mean_b) = (sum_a / n, sum_b / n)
+        cov = np.empty(sum_a.shape + (2, 2), np.float)
+        cov[...,0,0] = (sum_aa - sum_a*mean_a) / (n - 1)
+        cov[...,1,1] = (sum_bb - sum_b*mean_b) / (n - 1)
+        cov[...,0,1] = cov[...,1,0] = (sum_ab - sum_a*mean_b) / (n - 1)
+
+        self.result = dict(mean=[mean_a + self._offset, mean_b + self._offset],
+                           correlation=(sum_ab / n + self._offset*(mean_a + mean_b)
+                                        + self._offset**2),
+                           covariance=cov)
+        self._centered = self._prod = None
+
+    def get_result(self):
+        """Return the channel means, correlation and covariance.
+
+        Returns:
+            Dictionary with the entries
+                mean: list of the means of channels A and B, each a numpy array
+                    of shape (n_rec_types, samples_per_record)
+                correlation: <A*B>, of shape (n_rec_types, samples_per_record)
+                covariance: the sample covariance matrices of (A, B), of shape
+                    (n_rec_types, samples_per_record, 2, 2)
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        return self.result
+
+class Statistics(BufferProcessor):
+    """Processor to find per-sample statistics of N types of records.
+
+    The count, mean and sum of squared deviations (M2) of every sample are
+    updated one buffer at a time using the parallel algorithm of Chan et al.,
+    along with the minimum and maximum.  The state of two Statistics processors
+    which saw different data can be combined with merge().
+    """
+    def __init__(self, n_rec_types=1, name=None, target=None):
+        """Create a new Statistics processor.
+
+        Args:
+            n_rec_types (int): The number of record types.  Must be a positive
+                non-zero integer.  The number of records in the acquisition must
+                be a multiple of this or this processor will return an error.
+            target (float): If provided, the acquisition may stop once the
+                standard error of every sample mean is at most this.
+        """
+        super(Statistics, self).__init__(name)
+        if n_rec_types < 1:
+            raise ProcessorException("n_rec_types must be greater than 0."
+                                     " Provided: {}".format(n_rec_types))
+        self.n_rec_types = n_rec_types
+        self.target = target
+        self.counts = None
+        self.means = None
+        self.m2s = None
+        self.mins = None
+        self.maxs = None
+
+    def initialize_proc(self, params):
+        """Initialize the moment accumulators."""
+        if params["records_per_acquisition"] % self.n_rec_types != 0:
+            self.error = ProcessorException("Records per acquisition ({}) must be a"
+                                            " multiple of n_rec_types ({})"
+                                            .format(params["records_per_acquisition"],
+                                                    self.n_rec_types))
+            return
+        shape = (self.n_rec_types, params["samples_per_record"])
+        chans = xrange(params["channel_count"])
+        self.counts = np.zeros((self.n_rec_types,), np.int64)
+        self.means = [np.zeros(shape, np.float) for _ in chans]
+        self.m2s = [np.zeros(shape, np.float) for _ in chans]
+        self.mins = [np.full(shape, np.inf) for _ in chans]
+        self.maxs = [np.full(shape, -np.inf) for _ in chans]
+
+    def memory_footprint(self, params):
+        """The mean, M2, minimum and maximum per channel and type."""
+        return 4*params["channel_count"]*_nbytes((self.n_rec_types,
+                                                  params["samples_per_record"]),
+                                                 np.float)
+
+    def process(self, chan_bufs, buf_num):
+        """Merge the statistics of this buffer into the accumulators."""
+        self.process_batch(chan_bufs, buf_num, 1)
+
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Merge the statistics of a batch of buffers into the accumulators."""
+        if self.error:
+            return
+        n_records = n_bufs*self.plan.records_per_buffer
+        rec_offsets = self.plan.rec_type_offsets(first_buf_num, self.n_rec_types, n_bufs)
+        for (chan_buf, mean, m2, mins, maxs) in izip(chan_bufs, self.means, self.m2s,
+                                                     self.mins, self.maxs):
+            for (rec_type, offset) in rec_offsets:
+                recs = chan_buf[offset::self.n_rec_types]
+                batch_mean = np.mean(recs, axis=0)
+                batch_m2 = np.sum((recs - batch_mean)**2, axis=0)
+                _merge_moments(self.counts[rec_type], mean[rec_type], m2[rec_type],
+                               len(recs), batch_mean, batch_m2)
+                np.minimum(mins[rec_type], np.min(recs, axis=0), out=mins[rec_type])
+                np.maximum(maxs[rec_type], np.max(recs, axis=0), out=maxs[rec_type])
+        for (rec_type, offset) in rec_offsets:
+            self.counts[rec_type] += len(xrange(offset, n_records, self.n_rec_types))
+
+    def merge(self, other):
+        """Combine the statistics of another Statistics processor into this one.
+
+        Both processors must have been run with the same record types, record
+        length and channels.  Returns this processor.
+
+        Raises:
+            ProcessorException if either processor has an error or their
+                statistics are not compatible.
+        """
+        self.check_error()
+        other.check_error()
+        if (self.counts is None or other.counts is None or
+                self.n_rec_types != other.n_rec_types or
+                len(self.means) != len(other.means) or
+                self.means[0].shape != other.means[0].shape):
+            raise ProcessorException("Cannot merge incompatible Statistics processors.")
+        for chan in xrange(len(self.means)):
+            for rec_type in xrange(self.n_rec_types):
+                _merge_moments(self.counts[rec_type],
+                               self.means[chan][rec_type], self.m2s[chan][rec_type],
+                               other.counts[rec_type],
+                               other.means[chan][rec_type], other.m2s[chan][rec_type])
+            np.minimum(self.mins[chan], other.mins[chan], out=self.mins[chan])
+            np.maximum(self.maxs[chan], other.maxs[chan], out=self.maxs[chan])
+        self.counts += other.counts
+        return self
+
+    def convergence(self):
+        """Return the largest standard error of any sample mean."""
+        if self.counts is None:
+            return None
+        if np.min(self.counts) < 2:
+            return np.inf
+        counts = self.counts[:,np.newaxis].astype(np.float)
+        return max(np.sqrt(np.max(m2 / ((counts - 1)*counts))) for m2 in self.m2s)
+
+    def get_result(self):
+        """Return the per-sample statistics.
+
+        Returns:
+            Dictionary with the entries
+                count: the number of records of each type, of shape (n_rec_types,)
+                mean, variance, min, max: lists of channel results; each entry
+                    is a numpy array of shape (n_rec_types, samples_per_record).
+                    The variance is the sample variance, and is NaN for record
+                    types with fewer than two records.
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        dof = (self.counts - 1).astype(np.float)[:,np.newaxis]
+        dof[dof < 1] = np.nan
+        return dict(count=self.counts.copy(),
+                    mean=[mean.copy() for mean in self.means],
+                    variance=[m2 / dof for m2 in self.m2s],
+                    min=[mins.copy() for mins in self.mins],
+                    max=[maxs.copy() for maxs in self.maxs])
+
+class Preview(BufferProcessor):
+    """Processor which publishes a live envelope of the latest records.
+
+    The records of the latest buffer are reduced to the minimum, maximum and
+    mean of each block of samples, at a fixed number of points per channel,
+    and written to a slot file which a viewer can poll with
+    preview.PreviewSlot while the acquisition runs.  To keep the cost low, an
+    envelope is only computed at most max_rate times a second; other buffers
+    are skipped.  The name of the slot file is chosen with the processor, but
+    the file is only created when an acquisition starts; close() removes it.
+    """
+
+    def __init__(self, n_points=512, max_rate=20.0, records=None, name=None,
+                 directory=None):
+        """Create a new Preview processor.
+
+        Args:
+            n_points (int): the number of points in the envelope of each
+                channel; at most the number of samples per record are used.
+            max_rate (float): the most envelopes published per second.
+            records (int): the number of records at the end of the latest
+                buffer to include; None for the whole buffer.
+            directory: the directory for the slot file; defaults to
+                shared.default_dir()
+        """
+        super(Preview, self).__init__(name)
+        if n_points < 1:
+            raise ProcessorException("n_points must be greater than 0."
+                                     " Provided: {}".format(n_points))
+        if max_rate <= 0:
+            raise ProcessorException("max_rate must be positive. Provided: {}"
+                                     .format(max_rate))
+        if records is not None and records < 1:
+            raise ProcessorException("records must be greater than 0."
+                                     " Provided: {}".format(records))
+        self.n_points = n_points
+        self.max_rate = max_rate
+        self.records = records
+        self.filename = slot_filename(directory)
+        self.n_published = 0
+        self._slot = None
+        self._last_publish = None
+
+    def __getstate__(self):
+        state = super(Preview, self).__getstate__()
+        # each process maps the slot file itself
+        state["_slot"] = None
+        return state
+
+    def initialize_proc(self, params):
+        if params["channel_count"] > MAX_CHANNELS:
+            self.abort(ProcessorException("Preview supports at most {} channels."
+                                          .format(MAX_CHANNELS)))
+            return
+        spr = params["samples_per_record"]
+        n_points = min(self.n_points, spr)
+        # the first sample of each block, and the number of samples in it
+        edges = np.linspace(0, spr, n_points + 1).astype(np.int64)
+        self._starts = edges[:-1]
+        self._widths = np.diff(edges).astype(np.float)
+        # a viewer may have mapped the slot of an earlier acquisition already
+        if not os.path.exists(self.filename):
+            try:
+                create_slot(self.n_points, self.filename)
+            except (IOError, OSError) as err:
+                self.abort(ProcessorException("Could not create the preview slot: {}"
+                                              .format(err)))
+                return
+        self._slot = PreviewSlot(self.filename)
+        self._last_publish = None
+        self.n_published = 0
+
+    def process(self, chan_bufs, buf_num):
+        """Publish the envelope of this buffer, unless one was published too recently."""
+        self.process_batch(chan_bufs, buf_num, 1)
+
+    def process_batch(self, chan_bufs, first_buf_num, n_bufs):
+        """Publish the envelope of the end of the batch, unless one was published too recently."""
+        if self.error:
+            return
+        now = timeit.default_timer()
+        if self._last_publish is not None and now - self._last_publish < 1.0/self.max_rate:
+            return
+        self._last_publish = now
+
+        n_records = n_bufs*self.plan.records_per_buffer
+        if self.records is not None:
+            n_records = min(self.records, n_records)
+        (mins, maxs, means) = ([], [], [])
+        for chan_buf in chan_bufs:
+            recs = chan_buf[-n_records:]
+            # reduce over the records first, so the blocks are only one record long
+            mins.append(np.minimum.reduceat(np.min(recs, axis=0), self._starts))
+            maxs.append(np.maximum.reduceat(np.max(recs, axis=0), self._starts))
+            means.append(np.add.reduceat(np.mean(recs, axis=0), self._starts) / self._widths)
+        self._slot.write(mins, maxs, means, first_buf_num + n_bufs - 1, n_records,
+                         self.plan.samples_per_record)
+        self.n_published += 1
+
+    def get_result(self):
+        """Return the latest published envelope.
+
+        Returns:
+            Dictionary as from preview.PreviewSlot.read, or None if no envelope
+            was published.
+
+        Raises:
+            ProcessorException if an error occurred.
+        """
+        self.check_error()
+        if not os.path.exists(self.filename):
+            return None
+        return PreviewSlot(self.filename).read()
+
+    def close(self):
+        """Remove the slot file; a viewer can no longer open it."""
+        self._slot = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+# --- helper functions
+
+def _nbytes(shape, dtype):
+    """Return the size in bytes of an array."""
+    return int(np.prod(shape))*np.dtype(dtype).itemsize
+
+def _kernel_records(chan_bufs, chan):
+    """Return the (records, shift) of a channel for the compiled kernels.
+
+    The records are those of the raw buffer, before the bit shift.  Returns
+    None if the kernels are not built or do not support the samples.
+    """
+    if kernels is None:
+        return None
+    if hasattr(chan_bufs, "raw"):
+        (recs, shift) = chan_bufs.raw(chan)
+    else:
+        (recs, shift) = (chan_bufs[chan], 0)
+    if (recs.ndim != 2 or recs.dtype not in (np.uint8, np.uint16) or
+            not recs.flags.writeable):
+        return None
+    return (recs, shift)
+
+def _split_buffers(chan_bufs, n_bufs):
+    """Return the channel buffers of each buffer in a batch of n_bufs buffers.
+
+    Uses the worker's split if chan_bufs provides one; otherwise chan_bufs is
+    a list of channel arrays which are sliced by record.
+    """
+    if n_bufs == 1:
+        return [chan_bufs]
+    if hasattr(chan_bufs, "split"):
+        return chan_bufs.split(n_bufs)
+    recs_per_buf = len(chan_bufs[0]) / n_bufs
+    return [[chan_buf[i*recs_per_buf:(i+1)*recs_per_buf] for chan_buf in chan_bufs]
+            for i in xrange(n_bufs)]
+
+def _window(chan_bufs, chan, start, stop):
+    """Return samples start:stop of every record of a channel buffer.
+
+    Uses the worker's shared window extraction if chan_bufs provides one.
+    """
+    if hasattr(chan_bufs, "window"):
+        return chan_bufs.window(chan, start, stop)
+    return chan_bufs[chan][:,start:stop]
+
+def _max_standard_error(sum_buf, sumsq_buf, count):
+    """Return the largest standard error of the mean from sums and sums of squares.
+
+    Returns infinity if fewer than two records have been summed.
+    """
+    if np.min(count) < 2:
+        return np.inf
+    count = np.asarray(count, np.float)
+    mean = sum_buf / count
+    var = (sumsq_buf - sum_buf*mean) / (count - 1)
+    return np.sqrt(np.max(np.maximum(var, 0.0) / count))
+
+def _merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """Combine the streaming moments of b into the arrays of a, in place.
+
+    This is the pairwise combination formula of Chan et al. for the mean and
+    the sum of squared deviations; the caller is responsible for adding
+    count_b to count_a.
+    """
+    count = count_a + count_b
+    if count_b == 0 or count == 0:
+        return
+    delta = mean_b - mean_a
+    mean_a += delta * (float(count_b) / count)
+    m2_a += m2_b + delta**2 * (float(count_a) * count_b / count)
+
 # --- error handling
 
 class ProcessorException(Exception):
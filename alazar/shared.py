@@ -0,0 +1,209 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Result arrays shared between processes through memory-mapped files.
+
+A processor running in the worker process allocates its large result arrays
+with shared_empty().  When the processor is pickled to send it back to the
+caller, pack() replaces those arrays with small SharedArrayHandles, and
+unpack() in the caller maps the same file again instead of copying the data.
+
+Files which never reach another process are removed when the process which
+created them exits, or by remove_owned_files() in a worker which failed.
+Where a mapped file can't be removed, as on Windows, unpack() removes it once
+the arrays mapping it are garbage collected.
+"""
+import atexit
+import mmap
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+# files this process has to remove: those made by shared_empty which no other
+# process has mapped, and unpacked files which were still mapped
+_owned_files = set()
+# weak references, by filename, to the maps of unpacked files waiting to be removed
+_unmap_refs = {}
+
+def default_dir():
+    """Return the directory for shared result files.
+
+    This is the RAM-backed /dev/shm where available, otherwise the temporary
+    directory.
+    """
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+def shared_empty(shape, dtype, directory=None):
+    """Return a new array backed by a memory-mapped file.
+
+    Args:
+        shape, dtype: the shape and dtype of the array
+        directory: the directory in which to create the backing file; defaults
+            to default_dir()
+    """
+    if np.prod(shape) == 0:
+        # can't map an empty file
+        return np.empty(shape, dtype)
+    if directory is None:
+        directory = default_dir()
+    (fd, filename) = tempfile.mkstemp(prefix="pyalazar-", suffix=".dat", dir=directory)
+    os.close(fd)
+    _owned_files.add(filename)
+    return np.memmap(filename, dtype=dtype, mode="w+", shape=shape)
+
+def remove_owned_files():
+    """Remove the files made by shared_empty in this process.
+
+    The arrays stay valid where the platform allows removing a mapped file.
+    Files unpickled by another process are already gone.
+    """
+    for filename in list(_owned_files):
+        _remove(filename)
+
+# multiprocessing workers exit without running this, so their files survive
+# until the caller maps them
+atexit.register(remove_owned_files)
+
+def _remove(filename):
+    """Remove a file; return False if it is still there, as a mapped file on Windows."""
+    try:
+        os.remove(filename)
+    except OSError:
+        if os.path.exists(filename):
+            return False
+    _owned_files.discard(filename)
+    return True
+
+def _remove_when_unmapped(filename, file_map):
+    """Remove a file once file_map, and so every array mapping it, is collected."""
+    _owned_files.add(filename)
+    mapping = file_map._mmap
+    def unmapped(ref):
+        del _unmap_refs[filename]
+        # the map would only be closed after this returns
+        mapping.close()
+        _remove(filename)
+    _unmap_refs[filename] = weakref.ref(file_map, unmapped)
+
+def is_ram_backed(directory=None):
+    """Return True if files in directory are kept in memory, as in /dev/shm.
+
+    Args:
+        directory: the directory to check; defaults to default_dir()
+    """
+    if directory is None:
+        directory = default_dir()
+    path = os.path.realpath(directory)
+    try:
+        with open("/proc/mounts") as mounts:
+            entries = [line.split() for line in mounts]
+    except IOError:
+        return path == "/dev/shm"
+    # the file system is the one with the longest mount point containing path
+    (mount_point, fs_type) = ("", None)
+    for entry in entries:
+        if len(entry) < 3:
+            continue
+        mount = entry[1].rstrip("/") + "/"
+        if (path + "/").startswith(mount) and len(mount) > len(mount_point):
+            (mount_point, fs_type) = (mount, entry[2])
+    return fs_type in ("tmpfs", "ramfs")
+
+class SharedArrayHandle(object):
+    """Picklable reference to an array stored in a memory-mapped file."""
+    def __init__(self, filename, dtype, shape, strides, offset):
+        self.filename = filename
+        self.dtype = dtype
+        self.shape = shape
+        self.strides = strides
+        self.offset = offset
+
+    def open(self, file_maps=None):
+        """Map the file and return the array as a view into it.
+
+        Args:
+            file_maps: optional dict of file maps by filename, so that handles
+                to views of the same file share one mapping
+        """
+        if file_maps is None:
+            file_maps = {}
+        if self.filename not in file_maps:
+            file_maps[self.filename] = np.memmap(self.filename, dtype=np.uint8, mode="r+")
+        return np.ndarray(self.shape, self.dtype, buffer=file_maps[self.filename],
+                          offset=self.offset, strides=self.strides)
+
+def to_handle(arr):
+    """Return a SharedArrayHandle for arr, or None if it is not shared.
+
+    Only arrays which are views into a live file created by shared_empty()
+    have handles; anything else has to be pickled as usual.
+    """
+    if not isinstance(arr, np.ndarray):
+        return None
+    root = arr
+    while root is not None and not isinstance(root.base, mmap.mmap):
+        root = root.base if isinstance(root.base, np.ndarray) else None
+    if not isinstance(root, np.memmap) or root.filename is None:
+        return None
+    if not os.path.exists(root.filename) or root.filename in _unmap_refs:
+        # this is an array in the caller that was already unpacked
+        return None
+    offset = (arr.__array_interface__["data"][0] -
+              root.__array_interface__["data"][0] + root.offset)
+    if offset < 0 or min(arr.strides or (0,)) < 0:
+        return None
+    root.flush()
+    return SharedArrayHandle(root.filename, arr.dtype, arr.shape, arr.strides, offset)
+
+def pack(obj):
+    """Replace shared arrays in obj, or in a list, tuple or dict, with handles."""
+    if isinstance(obj, list):
+        return [pack(item) for item in obj]
+    elif isinstance(obj, tuple):
+        return tuple(pack(item) for item in obj)
+    elif isinstance(obj, dict):
+        return dict((key, pack(val)) for (key, val) in obj.iteritems())
+    handle = to_handle(obj)
+    if handle is not None:
+        return handle
+    return obj
+
+def unpack(obj):
+    """Replace the handles in obj, or in a list, tuple or dict, with arrays.
+
+    The backing files are removed once they are mapped, so they are cleaned
+    up when the arrays are garbage collected.  Where a mapped file can't be
+    removed, it is removed when the arrays are collected instead.
+    """
+    file_maps = {}
+    obj = _unpack(obj, file_maps)
+    for (filename, file_map) in file_maps.iteritems():
+        if not _remove(filename):
+            _remove_when_unmapped(filename, file_map)
+    return obj
+
+def _unpack(obj, file_maps):
+    if isinstance(obj, list):
+        return [_unpack(item, file_maps) for item in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_unpack(item, file_maps) for item in obj)
+    elif isinstance(obj, dict):
+        return dict((key, _unpack(val, file_maps)) for (key, val) in obj.iteritems())
+    elif isinstance(obj, SharedArrayHandle):
+        return obj.open(file_maps)
+    return obj
@@ -0,0 +1,479 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Carry the DMA buffers of an acquisition to the processors.
+
+LocalTransport runs the processors in a worker process on this machine, which
+is what acquire() does by default.  RemoteTransport streams the buffers over
+TCP, or over a Unix socket, to one or more ProcessingServers.  Each server
+runs a share of the processors on every buffer and sends them back when the
+acquisition is done, so the processing is spread over several machines.
+
+The work is split by processor, not by buffer: every server receives every
+buffer, so the board sends each buffer once per server, and it runs at the
+pace of the slowest server.  Spread the expensive processors over the
+servers, and use more servers only while the link can carry the extra copies.
+
+Typical use:
+
+    # on each processing node, listening only on the acquisition network
+    ProcessingServer(("10.0.0.2", 7000), authkey=key).serve_forever()
+
+    # on the digitizer host
+    transport = RemoteTransport([("10.0.0.2", 7000), ("10.0.0.3", 7000)], authkey=key)
+    board.acquire(1024, 100000, 100, processors=procs, transport=transport)
+
+The processors, the errors and the results are sent as pickles, and
+unpickling runs arbitrary code, so whoever may start an acquisition on a
+server can run any code there.  Both ends therefore prove that they know the
+shared authkey, with an HMAC challenge as in multiprocessing.connection,
+before anything is unpickled.  The traffic itself is neither encrypted nor
+signed: keep the authkey secret and only listen on trusted interfaces.
+
+Buffers are sent as frames of raw samples, without pickling.  Each server
+acknowledges a buffer once its worker has processed it, and the board waits
+before sending to a server which has window buffers unacknowledged, so a slow
+server holds back the board instead of filling up its memory.  Results are
+always pickled in full, since a remote server can't share memory-mapped files
+with the caller.
+"""
+import cPickle as pickle
+import hashlib
+import hmac
+import multiprocessing as mp
+import os
+import select
+import socket
+import struct
+from Queue import Empty
+
+import numpy as np
+
+from alazar.exceptions import AlazarException
+from alazar.process import _process_buffers
+
+# frame kinds; the first three are sent to the server, the next three back to
+# the board, and the rest both ways while the two ends authenticate
+_START = 1
+_BUFFER = 2
+_END = 3
+_ACK = 4
+_STOP = 5
+_RESULT = 6
+_CHALLENGE = 7
+_ANSWER = 8
+_WELCOME = 9
+_FAILURE = 10
+
+# kind and payload length of a frame
+_HEADER = struct.Struct("!BQ")
+
+# the random message each end signs with the authkey
+_CHALLENGE_SIZE = 20
+_DIGEST = hashlib.sha256
+
+class LocalTransport(object):
+    """Process the buffers in a worker process on this machine."""
+
+    def start(self, processors, acq_params, placement=None):
+        """Start processing an acquisition.
+
+        Args:
+            processors ([BufferProcessor]): the processors for the acquisition.
+            acq_params: the acquisition parameter dictionary from def_acq_params.
+            placement (Placement): the placement of the processing worker.
+
+        Returns:
+            (buf_queue, comm, stop): buf_queue takes (buffer, error) pairs from
+            the board, comm.get() returns the finished processors, and
+            stop.is_set() is True once the processors have converged.
+        """
+        buf_queue = mp.Queue()
+        comm = mp.Queue()
+        stop = mp.Event()
+        worker = mp.Process(target = _process_buffers,
+                            args = (buf_queue,
+                                    comm,
+                                    processors,
+                                    acq_params,
+                                    stop,
+                                    placement,))
+        worker.start()
+        return (buf_queue, comm, stop)
+
+class RemoteTransport(object):
+    """Process the buffers on one or more ProcessingServers."""
+
+    def __init__(self, addresses, authkey, window=8):
+        """Create a transport to a set of processing servers.
+
+        Args:
+            addresses: a list of server addresses; a (host, port) tuple for
+                TCP, or a path for a Unix socket.  The processors are shared
+                out between the servers in turn, and every server receives
+                every buffer.
+            authkey (str): the secret shared with the servers.
+            window (int): the most buffers a server may have received but
+                not yet processed before the board waits for it.
+        """
+        if not addresses:
+            raise AlazarException("A remote transport needs at least one server.")
+        _check_authkey(authkey)
+        if window < 1:
+            raise AlazarException("The window must be at least one buffer; got {}."
+                                  .format(window))
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        self.window = window
+
+    def start(self, processors, acq_params, placement=None):
+        """Send the processors to the servers; see LocalTransport.start.
+
+        Only the servers given at least one processor are used.  The
+        placement is applied to the worker on each server.
+
+        Raises:
+            AlazarException if a server can't be reached, or doesn't know
+                the authkey.
+        """
+        n_servers = min(len(self.addresses), len(processors))
+        shares = [processors[i::n_servers] for i in xrange(n_servers)]
+        links = []
+        try:
+            for (address, share) in zip(self.addresses, shares):
+                links.append(_ServerConnection(address))
+                # the server challenges first, as it is the one at risk
+                _answer_challenge(links[-1].sock, self.authkey)
+                _deliver_challenge(links[-1].sock, self.authkey)
+                _send_frame(links[-1].sock, _START,
+                            pickle.dumps((share, acq_params, placement),
+                                         pickle.HIGHEST_PROTOCOL))
+        except (socket.error, EOFError, AlazarException) as err:
+            for link in links:
+                link.close()
+            raise AlazarException("Could not start remote processing: {}".format(err))
+        session = _RemoteSession(links, shares, self.window)
+        return (session, session, session)
+
+class ProcessingServer(object):
+    """Run the processors of remote acquisitions.
+
+    Each connection is one acquisition from a RemoteTransport, which is
+    processed by a new worker process, as with a local acquisition.  Needs
+    fork, so it doesn't run on Windows.  A connection which doesn't prove it
+    knows the authkey is closed before anything it sent is unpickled; see the
+    module docstring for the risks.
+    """
+
+    def __init__(self, address, authkey, backlog=8):
+        """Listen for acquisitions.
+
+        Args:
+            address: a (host, port) tuple for TCP, or a path for a Unix socket.
+                Port 0 picks a free port; see the address attribute.  Only
+                bind to trusted interfaces.
+            authkey (str): the secret shared with the RemoteTransports.
+            backlog (int): the most connections waiting to be accepted.
+        """
+        _check_authkey(authkey)
+        self.authkey = authkey
+        if isinstance(address, tuple):
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(address)
+        self.sock.listen(backlog)
+        self.address = self.sock.getsockname()
+        self._closed = False
+
+    def serve_forever(self):
+        """Handle acquisitions until the server is closed."""
+        while not self._closed:
+            try:
+                self.handle_one()
+            except socket.error:
+                if not self._closed:
+                    raise
+
+    def handle_one(self):
+        """Wait for one acquisition and start a worker to process it."""
+        (conn, _) = self.sock.accept()
+        try:
+            worker = mp.Process(target=_serve_acquisition, args=(conn, self.authkey))
+            worker.start()
+        finally:
+            # the worker has its own copy of the connection
+            conn.close()
+
+    def close(self):
+        """Stop listening; acquisitions already started are finished."""
+        self._closed = True
+        address = self.address
+        try:
+            # wakes up a thread waiting in accept
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+
+# --- the two ends of a connection
+
+class _ServerConnection(object):
+    """The board's connection to one server."""
+    def __init__(self, address):
+        if isinstance(address, tuple):
+            self.sock = socket.create_connection(address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+        self.in_flight = 0
+        self.stopped = False
+        self.result = None
+
+    def handle(self, kind, payload):
+        """Handle a frame from the server."""
+        if kind == _ACK:
+            self.in_flight -= 1
+        elif kind == _STOP:
+            self.stopped = True
+        elif kind == _RESULT:
+            self.result = pickle.loads(bytes(payload))
+
+    def receive(self):
+        """Wait for a frame from the server and handle it."""
+        self.handle(*_recv_frame(self.sock))
+
+    def close(self):
+        self.sock.close()
+
+class _RemoteSession(object):
+    """The board's side of a remote acquisition.
+
+    Stands in for the buffer queue, the result queue and the stop event of a
+    local worker.
+    """
+    def __init__(self, links, shares, window):
+        self.links = links
+        self.shares = shares
+        self.window = window
+        # the servers which can stop the acquisition early
+        self.voters = [link for (link, share) in zip(links, shares)
+                       if any(getattr(proc, "target", None) is not None for proc in share)]
+
+    def put(self, item):
+        """Send a (buffer, error) pair to every server.
+
+        Waits for a server which already has window buffers unprocessed.
+        """
+        (buf, err) = item
+        try:
+            for link in self.links:
+                if buf is None:
+                    _send_frame(link.sock, _END, pickle.dumps(err, pickle.HIGHEST_PROTOCOL))
+                    continue
+                while link.in_flight >= self.window:
+                    link.receive()
+                _send_frame(link.sock, _BUFFER, buf)
+                link.in_flight += 1
+        except (socket.error, EOFError) as err:
+            raise AlazarException("Lost connection to a processing server: {}".format(err))
+
+    def close(self):
+        """The buffers are sent by put, so there is nothing to flush."""
+        pass
+
+    def join_thread(self):
+        pass
+
+    def is_set(self):
+        """Return True once every server with a convergence target has converged."""
+        self._poll()
+        return bool(self.voters) and all(link.stopped for link in self.voters)
+
+    def get(self):
+        """Wait for the processors from every server and return them in order.
+
+        Raises:
+            AlazarException if a server is lost before sending its processors.
+        """
+        try:
+            for link in self.links:
+                while link.result is None:
+                    link.receive()
+        except (socket.error, EOFError) as err:
+            raise AlazarException("Lost connection to a processing server: {}".format(err))
+        finally:
+            for link in self.links:
+                link.close()
+        processors = [None]*sum(len(share) for share in self.shares)
+        for (i, link) in enumerate(self.links):
+            processors[i::len(self.links)] = link.result
+        return processors
+
+    def _poll(self):
+        """Handle the frames the servers have already sent."""
+        socks = dict((link.sock, link) for link in self.links)
+        while True:
+            (ready, _, _) = select.select(list(socks), [], [], 0)
+            if not ready:
+                return
+            for sock in ready:
+                socks[sock].receive()
+
+class _ServerLink(object):
+    """The server's side of a remote acquisition.
+
+    Stands in for the buffer queue, the result queue and the stop event of
+    _process_buffers.
+    """
+    def __init__(self, sock, dtype):
+        self.sock = sock
+        self.dtype = dtype
+        # buffers handed to the worker and not yet acknowledged
+        self.unacked = 0
+
+    def get(self):
+        """Return the next (buffer, error) pair from the board.
+
+        The worker only waits for a buffer once it has processed those it
+        took before, so they are acknowledged first.
+        """
+        for _ in xrange(self.unacked):
+            _send_frame(self.sock, _ACK, b"")
+        self.unacked = 0
+        return self._receive()
+
+    def get_nowait(self):
+        """Return a buffer the board has already sent, without acknowledging any."""
+        (ready, _, _) = select.select([self.sock], [], [], 0)
+        if not ready:
+            raise Empty
+        return self._receive()
+
+    def _receive(self):
+        (kind, payload) = _recv_frame(self.sock)
+        if kind == _BUFFER:
+            self.unacked += 1
+            return (np.frombuffer(payload, self.dtype), None)
+        elif kind == _END:
+            return (None, pickle.loads(bytes(payload)))
+        return (None, AlazarException("Unexpected frame of kind {} from the board."
+                                      .format(kind)))
+
+    def put(self, processors):
+        """Send the finished processors back to the board."""
+        _send_frame(self.sock, _RESULT, pickle.dumps(processors, pickle.HIGHEST_PROTOCOL))
+
+    def set(self):
+        """Tell the board the processors have converged."""
+        _send_frame(self.sock, _STOP, b"")
+
+def _serve_acquisition(conn, authkey):
+    """Process one remote acquisition in a server worker."""
+    try:
+        _deliver_challenge(conn, authkey)
+        _answer_challenge(conn, authkey)
+        (kind, payload) = _recv_frame(conn)
+        if kind != _START:
+            return
+        (processors, acq_params, placement) = pickle.loads(bytes(payload))
+        # the board can't map the result files of another machine
+        for proc in processors:
+            proc.shared = False
+        link = _ServerLink(conn, acq_params["dtype"])
+        _process_buffers(link, link, processors, acq_params, link, placement)
+    except (socket.error, EOFError):
+        # the board went away; nobody is waiting for the result
+        pass
+    except AlazarException:
+        # the other end doesn't know the authkey
+        pass
+    finally:
+        conn.close()
+
+# --- authentication
+
+def _check_authkey(authkey):
+    if not isinstance(authkey, str) or not authkey:
+        raise AlazarException("The authkey must be a non-empty string.")
+
+def _deliver_challenge(sock, authkey):
+    """Check that the other end of a connection knows the authkey.
+
+    Raises:
+        AlazarException if it answers wrongly.
+    """
+    message = os.urandom(_CHALLENGE_SIZE)
+    _send_frame(sock, _CHALLENGE, message)
+    (kind, answer) = _recv_frame(sock, _DIGEST().digest_size)
+    expected = hmac.new(authkey, message, _DIGEST).digest()
+    if kind != _ANSWER or not hmac.compare_digest(bytes(answer), expected):
+        _send_frame(sock, _FAILURE, b"")
+        raise AlazarException("The other end does not know the authkey.")
+    _send_frame(sock, _WELCOME, b"")
+
+def _answer_challenge(sock, authkey):
+    """Prove to the other end of a connection that this end knows the authkey.
+
+    Raises:
+        AlazarException if the other end refuses the answer.
+    """
+    (kind, message) = _recv_frame(sock, _CHALLENGE_SIZE)
+    if kind != _CHALLENGE:
+        raise AlazarException("Expected an authentication challenge.")
+    _send_frame(sock, _ANSWER, hmac.new(authkey, bytes(message), _DIGEST).digest())
+    (kind, _) = _recv_frame(sock, 0)
+    if kind != _WELCOME:
+        raise AlazarException("Authentication failed; check the authkey.")
+
+# --- framing
+
+def _send_frame(sock, kind, payload):
+    """Send a frame; an array payload is sent from its memory without copying."""
+    if isinstance(payload, np.ndarray):
+        payload = memoryview(np.ascontiguousarray(payload).view(np.uint8))
+    sock.sendall(_HEADER.pack(kind, len(payload)))
+    sock.sendall(payload)
+
+def _recv_frame(sock, max_length=None):
+    """Return the (kind, payload) of the next frame; the payload is a bytearray.
+
+    Args:
+        max_length (int): the longest payload accepted; None for any.
+
+    Raises:
+        EOFError if the connection is closed.
+        AlazarException if the payload is longer than max_length.
+    """
+    (kind, length) = _HEADER.unpack(bytes(_recv_exactly(sock, _HEADER.size)))
+    if max_length is not None and length > max_length:
+        raise AlazarException("Frame of {} bytes is longer than {} bytes."
+                              .format(length, max_length))
+    return (kind, _recv_exactly(sock, length))
+
+def _recv_exactly(sock, n_bytes):
+    """Read exactly n_bytes into a new bytearray."""
+    data = bytearray(n_bytes)
+    view = memoryview(data)
+    received = 0
+    while received < n_bytes:
+        n_recv = sock.recv_into(view[received:], n_bytes - received)
+        if not n_recv:
+            raise EOFError("connection closed")
+        received += n_recv
+    return data
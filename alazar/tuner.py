@@ -0,0 +1,198 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""Choose the DMA buffer geometry for an acquisition.
+
+Small buffers keep latency and memory low, but every buffer costs a fixed
+Python overhead in the processing worker; large buffers amortize that overhead
+at the cost of memory.  tune_buffer_geometry times the processors on mock
+buffers of several sizes and picks the smallest buffer which processes nearly
+as fast as the best one.
+
+Typical use:
+
+    geometry = tune_buffer_geometry(board.get_board_type(), 1024, 100000, procs)
+    board.acquire(1024, 100000, processors=procs, **geometry)
+"""
+import copy
+import cPickle as pickle
+import timeit
+
+from alazar.board_common import (def_acq_params, AcquisitionPlan,
+                                 _check_buffer_alignment, _make_channel_mask)
+from alazar.board_mock import make_mock_buffer, mock_sample_format
+from alazar.exceptions import AlazarException
+from alazar.process import MAX_BATCH_BUFFERS, _process_batch, _sample_window
+
+def tune_buffer_geometry(board_type,
+                         samples_per_record,
+                         records_per_acquisition,
+                         processors,
+                         channels_to_acquire="all",
+                         memory_budget=256*2**20,
+                         max_buffer_count=64,
+                         calibration_records=4096,
+                         tolerance=0.9):
+    """Return the buffer geometry with the best sustained processing rate.
+
+    Args:
+        board_type: the board to tune for, as for MockAlazar.
+        samples_per_record, records_per_acquisition, channels_to_acquire: the
+            acquisition to tune, as for acquire().
+        processors ([BufferProcessor]): the processors to time; they are
+            copied, so they are not modified.
+        memory_budget (int): the most memory in bytes to use for DMA buffers.
+        max_buffer_count (int): the most DMA buffers to allocate.
+        calibration_records (int): roughly how many records to time for each
+            candidate buffer size.
+        tolerance (float): the smallest buffer processing at least this
+            fraction of the best rate is chosen, to keep latency low.
+
+    Returns:
+        Dictionary with records_per_buffer and buffer_count, which can be
+        passed as keyword arguments to acquire().
+
+    Raises:
+        AlazarException if the acquisition is invalid or no buffer fits in
+            the memory budget.
+    """
+    rates = measure_processing_rates(board_type,
+                                     samples_per_record,
+                                     records_per_acquisition,
+                                     processors,
+                                     channels_to_acquire,
+                                     memory_budget,
+                                     calibration_records)
+    best_rate = max(rates.itervalues())
+    records_per_buffer = min(recs for (recs, rate) in rates.iteritems()
+                             if rate >= tolerance*best_rate)
+
+    bytes_per_buffer = _bytes_per_buffer(board_type, samples_per_record,
+                                         records_per_buffer, channels_to_acquire)
+    buffer_count = min(max_buffer_count,
+                       memory_budget / bytes_per_buffer,
+                       records_per_acquisition / records_per_buffer)
+    return dict(records_per_buffer=records_per_buffer,
+                buffer_count=max(buffer_count, 2))
+
+def measure_processing_rates(board_type,
+                             samples_per_record,
+                             records_per_acquisition,
+                             processors,
+                             channels_to_acquire="all",
+                             memory_budget=256*2**20,
+                             calibration_records=4096):
+    """Measure the processing rate for a range of buffer sizes.
+
+    The candidate buffer sizes are the divisors of records_per_acquisition,
+    spaced by at least a factor of two, for which two buffers fit in the
+    memory budget.  See tune_buffer_geometry for the arguments.
+
+    Returns:
+        Dictionary of the processing rate in records per second, keyed by
+        records per buffer.
+    """
+    _check_buffer_alignment(board_type, samples_per_record)
+    (_, channel_count) = _make_channel_mask(board_type, channels_to_acquire)
+    (bit_depth, dtype) = mock_sample_format(board_type)
+
+    bytes_per_record = _bytes_per_buffer(board_type, samples_per_record, 1,
+                                         channels_to_acquire)
+    candidates = []
+    for recs in xrange(1, records_per_acquisition + 1):
+        if records_per_acquisition % recs != 0:
+            continue
+        if 2*recs*bytes_per_record > memory_budget:
+            break
+        if not candidates or recs >= 2*candidates[-1]:
+            candidates.append(recs)
+    if not candidates:
+        raise AlazarException("Two buffers of one record each do not fit in the"
+                              " memory budget of {} bytes.".format(memory_budget))
+
+    rates = {}
+    for recs in candidates:
+        buffers_per_acquisition = records_per_acquisition / recs
+        # a divisor, so the timed records divide the acquisition like its own
+        n_buffers = _next_divisor(min(buffers_per_acquisition,
+                                      max(2, calibration_records / recs)),
+                                  buffers_per_acquisition)
+        rates[recs] = _time_processing(processors, samples_per_record, recs,
+                                       n_buffers, buffers_per_acquisition,
+                                       channel_count, dtype, bit_depth)
+    return rates
+
+def _time_processing(processors, samples_per_record, records_per_buffer, n_buffers,
+                     max_buffers, channel_count, dtype, bit_depth, repeats=3):
+    """Return the rate in records per second to process n_buffers buffers.
+
+    The buffers are processed as by the worker when it falls behind: each is
+    unpickled as if taken from the queue, and they are processed in batches
+    of MAX_BATCH_BUFFERS.  If a processor rejects an acquisition of n_buffers
+    buffers, for example because of its number of record types, the next
+    divisor of max_buffers is tried, up to max_buffers itself.
+    """
+    params = def_acq_params(samples_per_record, n_buffers*records_per_buffer,
+                            records_per_buffer, channel_count, dtype, bit_depth)
+    plan = AcquisitionPlan(params)
+    buf = make_mock_buffer(records_per_buffer, samples_per_record, bit_depth, dtype,
+                           channel_count)
+    pickled = pickle.dumps((buf, None), pickle.HIGHEST_PROTOCOL)
+
+    # take the best of a few runs to reject scheduling noise
+    elapsed = None
+    for _ in xrange(repeats):
+        procs = _unshared_copies(processors)
+        for proc in procs:
+            proc.initialize(params, plan)
+        if n_buffers < max_buffers and any(proc.error for proc in procs):
+            return _time_processing(processors, samples_per_record, records_per_buffer,
+                                    _next_divisor(n_buffers + 1, max_buffers), max_buffers,
+                                    channel_count, dtype, bit_depth, repeats)
+        start = timeit.default_timer()
+        window = _sample_window(procs)
+        buf_num = 0
+        while buf_num < n_buffers:
+            n_bufs = min(MAX_BATCH_BUFFERS, n_buffers - buf_num)
+            bufs = [pickle.loads(pickled)[0] for _ in xrange(n_bufs)]
+            _process_batch(procs, bufs, plan, window, buf_num)
+            buf_num += n_bufs
+        run_time = timeit.default_timer() - start
+        elapsed = run_time if elapsed is None else min(elapsed, run_time)
+    return n_buffers*records_per_buffer / max(elapsed, 1e-9)
+
+def _next_divisor(n, number):
+    """Return the smallest divisor of number which is at least n."""
+    while number % n != 0:
+        n += 1
+    return n
+
+def _unshared_copies(processors):
+    """Return copies of the processors which keep their results in memory.
+
+    Results of the copies are never sent to another process, so shared result
+    files would only be left behind.
+    """
+    procs = copy.deepcopy(processors)
+    for proc in procs:
+        proc.shared = False
+    return procs
+
+def _bytes_per_buffer(board_type, samples_per_record, records_per_buffer,
+                      channels_to_acquire):
+    """Return the size in bytes of one DMA buffer."""
+    (_, channel_count) = _make_channel_mask(board_type, channels_to_acquire)
+    (bit_depth, _) = mock_sample_format(board_type)
+    bytes_per_sample = (bit_depth + 7) / 8
+    return samples_per_record*records_per_buffer*channel_count*bytes_per_sample
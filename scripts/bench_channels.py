@@ -0,0 +1,27 @@
+"""Benchmark single-channel against two-channel acquisitions.
+
+For each mock board type, this prints the best processing rate of the worker
+and the DMA bytes per record when acquiring both channels and only channel A.
+A single channel halves the bytes the board and the buffer queue have to move
+for each record, and needs no deinterleaving in the worker.
+"""
+import alazar.processor as proc
+from alazar.tuner import measure_processing_rates, _bytes_per_buffer
+
+board_types = {13: "ATS9870", 25: "ATS9360"}
+
+def main(samples_per_record=4096, records_per_acquisition=4096):
+    for (board_type, model) in sorted(board_types.iteritems()):
+        for channels in ["all", "A"]:
+            processors = [proc.Average(), proc.Chunk(1, 0, 64)]
+            rates = measure_processing_rates(board_type,
+                                             samples_per_record,
+                                             records_per_acquisition,
+                                             processors,
+                                             channels)
+            bytes_per_record = _bytes_per_buffer(board_type, samples_per_record, 1, channels)
+            print '{} channels={}: {:.0f} records/s, {} bytes/record'.format(
+                model, channels, max(rates.itervalues()), bytes_per_record)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Benchmark the time to import parts of the alazar package.
+
+Each import is timed in a fresh interpreter, since that is what the short-lived
+worker jobs pay.  The time to start an interpreter which imports nothing is
+subtracted.
+"""
+import subprocess
+import sys
+import timeit
+
+modules = ["alazar",
+           "alazar.processor",
+           "alazar.board_common",
+           "alazar.board_mock",
+           "alazar.board",]
+
+def time_import(statement, repeats):
+    """Return the best wall time in seconds to run statement in a new interpreter."""
+    times = []
+    for _ in xrange(repeats):
+        start = timeit.default_timer()
+        ret_code = subprocess.call([sys.executable, "-c", statement])
+        times.append(timeit.default_timer() - start)
+        if ret_code != 0:
+            return None
+    return min(times)
+
+def main(repeats=10):
+    baseline = time_import("pass", repeats)
+    print 'interpreter startup: {:.1f} ms'.format(baseline*1e3)
+    for module in modules:
+        import_time = time_import("import " + module, repeats)
+        if import_time is None:
+            print '{}: import failed'.format(module)
+        else:
+            print '{}: {:.1f} ms'.format(module, (import_time - baseline)*1e3)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Benchmark the compiled processor kernels against NumPy.
+
+For each mock board type, this prints the processing rate of Average, AverageN
+and Chunk with the compiled kernels and with the NumPy fallback.
+"""
+import timeit
+
+import alazar.processor as proc
+from alazar.board_common import def_acq_params, AcquisitionPlan
+from alazar.board_mock import make_mock_buffer, mock_sample_format
+from alazar.process import _ChannelBuffers, _sample_window
+
+board_types = {13: "ATS9870", 25: "ATS9360"}
+
+def make_processors():
+    return [("Average", proc.Average()),
+            ("AverageN", proc.AverageN(4)),
+            ("Chunk", proc.Chunk(1, 0, 64))]
+
+def time_processor(processor, params, buf, repeats):
+    """Return the best rate in records per second to process one buffer."""
+    plan = AcquisitionPlan(params)
+    processor.initialize(params, plan)
+    window = _sample_window([processor])
+    def run():
+        processor.process(_ChannelBuffers(buf, plan, window), 0)
+    return params["records_per_buffer"] / min(timeit.repeat(run, number=1, repeat=repeats))
+
+def main(samples_per_record=4096, records_per_buffer=256, repeats=20):
+    kernels = proc.kernels
+    if kernels is None:
+        print 'the kernels are not built; only NumPy is timed'
+    for (board_type, model) in sorted(board_types.iteritems()):
+        (bit_depth, dtype) = mock_sample_format(board_type)
+        params = def_acq_params(samples_per_record, records_per_buffer, records_per_buffer,
+                                2, dtype, bit_depth)
+        buf = make_mock_buffer(records_per_buffer, samples_per_record, bit_depth, dtype, 2)
+        for (name, processor) in make_processors():
+            rates = []
+            for use_kernels in [True, False]:
+                proc.kernels = kernels if use_kernels else None
+                rates.append(time_processor(processor, params, buf, repeats))
+            proc.kernels = kernels
+            print '{} {}: {:.0f} records/s compiled, {:.0f} records/s NumPy'.format(
+                model, name, rates[0], rates[1])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Compare the buffer timing jitter with and without a placement.
+
+Runs mock acquisitions with the default scheduling and with the acquiring and
+processing processes pinned to the given CPUs, and prints the telemetry.  Pass
+a board type to time a real board instead, e.g. `bench_placement.py 13 1,1`;
+the second argument is system ID and board ID.
+"""
+import sys
+
+import alazar
+import alazar.processor as proc
+from alazar.placement import Placement, get_affinity
+
+def run(board, acquisition_placement, processing_placement, repeats=5):
+    """Return the mean and worst jitter in seconds over several acquisitions."""
+    jitters = []
+    for _ in xrange(repeats):
+        board.acquire(1024, 4096, 16, processors=[proc.Average()],
+                      acquisition_placement=acquisition_placement,
+                      processing_placement=processing_placement)
+        jitters.append(board.get_telemetry()["jitter"])
+    return (sum(jitters) / len(jitters), max(jitters))
+
+def main():
+    if len(sys.argv) > 2:
+        (system_id, board_id) = [int(num) for num in sys.argv[2].split(",")]
+        board = alazar.Alazar(system_id, board_id)
+    else:
+        board = alazar.MockAlazar(int(sys.argv[1]) if len(sys.argv) > 1 else 13)
+    cpus = get_affinity()
+    placements = [("default", None, None),
+                  ("pinned", Placement(cpus=cpus[:1]), Placement(cpus=cpus[-1:]))]
+    for (name, acquisition_placement, processing_placement) in placements:
+        (mean_jitter, max_jitter) = run(board, acquisition_placement, processing_placement)
+        print '{}: jitter {:.1f} us mean, {:.1f} us worst'.format(name, mean_jitter*1e6,
+                                                                 max_jitter*1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Benchmark the cost of a live Preview.
+
+Prints the time to compute and publish one envelope, the time a viewer takes
+to read it, and the average cost per buffer of a rate-capped Preview.
+"""
+import timeit
+
+import alazar.processor as proc
+from alazar.board_common import def_acq_params, AcquisitionPlan
+from alazar.board_mock import make_mock_buffer, mock_sample_format
+from alazar.preview import PreviewSlot
+from alazar.process import _ChannelBuffers
+
+def time_preview(preview, params, buf, n_buffers):
+    """Return the mean time in seconds to process one buffer."""
+    plan = AcquisitionPlan(params)
+    preview.initialize(params, plan)
+    start = timeit.default_timer()
+    for buf_num in xrange(n_buffers):
+        preview.process(_ChannelBuffers(buf, plan), buf_num)
+    return (timeit.default_timer() - start) / n_buffers
+
+def main(samples_per_record=4096, records_per_buffer=256, n_buffers=1000, board_type=25):
+    (bit_depth, dtype) = mock_sample_format(board_type)
+    params = def_acq_params(samples_per_record, n_buffers*records_per_buffer,
+                            records_per_buffer, 2, dtype, bit_depth)
+    buf = make_mock_buffer(records_per_buffer, samples_per_record, bit_depth, dtype, 2)
+
+    for (label, max_rate) in [("every buffer", 1e9), ("20 Hz", 20.0)]:
+        preview = proc.Preview(n_points=1024, max_rate=max_rate)
+        try:
+            per_buffer = time_preview(preview, params, buf, n_buffers)
+            slot = PreviewSlot(preview.filename)
+            read = min(timeit.repeat(slot.read, number=100, repeat=5)) / 100
+        finally:
+            preview.close()
+        print 'publishing {}: {:.1f} us per buffer, {} envelopes; read {:.1f} us'.format(
+            label, 1e6*per_buffer, preview.n_published, 1e6*read)
+
+if __name__ == '__main__':
+    main()
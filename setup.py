@@ -44,6 +44,12 @@ extensions = [Extension('board',
                        libraries = ['ATSApi',],
                        library_dirs = [alazar_SDK_path + library_path, ],)]
 
+# the compiled processor kernels are optional and do not need the Alazar SDK
+kernels_path = os.path.join("alazar", "kernels" + ext)
+if os.path.exists(kernels_path):
+    extensions.append(Extension('alazar.kernels',
+                                sources = [kernels_path,],))
+
 if USE_CYTHON:
     extensions = cythonize(extensions)
 
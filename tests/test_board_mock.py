@@ -0,0 +1,190 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import alazar.processor as proc
+from alazar.board_mock import MockAlazar, mock_record
+from alazar.exceptions import AlazarException
+
+import numpy as np
+from nose.tools import raises
+
+# the mock board types and their bit depths
+board_types = {13: 8, 25: 12}
+
+class TestMockAlazar(object):
+
+    def test_acquire(self):
+        for board_type in board_types:
+            yield self.check_acquire, board_type
+
+    def check_acquire(self, board_type):
+        board = MockAlazar(board_type)
+
+        samples_per_record = 1024
+
+        (ave,) = board.acquire(samples_per_record, 128, 32, processors=[proc.Average()])
+
+        check_sawtooth(ave.get_result(), board_types[board_type], samples_per_record)
+
+    def test_acquire_one_channel(self):
+        for board_type in board_types:
+            for (first_chan, channel) in enumerate(["A", "B"]):
+                yield self.check_acquire_one_channel, board_type, channel, first_chan
+
+    def check_acquire_one_channel(self, board_type, channel, first_chan):
+        board = MockAlazar(board_type)
+
+        (ave, raw) = board.acquire(256, 64, 16, channels_to_acquire=channel,
+                                   processors=[proc.Average(), proc.Raw()])
+
+        assert len(ave.get_result()) == 1
+        check_sawtooth(ave.get_result(), board_types[board_type], 256, first_chan)
+        # every record is the full record of the one channel
+        assert (raw.get_result()[0] == ave.get_result()[0]).all()
+
+    @raises(AlazarException)
+    def test_invalid_channel(self):
+        MockAlazar(13).acquire(256, 64, 16, channels_to_acquire="C")
+
+    def test_acquire_sequence(self):
+        board = MockAlazar(13)
+
+        acquisitions = [dict(samples_per_record=256*(n+1),
+                             records_per_acquisition=16,
+                             records_per_buffer=4,
+                             processors=[proc.Average()])
+                        for n in range(3)]
+
+        results = list(board.acquire_sequence(acquisitions))
+
+        # results should come back in the order of the acquisitions
+        assert len(results) == len(acquisitions)
+        for (acquisition, (ave,)) in zip(acquisitions, results):
+            check_sawtooth(ave.get_result(), 8, acquisition["samples_per_record"])
+
+    def test_acquire_sequence_error(self):
+        board = MockAlazar(13)
+
+        acquisitions = [dict(samples_per_record=256, records_per_acquisition=16,
+                             records_per_buffer=4, processors=[proc.Average()]),
+                        dict(samples_per_record=256, records_per_acquisition=16,
+                             records_per_buffer=4, channels_to_acquire="C")]
+        results = board.acquire_sequence(acquisitions)
+        (ave,) = next(results)
+        check_sawtooth(ave.get_result(), 8, 256)
+        # an exception handled by the caller doesn't replace the acquisition error
+        try:
+            raise KeyError()
+        except KeyError:
+            pass
+        try:
+            next(results)
+        except AlazarException:
+            pass
+        else:
+            assert False
+
+    def test_abandoned_sequence_removes_files(self):
+        board = MockAlazar(13)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            acquisitions = [dict(samples_per_record=256, records_per_acquisition=16,
+                                 records_per_buffer=4,
+                                 processors=[proc.Raw(shared=tmp_dir)])
+                            for _ in range(3)]
+            results = board.acquire_sequence(acquisitions)
+            next(results)
+            results.close()
+            # the second acquisition was collected, and the third never ran
+            assert os.listdir(tmp_dir) == []
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_failed_processor_removes_files(self):
+        (failing,) = MockAlazar(13).acquire(256, 64, 8, processors=[FailingProcessor()])
+        try:
+            failing.get_result()
+        except proc.ProcessorException:
+            pass
+        else:
+            assert False
+        assert not os.path.exists(failing.filename)
+
+    def test_acquire_until_converged(self):
+        board = MockAlazar(13)
+
+        # every mock record is the same, so the average converges immediately
+        (ave, raw) = board.acquire(256, 1024, 16,
+                                   processors=[proc.Average(target=1.0), proc.Raw()])
+
+        assert ave.records_processed < 1024
+        assert raw.records_processed == ave.records_processed
+        assert all(len(chan_dat) == raw.records_processed for chan_dat in raw.get_result())
+        check_sawtooth(ave.get_result(), 8, 256)
+
+    def test_preview(self):
+        board = MockAlazar(25)
+        preview = proc.Preview(n_points=1024)
+        try:
+            (preview,) = board.acquire(1024, 128, 32, processors=[preview])
+            result = preview.get_result()
+            # the worker published at least the first buffer
+            assert result["seq"] >= 1
+            check_sawtooth(result["mean"], 12, 1024)
+            check_sawtooth(result["min"], 12, 1024)
+            check_sawtooth(result["max"], 12, 1024)
+        finally:
+            preview.close()
+
+class TestPackage(object):
+
+    def test_star_import(self):
+        # in a fresh interpreter, where the board extension is not loaded yet
+        code = ("import alazar\n"
+                "assert 'Alazar' not in alazar.__all__\n"
+                "from alazar import *\n"
+                "MockAlazar(13)\n"
+                "assert 'alazar.board' not in sys.modules and 'board' not in sys.modules\n")
+        subprocess.check_call([sys.executable, "-c", "import sys\n" + code])
+
+# --- Helper functions
+
+class FailingProcessor(proc.BufferProcessor):
+    """Processor with a shared result which raises on the second buffer."""
+    def __init__(self):
+        super(FailingProcessor, self).__init__(shared=True)
+        self.filename = None
+
+    def initialize_proc(self, params):
+        self.result = self._result_array((params["records_per_acquisition"],), np.float)
+        self.filename = self.result.filename
+
+    def process(self, chan_bufs, buf_num):
+        if buf_num > 0:
+            raise ValueError("failed on buffer {}".format(buf_num))
+
+
+def check_sawtooth(chan_aves, bit_depth, samples_per_record, first_chan=0):
+    """Check channel averages against the mock sawtooth records."""
+    for (chan, chan_ave) in enumerate(chan_aves):
+        correct = np.fromiter(mock_record(samples_per_record, first_chan + chan == 1,
+                                          bit_depth),
+                              dtype=np.float)
+        assert (correct == chan_ave).all()
@@ -0,0 +1,67 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+
+import numpy as np
+
+import alazar.processor as proc
+from alazar import budget
+from alazar.board_common import def_acq_params
+from alazar.board_mock import MockAlazar
+from alazar.exceptions import AlazarException
+
+from nose.plugins.skip import SkipTest
+from nose.tools import raises
+
+class TestBudget(object):
+
+    def test_memory_plan(self):
+        params = def_acq_params(1024, 512, 64, 2, np.uint16, 12)
+        raw = proc.Raw()
+
+        plan = budget.memory_plan(params, [raw, proc.BufferProcessor()], 4)
+
+        assert plan["dma"] == 4*64*1024*2*2
+        assert plan["processors"] == 512*1024*2*2
+        # the buffer queue and the pickled raw data
+        assert plan["transport"] == plan["dma"] + plan["processors"]
+        assert plan["total"] == plan["dma"] + plan["transport"] + plan["processors"]
+
+    @raises(AlazarException)
+    def test_over_budget(self):
+        MockAlazar(13).acquire(1024, 1024, 64, processors=[proc.Raw()], buffer_count=4,
+                               memory_budget=2**20)
+
+    @raises(AlazarException)
+    def test_invalid_on_over_budget(self):
+        params = def_acq_params(1024, 512, 64, 2, np.uint8, 8)
+        budget.check_memory_budget(params, [proc.Raw()], 4, 2**30, on_over_budget="ignore")
+
+    def test_spill(self):
+        if budget.shared.is_ram_backed(budget.spill_dir()):
+            raise SkipTest("the temporary directory is in memory")
+        raw = proc.Raw()
+        (ave, raw) = MockAlazar(13).acquire(1024, 1024, 64,
+                                            processors=[proc.Average(), raw],
+                                            buffer_count=4, memory_budget=2**21,
+                                            on_over_budget="spill")
+
+        assert raw.shared == budget.spill_dir()
+        # the averages are small enough to stay in memory
+        assert not ave.shared
+        for (chan_dat, chan_ave) in zip(raw.get_result(), ave.get_result()):
+            assert (chan_dat == chan_ave).all()
+            # the spilled result is mapped from a file which is already removed
+            assert not os.path.exists(chan_dat.base.filename)
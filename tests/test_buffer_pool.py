@@ -0,0 +1,95 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import ctypes
+import ctypes.util
+import mmap
+
+import numpy as np
+from nose.plugins.skip import SkipTest
+
+import alazar.processor as proc
+from alazar.board_mock import MockAlazar
+from alazar.buffer_pool import BufferPool, HUGE_PAGE_SIZE
+
+class TestBufferPool(object):
+
+    def test_alignment(self):
+        for (huge_pages, alignment) in [(False, mmap.PAGESIZE), (True, HUGE_PAGE_SIZE)]:
+            yield self.check_alignment, huge_pages, alignment
+
+    def check_alignment(self, huge_pages, alignment):
+        pool = BufferPool(huge_pages)
+        bufs = pool.get(4, 3000, np.uint16)
+
+        assert len(bufs) == 4
+        for buf in bufs:
+            assert buf.dtype == np.uint16 and buf.shape == (3000,)
+            assert buf.ctypes.data % alignment == 0
+
+    def test_reuse(self):
+        pool = BufferPool()
+        bufs = pool.get(4, 4096, np.uint8)
+        size = pool.nbytes()
+
+        # a smaller geometry reuses the same memory
+        smaller = pool.get(2, 1024, np.uint16)
+        assert pool.nbytes() == size
+        assert smaller[0].ctypes.data == bufs[0].ctypes.data
+
+        # a larger one grows the pool to fit both
+        pool.get(8, 2048, np.uint8)
+        assert pool.nbytes() == 8*size/4
+
+    def test_prewarm_and_release(self):
+        pool = BufferPool()
+        pool.prewarm(4, 8192, np.uint8)
+        assert pool.nbytes() >= 4*8192
+
+        bufs = pool.get(4, 8192, np.uint8)
+        bufs[0][:] = 1
+        pool.release()
+        assert pool.nbytes() == 0
+        # buffers still referenced stay valid
+        assert (bufs[0] == 1).all()
+
+    def test_numa_node(self):
+        name = ctypes.util.find_library("numa")
+        if name is None or ctypes.CDLL(name).numa_available() < 0:
+            raise SkipTest("needs libnuma")
+        numa = ctypes.CDLL(name)
+        pool = BufferPool()
+        # the pages are already faulted in when the node is chosen
+        pool.prewarm(4, 8192, np.uint8)
+        pool.get(4, 8192, np.uint8, numa_node=0)
+
+        n_pages = pool.nbytes() / mmap.PAGESIZE
+        pages = (ctypes.c_void_p*n_pages)(*[pool._data.ctypes.data + i*mmap.PAGESIZE
+                                             for i in range(n_pages)])
+        status = (ctypes.c_int*n_pages)()
+        # without target nodes, move_pages reports the node of each page
+        assert numa.numa_move_pages(0, n_pages, pages, None, status, 0) == 0
+        assert list(status) == [0]*n_pages
+
+    def test_mock_reuses_buffer(self):
+        board = MockAlazar(13)
+        board.prewarm_buffers(256, 8)
+        buf = board._mock_buffer(256, 8, "all")
+
+        (ave,) = board.acquire(256, 64, 8, processors=[proc.Average()])
+        ave.get_result()
+        assert board._mock_buffer(256, 8, "all") is buf
+
+        board.release_buffers()
+        assert board._mock_buffer(256, 8, "all") is not buf
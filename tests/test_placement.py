@@ -0,0 +1,60 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+
+import alazar.processor as proc
+from alazar.board_mock import MockAlazar
+from alazar.exceptions import AlazarException
+from alazar.placement import Placement, apply_placement, get_affinity
+
+from nose.tools import raises
+
+class TestPlacement(object):
+
+    def test_apply_and_restore(self):
+        cpus = get_affinity()
+        restore = apply_placement(Placement(cpus=cpus[:1]))
+        try:
+            assert get_affinity() == cpus[:1]
+        finally:
+            restore()
+        assert get_affinity() == cpus
+
+    @raises(AlazarException)
+    def test_invalid_cpu(self):
+        apply_placement(Placement(cpus=[-1]))
+
+    def test_acquire(self):
+        board = MockAlazar(13)
+        cpus = get_affinity()
+
+        (ave,) = board.acquire(256, 64, 8, processors=[proc.Average()],
+                               acquisition_placement=Placement(cpus=cpus[:1]),
+                               processing_placement=Placement(cpus=cpus[-1:]))
+        ave.get_result()
+        # the acquiring process is restored afterwards
+        assert get_affinity() == cpus
+
+        telemetry = board.get_telemetry()
+        assert telemetry["buffers"] == 8
+        assert len(telemetry["intervals"]) == 7
+        assert telemetry["max_interval"] >= telemetry["mean_interval"]
+        assert not np.isnan(telemetry["jitter"])
+
+    @raises(proc.ProcessorException)
+    def test_invalid_processing_placement(self):
+        (ave,) = MockAlazar(13).acquire(256, 64, 8, processors=[proc.Average()],
+                                        processing_placement=Placement(cpus=[-1]))
+        ave.get_result()
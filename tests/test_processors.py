@@ -12,13 +12,21 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import gc
+import os
+
 import alazar.processor as proc
+from alazar import shared
 from alazar.processor import ProcessorException
-from alazar.board import def_acq_params
+from alazar.board_common import def_acq_params, AcquisitionPlan
+from alazar.preview import PreviewSlot
+from alazar.process import _ChannelBuffers, _sample_window
 
+from nose.plugins.skip import SkipTest
 from nose.tools import raises
 
 import numpy as np
+import cPickle as pickle
 
 # some fake but realistic acquisition parameters
 def mock_acq_params():
@@ -62,7 +70,13 @@ class TestAllProcessors(object):
         processors.append(proc.Average())
         processors.append(proc.Raw())
         processors.append(proc.AverageN(1))
+        processors.append(proc.HeraldedAverageN(1, 0, 1, 0))
+        processors.append(proc.AlignedAverageN(1))
         processors.append(proc.Chunk(1,0,1))
+        processors.append(proc.Decimate(1))
+        processors.append(proc.PowerSpectrum())
+        processors.append(proc.Correlation())
+        processors.append(proc.Statistics())
 
         return processors
 
@@ -112,6 +126,64 @@ class TestAverage(object):
 
             assert (chan_aves[chan] == dat[chan]).all()
 
+    def test_accumulate(self):
+        params = mock_acq_params()
+
+        ave = proc.Average(accumulate=True)
+
+        bufs = buffers_random(params, 0, 255)
+        other_bufs = buffers_random(params, 0, 255, seed=1)
+
+        emulate_acq(params, bufs, ave)
+        emulate_acq(params, other_bufs, ave)
+
+        raw_dat = [np.concatenate(chan_dats) for chan_dats in
+                   zip(bufs_to_raw_array(bufs, params), bufs_to_raw_array(other_bufs, params))]
+
+        for (chan_dat, result) in zip(raw_dat, ave.get_result()):
+            assert np.allclose(np.mean(chan_dat, axis=0), result)
+
+        # after a reset only the next acquisition is averaged
+        ave.reset()
+        emulate_acq(params, bufs, ave)
+
+        for (chan_dat, result) in zip(bufs_to_raw_array(bufs, params), ave.get_result()):
+            assert np.allclose(np.mean(chan_dat, axis=0), result)
+
+    @raises(ProcessorException)
+    def test_accumulate_different_records(self):
+        params = mock_acq_params()
+
+        ave = proc.Average(accumulate=True)
+
+        emulate_acq(params, buffers_same_val(params, 1), ave)
+
+        params = def_acq_params(512, 128, 64, 2, np.uint8, 8)
+        emulate_acq(params, buffers_same_val(params, 1), ave)
+
+        ave.get_result()
+
+    def test_convergence(self):
+        params = mock_acq_params()
+        bufs = buffers_random(params, 0, 255)
+        raw_dat = bufs_to_raw_array(bufs, params)
+        std_err = max(np.max(np.std(chan_dat.astype(np.float), axis=0, ddof=1))
+                      for chan_dat in raw_dat) / np.sqrt(params["records_per_acquisition"])
+
+        # without a target there is no metric to converge on
+        ave = proc.Average()
+        emulate_acq(params, bufs, ave)
+        assert ave.convergence() is None
+        assert not ave.converged()
+
+        ave = proc.Average(target=std_err*1.01)
+        emulate_acq(params, bufs, ave)
+        assert np.allclose(std_err, ave.convergence())
+        assert ave.converged()
+
+        ave.target = std_err*0.99
+        assert not ave.converged()
+
 # --- tests for Raw processor
 
 class TestRaw(object):
@@ -166,6 +238,16 @@ class TestAverageN(object):
         for val in n_vals:
             yield self.check_process_for_n_val, val, mock_acq_params()
 
+        # buffers which do not start with the first record type
+        params = def_acq_params(samples_per_record=1024,
+                                records_per_acquisition=96,
+                                records_per_buffer=8,
+                                channel_count=2,
+                                dtype=np.uint8,
+                                bit_depth=8)
+        for val in [3, 12]:
+            yield self.check_process_for_n_val, val, params
+
     def check_process_for_n_val(self, n_val, params):
 
         ave_n = proc.AverageN(n_val)
@@ -190,6 +272,146 @@ class TestAverageN(object):
 
             assert (correct == returned).all()
 
+    def test_accumulate(self):
+        params = mock_acq_params()
+        n_rec_types = 4
+
+        ave_n = proc.AverageN(n_rec_types, accumulate=True)
+
+        bufs = buffers_random(params, 0, 255)
+        other_bufs = buffers_random(params, 0, 255, seed=1)
+
+        emulate_acq(params, bufs, ave_n)
+        emulate_acq(params, other_bufs, ave_n)
+
+        raw_dat = [np.concatenate(chan_dats) for chan_dats in
+                   zip(bufs_to_raw_array(bufs, params), bufs_to_raw_array(other_bufs, params))]
+
+        for (chan_dat, result) in zip(raw_dat, ave_n.get_result()):
+            for rec_type in range(n_rec_types):
+                assert np.allclose(np.mean(chan_dat[rec_type::n_rec_types], axis=0),
+                                   result[rec_type])
+
+# --- tests for HeraldedAverageN processor
+
+class TestHeraldedAverageN(object):
+
+    @raises(ProcessorException)
+    def test_invalid_window(self):
+        proc.HeraldedAverageN(2, 10, 10, 0)
+
+    @raises(ProcessorException)
+    def test_herald_chan_not_acquired(self):
+        params = mock_acq_params()
+        herald = proc.HeraldedAverageN(2, 0, 10, 0, herald_chan=2)
+        emulate_acq(params, buffers_same_val(params, 1), herald)
+        herald.get_result()
+
+    def test_process(self):
+        for previous_record in [False, True]:
+            for accept_above in [False, True]:
+                yield self.check_process, previous_record, accept_above
+
+    def check_process(self, previous_record, accept_above):
+        params = def_acq_params(256, 96, 16, 2, np.uint8, 8)
+        n_rec_types = 3
+        herald = proc.HeraldedAverageN(n_rec_types, 20, 40, 127.5, herald_chan=1,
+                                       previous_record=previous_record,
+                                       accept_above=accept_above)
+
+        bufs = buffers_random(params, 0, 255)
+        emulate_acq(params, bufs, herald)
+
+        raw_dat = bufs_to_raw_array(bufs, params)
+        integrals = np.mean(raw_dat[1][:,20:40], axis=1)
+        passed = integrals > 127.5 if accept_above else integrals < 127.5
+        if previous_record:
+            passed = np.concatenate(([False], passed[:-1]))
+        rec_types = np.arange(params["records_per_acquisition"]) % n_rec_types
+
+        for (chan_dat, result) in zip(raw_dat, herald.get_result()):
+            for rec_type in range(n_rec_types):
+                accepted = chan_dat[passed & (rec_types == rec_type)]
+                assert np.allclose(np.mean(accepted, axis=0), result[rec_type])
+        acceptance = [np.mean(passed[rec_types == rec_type]) for rec_type in range(n_rec_types)]
+        assert np.allclose(acceptance, herald.get_acceptance())
+
+    def test_none_accepted(self):
+        params = mock_acq_params()
+        herald = proc.HeraldedAverageN(2, 0, 10, 2)
+        emulate_acq(params, buffers_same_val(params, 1), herald)
+
+        assert np.isnan(herald.get_result()[0]).all()
+        assert (herald.get_acceptance() == 0).all()
+
+# --- tests for AlignedAverageN processor
+
+class TestAlignedAverageN(object):
+
+    def make_bufs(self, params, offsets, template):
+        """Return buffers of the template delayed by offsets; channel B is inverted."""
+        spr = params["samples_per_record"]
+        freqs = np.fft.rfftfreq(spr)
+        recs = np.fft.irfft(np.fft.rfft(template)[np.newaxis,:] *
+                            np.exp(-2j*np.pi*freqs[np.newaxis,:]*offsets[:,np.newaxis]),
+                            spr, axis=1)
+        chans = [np.round(recs), np.round(4000 - recs)]
+        rpb = params["records_per_buffer"]
+        return [[chan[i*rpb:(i+1)*rpb].astype(params["dtype"]) for chan in chans]
+                for i in range(params["buffers_per_acquisition"])]
+
+    def pulse(self, spr, width):
+        return 100 + 3000*np.exp(-0.5*((np.arange(spr) - spr/2) / float(width))**2)
+
+    def test_invalid_max_shift(self):
+        aligned = proc.AlignedAverageN(1, max_shift=128)
+        aligned.initialize(def_acq_params(256, 8, 4, 2, np.uint16, 12))
+        assert aligned.error is not None
+
+    def test_integer_offsets(self):
+        params = def_acq_params(256, 64, 16, 2, np.uint16, 12)
+        np.random.seed(0)
+        offsets = np.random.randint(-5, 6, 64)
+        template = np.round(self.pulse(256, 3))
+        aligned = proc.AlignedAverageN(2, template=template, max_shift=8)
+        emulate_acq(params, self.make_bufs(params, offsets, template), aligned)
+
+        (chan_a, chan_b) = aligned.get_result()
+        assert np.allclose(chan_a, template[np.newaxis,:])
+        assert np.allclose(chan_b, 4000 - template[np.newaxis,:])
+        (lags, counts) = aligned.get_offset_histogram()
+        assert (lags == np.arange(-8, 9)).all()
+        assert (counts == np.bincount(offsets + 8, minlength=17)).all()
+
+    def test_subsample_offsets(self):
+        params = def_acq_params(256, 64, 8, 2, np.uint16, 12)
+        np.random.seed(1)
+        offsets = np.random.uniform(-4, 4, 64)
+        template = self.pulse(256, 6)
+        bufs = self.make_bufs(params, offsets, template)
+
+        aligned = proc.AlignedAverageN(1, template=template, subsample=True)
+        ave = proc.Average()
+        emulate_acq(params, bufs, [aligned, ave])
+
+        error = np.max(np.abs(aligned.get_result()[0][0] - template))
+        blurred = np.max(np.abs(ave.get_result()[0] - template))
+        assert error < 0.01*3000
+        assert error < blurred / 10
+        assert aligned.get_offset_histogram()[1].sum() == 64
+
+    def test_template_from_first_buffer(self):
+        params = def_acq_params(256, 32, 8, 2, np.uint16, 12)
+        offsets = np.zeros(32, np.int64)
+        offsets[8:] = 3
+        template = np.round(self.pulse(256, 3))
+        aligned = proc.AlignedAverageN(1)
+        emulate_acq(params, self.make_bufs(params, offsets, template), aligned)
+        assert np.allclose(aligned.get_result()[0][0], template)
+        assert aligned.get_offset_histogram()[1][16 + 3] == 24
+
+# --- tests for Chunk processor
+
 class TestChunk(object):
 
     @raises(ProcessorException)
@@ -251,10 +473,519 @@ class TestChunk(object):
             assert (result_chan == correct_result_chan).all()
 
 
+# --- tests for Decimate processor
+
+class TestDecimate(object):
+
+    @raises(ProcessorException)
+    def test_zero_factor(self):
+        proc.Decimate(0)
+
+    @raises(ProcessorException)
+    def test_record_not_divisible_by_factor(self):
+        params = mock_acq_params()
+        assert params["samples_per_record"] % 3 != 0
+
+        dec = proc.Decimate(3)
+
+        emulate_acq(params, buffers_same_val(params, 1), dec)
+
+        dec.get_result()
+
+    def test_boxcar(self):
+        params = mock_acq_params()
+        factor = 8
+
+        dec = proc.Decimate(factor)
+
+        bufs = buffers_random(params, 0, 255)
+
+        raw_dat = bufs_to_raw_array(bufs, params)
+
+        emulate_acq(params, bufs, dec)
+
+        for (chan_dat, result) in zip(raw_dat, dec.get_result()):
+            correct = np.mean(chan_dat.reshape(params["records_per_acquisition"], -1, factor),
+                              axis=2)
+            assert np.allclose(correct, result)
+
+    def test_continuous_fir(self):
+        params = mock_acq_params()
+        factor = 4
+        taps = [0.1, 0.2, 0.3, 0.2, 0.1, 0.05]
+
+        dec = proc.Decimate(factor, taps=taps, continuous=True)
+
+        bufs = buffers_random(params, 0, 255)
+
+        raw_dat = bufs_to_raw_array(bufs, params)
+
+        emulate_acq(params, bufs, dec)
+
+        for (chan_dat, result) in zip(raw_dat, dec.get_result()):
+            # filter the whole acquisition as one stream
+            filtered = np.convolve(chan_dat.ravel().astype(np.float), taps)
+            correct = filtered[factor-1:chan_dat.size:factor]
+            assert np.allclose(correct, result.ravel())
+
+    def test_average(self):
+        params = mock_acq_params()
+        factor = 16
+        n_rec_types = 4
+
+        dec = proc.Decimate(factor, n_rec_types=n_rec_types)
+
+        bufs = buffers_random(params, 0, 255)
+
+        raw_dat = bufs_to_raw_array(bufs, params)
+
+        emulate_acq(params, bufs, dec)
+
+        for (chan_dat, result) in zip(raw_dat, dec.get_result()):
+            decimated = np.mean(chan_dat.reshape(params["records_per_acquisition"], -1, factor),
+                                axis=2)
+            for rec_type in range(n_rec_types):
+                assert np.allclose(np.mean(decimated[rec_type::n_rec_types], axis=0),
+                                   result[rec_type])
 
+# --- tests for PowerSpectrum processor
+
+class TestPowerSpectrum(object):
+
+    @raises(ProcessorException)
+    def test_unknown_window(self):
+        proc.PowerSpectrum(window="not a window")
+
+    @raises(ProcessorException)
+    def test_cross_spectrum_not_requested(self):
+        params = mock_acq_params()
+
+        spec = proc.PowerSpectrum()
+
+        emulate_acq(params, buffers_same_val(params, 1), spec)
+
+        spec.get_cross_spectrum()
+
+    def test_process(self):
+        for n_rec_types in [1, 2, 16]:
+            for window in ["boxcar", "hann"]:
+                yield self.check_process, n_rec_types, window, mock_acq_params()
+
+    def check_process(self, n_rec_types, window, params):
+
+        spec = proc.PowerSpectrum(n_rec_types, window=window, cross_spectrum=True)
+
+        bufs = buffers_random(params, 0, 255)
+
+        raw_dat = bufs_to_raw_array(bufs, params)
+
+        emulate_acq(params, bufs, spec)
+
+        window_vals = proc.PowerSpectrum.windows[window](params["samples_per_record"])
+        norm = np.sum(window_vals**2)
+        ffts = [np.fft.rfft(chan_dat*window_vals, axis=1) for chan_dat in raw_dat]
+
+        for (chan_fft, result) in zip(ffts, spec.get_result()):
+            for rec_type in range(n_rec_types):
+                correct = np.mean(np.abs(chan_fft[rec_type::n_rec_types])**2, axis=0) / norm
+                assert np.allclose(correct, result[rec_type])
+
+        cross = ffts[0] * np.conj(ffts[1])
+        result = spec.get_cross_spectrum()
+        for rec_type in range(n_rec_types):
+            correct = np.mean(cross[rec_type::n_rec_types], axis=0) / norm
+            assert np.allclose(correct, result[rec_type])
+
+# --- tests for Correlation processor
+
+class TestCorrelation(object):
+
+    @raises(ProcessorException)
+    def test_one_channel(self):
+        params = def_acq_params(1024, 128, 64, 1, np.uint8, 8)
+
+        corr = proc.Correlation()
+
+        emulate_acq(params, buffers_same_val(params, 1), corr)
+
+        corr.get_result()
+
+    def test_process(self):
+        for n_rec_types in [1, 2, 16]:
+            yield self.check_process, n_rec_types, mock_acq_params()
+
+    def check_process(self, n_rec_types, params):
+
+        corr = proc.Correlation(n_rec_types)
+
+        bufs = buffers_random(params, 0, 255)
+
+        (dat_a, dat_b) = [chan_dat.astype(np.float)
+                          for chan_dat in bufs_to_raw_array(bufs, params)]
+
+        emulate_acq(params, bufs, corr)
+
+        result = corr.get_result()
+
+        for rec_type in range(n_rec_types):
+            (rec_a, rec_b) = (dat_a[rec_type::n_rec_types], dat_b[rec_type::n_rec_types])
+            assert np.allclose(np.mean(rec_a, axis=0), result["mean"][0][rec_type])
+            assert np.allclose(np.mean(rec_b, axis=0), result["mean"][1][rec_type])
+            assert np.allclose(np.mean(rec_a*rec_b, axis=0), result["correlation"][rec_type])
+            for sample in [0, 100, params["samples_per_record"] - 1]:
+                correct = np.cov(rec_a[:,sample], rec_b[:,sample])
+                assert np.allclose(correct, result["covariance"][rec_type, sample])
+
+# --- tests for Statistics processor
+
+class TestStatistics(object):
+
+    def test_process(self):
+        for n_rec_types in [1, 2, 16]:
+            yield self.check_process, n_rec_types, mock_acq_params()
+
+    def check_process(self, n_rec_types, params):
+
+        stats = proc.Statistics(n_rec_types)
+
+        bufs = buffers_random(params, 0, 255)
+
+        raw_dat = bufs_to_raw_array(bufs, params)
+
+        emulate_acq(params, bufs, stats)
+
+        result = stats.get_result()
+
+        assert (result["count"] == params["records_per_acquisition"] / n_rec_types).all()
+        check_stats(raw_dat, result, n_rec_types)
+
+    def test_merge(self):
+        params = mock_acq_params()
+        n_rec_types = 4
+
+        bufs = buffers_random(params, 0, 255)
+        other_bufs = buffers_random(params, 50, 100, seed=1)
+
+        stats = proc.Statistics(n_rec_types)
+        emulate_acq(params, bufs, stats)
+
+        other_stats = proc.Statistics(n_rec_types)
+        emulate_acq(params, other_bufs, other_stats)
+
+        result = stats.merge(other_stats).get_result()
+
+        # the merged statistics should match those of all records
+        raw_dat = [np.concatenate(chan_dats) for chan_dats in
+                   zip(bufs_to_raw_array(bufs, params), bufs_to_raw_array(other_bufs, params))]
+
+        assert (result["count"] == 2*params["records_per_acquisition"] / n_rec_types).all()
+        check_stats(raw_dat, result, n_rec_types)
+
+    @raises(ProcessorException)
+    def test_merge_incompatible(self):
+        params = mock_acq_params()
+
+        stats = proc.Statistics(1)
+        emulate_acq(params, buffers_same_val(params, 1), stats)
+
+        other_stats = proc.Statistics(2)
+        emulate_acq(params, buffers_same_val(params, 1), other_stats)
+
+        stats.merge(other_stats)
+
+# --- tests for Preview processor
+
+class TestPreview(object):
+
+    def setup(self):
+        self.preview = None
+
+    def teardown(self):
+        if self.preview is not None:
+            self.preview.close()
+
+    def test_envelope(self):
+        params = mock_acq_params()
+        self.preview = proc.Preview(n_points=100, max_rate=1e-3, records=16)
+        bufs = buffers_random(params, 0, 255)
+        emulate_acq(params, bufs, self.preview)
+
+        # only the first buffer is published at this rate
+        assert self.preview.n_published == 1
+        envelope = PreviewSlot(self.preview.filename).read()
+        assert envelope["buf_num"] == 0
+        assert envelope["records"] == 16
+        edges = np.linspace(0, params["samples_per_record"], 101).astype(int)
+        for (chan, chan_buf) in enumerate(bufs[0]):
+            recs = chan_buf[-16:]
+            for point in range(100):
+                block = recs[:,edges[point]:edges[point+1]]
+                assert envelope["min"][chan][point] == np.min(block)
+                assert envelope["max"][chan][point] == np.max(block)
+                assert np.allclose(envelope["mean"][chan][point], np.mean(block))
+
+    def test_rate(self):
+        params = mock_acq_params()
+        self.preview = proc.Preview(n_points=2048, max_rate=1e9)
+        emulate_acq(params, buffers_same_val(params, 7), self.preview)
+        assert self.preview.n_published == params["buffers_per_acquisition"]
+        result = self.preview.get_result()
+        # no more points than samples
+        assert len(result["min"][0]) == params["samples_per_record"]
+        assert result["buf_num"] == params["buffers_per_acquisition"] - 1
+        assert result["seq"] == params["buffers_per_acquisition"]
+        assert (result["mean"][1] == 7).all()
+
+    def test_nothing_published(self):
+        self.preview = proc.Preview()
+        # the slot file is only created by an acquisition
+        assert not os.path.exists(self.preview.filename)
+        assert self.preview.get_result() is None
+        self.preview.initialize(mock_acq_params())
+        assert PreviewSlot(self.preview.filename).read() is None
+
+    def test_pickle(self):
+        params = mock_acq_params()
+        self.preview = proc.Preview()
+        self.preview.initialize(params)
+        copied = pickle.loads(pickle.dumps(self.preview, pickle.HIGHEST_PROTOCOL))
+        assert copied._slot is None
+        assert copied.filename == self.preview.filename
+
+    @raises(ProcessorException)
+    def test_abort(self):
+        self.preview = proc.Preview()
+        self.preview.abort(Exception())
+        self.preview.get_result()
+
+# --- tests for returning results through shared memory
+
+class TestSharedResults(object):
+
+    def test_pickle(self):
+        params = mock_acq_params()
+        procs = [proc.Raw(shared=True), proc.Chunk(4, 0, 10, shared=True),
+                 proc.Decimate(8, shared=True)]
+
+        bufs = buffers_random(params, 0, 255)
+
+        emulate_acq(params, bufs, procs)
+
+        for processor in procs:
+            pickled = pickle.dumps(processor, pickle.HIGHEST_PROTOCOL)
+            # only handles to the result files are pickled
+            assert len(pickled) < 4096
+            unpickled = pickle.loads(pickled)
+            for (correct, result) in zip(processor.get_result(), unpickled.get_result()):
+                assert (correct == result).all()
+
+    def test_pickle_unpickled(self):
+        params = mock_acq_params()
+        raw = proc.Raw(shared=True)
+
+        emulate_acq(params, buffers_random(params, 0, 255), raw)
+
+        unpickled = pickle.loads(pickle.dumps(raw, pickle.HIGHEST_PROTOCOL))
+        # the files were removed when unpickled, so this pickles the data
+        again = pickle.loads(pickle.dumps(unpickled, pickle.HIGHEST_PROTOCOL))
+        for (correct, result) in zip(raw.get_result(), again.get_result()):
+            assert (correct == result).all()
+
+    def test_remove_owned_files(self):
+        arr = shared.shared_empty((16,), np.float)
+        unpickled = shared.shared_empty((16,), np.float)
+        shared.unpack(shared.pack(unpickled))
+        # only the file nobody else mapped is still owned
+        assert arr.filename in shared._owned_files
+        assert unpickled.filename not in shared._owned_files
+        shared.remove_owned_files()
+        assert not os.path.exists(arr.filename)
+
+    def test_remove_when_unmapped(self):
+        # emulate Windows, which refuses to remove a file while it is mapped
+        remove = os.remove
+        refused = set()
+        def remove_unless_mapped(filename):
+            if filename not in refused:
+                refused.add(filename)
+                raise OSError("{} is mapped".format(filename))
+            remove(filename)
+
+        arr = shared.shared_empty((16,), np.float)
+        arr[:] = 3
+        os.remove = remove_unless_mapped
+        try:
+            unpacked = shared.unpack(shared.pack(arr[4:]))
+            assert os.path.exists(arr.filename)
+            assert arr.filename in shared._unmap_refs
+            # the file is going away, so the unpacked array is pickled in full
+            assert shared.to_handle(unpacked) is None
+            view = unpacked[2:]
+            del unpacked
+            gc.collect()
+            # the view still maps the file
+            assert os.path.exists(arr.filename)
+            assert (view == 3).all()
+            del view
+            gc.collect()
+            assert not os.path.exists(arr.filename)
+            assert arr.filename not in shared._owned_files
+            assert arr.filename not in shared._unmap_refs
+        finally:
+            os.remove = remove
+
+# --- tests for the worker's channel extraction
+
+class TestChannelBuffers(object):
+
+    def test_window(self):
+        params = def_acq_params(256, 8, 8, 2, np.uint16, 12)
+        plan = AcquisitionPlan(params)
+        np.random.seed(0)
+        buf = (np.random.randint(0, 2**12, 8*256*2) << 4).astype(np.uint16)
+        chunks = [proc.Chunk(1, 10, 20), proc.Chunk(1, 15, 40)]
+
+        chan_bufs = _ChannelBuffers(buf, plan, _sample_window(chunks))
+        windowed = chan_bufs.window(1, 15, 40)
+        # reading a window does not extract the whole channel
+        assert chan_bufs._chans == [None, None]
+
+        full = [chan_dat >> 4 for chan_dat in np.swapaxes(buf.reshape(plan.buffer_shape), 0, 2)]
+        assert (windowed == full[1].T[:,15:40]).all()
+        for chan in range(2):
+            assert (chan_bufs[chan] == full[chan].T).all()
+            assert (chan_bufs.window(chan, 10, 20) == full[chan].T[:,10:20]).all()
+
+    def test_slice(self):
+        params = def_acq_params(256, 8, 8, 2, np.uint16, 12)
+        plan = AcquisitionPlan(params)
+        buf = (np.arange(8*256*2) % 2**12 << 4).astype(np.uint16)
+        chan_bufs = _ChannelBuffers(buf, plan)
+        # processors may slice the channels like the list they replace
+        assert len(chan_bufs[:]) == 2
+        assert len(chan_bufs[1:]) == 1
+        assert (chan_bufs[::-1][0] == chan_bufs[1]).all()
+        assert chan_bufs[5:] == []
+
+# --- tests for batched processing
+
+class TestBatch(object):
+
+    def test_same_as_single_buffers(self):
+        # fewer records per buffer than record types
+        params = def_acq_params(256, 60, 3, 2, np.uint16, 12)
+        plan = AcquisitionPlan(params)
+        np.random.seed(0)
+        bufs = [(np.random.randint(0, 2**12, 3*256*2) << 4).astype(np.uint16)
+                for _ in range(params["buffers_per_acquisition"])]
+        batch_sizes = [1, 4, 2, 5, 8]
+
+        def run(batched):
+            procs = [proc.Raw(), proc.Average(target=1.0), proc.AverageN(5),
+                     proc.HeraldedAverageN(5, 0, 16, 2**11, previous_record=True),
+                     proc.AlignedAverageN(5, max_shift=8),
+                     proc.AlignedAverageN(5, subsample=True),
+                     proc.Chunk(5, 10, 74), proc.Statistics(5),
+                     proc.Decimate(4, n_rec_types=5), proc.PowerSpectrum(5),
+                     proc.Correlation(5)]
+            for processor in procs:
+                processor.initialize(params, plan)
+            window = _sample_window(procs)
+            if batched:
+                buf_num = 0
+                for n_bufs in batch_sizes:
+                    batch = np.concatenate(bufs[buf_num:buf_num+n_bufs])
+                    chan_bufs = _ChannelBuffers(batch, plan, window, n_bufs)
+                    for processor in procs:
+                        processor.process_batch(chan_bufs, buf_num, n_bufs)
+                    buf_num += n_bufs
+            else:
+                for (buf_num, buf) in enumerate(bufs):
+                    chan_bufs = _ChannelBuffers(buf, plan, window)
+                    for processor in procs:
+                        processor.process(chan_bufs, buf_num)
+            for processor in procs:
+                processor.post_process()
+            return procs
+
+        for (batched, single) in zip(run(True), run(False)):
+            check_same_result(batched.get_result(), single.get_result())
+
+    def test_split_lists(self):
+        params = def_acq_params(16, 8, 2, 2, np.uint8, 8)
+        bufs = buffers_random(params, 0, 255)
+        batch = [np.concatenate([buf[chan] for buf in bufs]) for chan in range(2)]
+        single = proc.AverageN(4)
+        single.initialize(params)
+        run_process(bufs, single)
+        batched = proc.AverageN(4)
+        batched.initialize(params)
+        # the base class falls back to process for each buffer
+        proc.BufferProcessor.process_batch(batched, batch, 0, 4)
+        check_same_result(batched.get_result(), single.get_result())
+
+# --- tests for the compiled kernels
+
+class TestKernels(object):
+
+    def test_same_as_numpy(self):
+        if proc.kernels is None:
+            raise SkipTest("the kernels are not built")
+        for (dtype, bit_depth) in [(np.uint8, 8), (np.uint16, 12)]:
+            yield self.check_same_as_numpy, dtype, bit_depth
+
+    def check_same_as_numpy(self, dtype, bit_depth):
+        params = def_acq_params(256, 60, 12, 2, dtype, bit_depth)
+        plan = AcquisitionPlan(params)
+        np.random.seed(0)
+        bufs = [(np.random.randint(0, 2**bit_depth, 12*256*2) << plan.shift).astype(dtype)
+                for _ in range(params["buffers_per_acquisition"])]
+
+        def run(use_kernels):
+            procs = [proc.Average(target=1.0), proc.AverageN(5, target=1.0),
+                     proc.Chunk(1, 10, 74)]
+            kernels = proc.kernels
+            if not use_kernels:
+                proc.kernels = None
+            try:
+                for processor in procs:
+                    processor.initialize(params, plan)
+                for (buf_num, buf) in enumerate(bufs):
+                    chan_bufs = _ChannelBuffers(buf, plan, _sample_window(procs))
+                    for processor in procs:
+                        processor.process(chan_bufs, buf_num)
+            finally:
+                proc.kernels = kernels
+            return procs
+
+        for (compiled, numpy) in zip(run(True), run(False)):
+            for (result, correct) in zip(compiled.get_result(), numpy.get_result()):
+                assert np.allclose(result, correct)
+            assert np.allclose(compiled.convergence() or 0, numpy.convergence() or 0)
 
 # --- Helper functions
 
+def check_same_result(result, correct):
+    if isinstance(result, dict):
+        assert sorted(result) == sorted(correct)
+        for key in result:
+            check_same_result(result[key], correct[key])
+    elif isinstance(result, (list, tuple)):
+        assert len(result) == len(correct)
+        for (res, cor) in zip(result, correct):
+            check_same_result(res, cor)
+    else:
+        assert np.allclose(result, correct, equal_nan=True)
+
+def check_stats(raw_dat, result, n_rec_types):
+    for (chan, chan_dat) in enumerate(raw_dat):
+        for rec_type in range(n_rec_types):
+            recs = chan_dat[rec_type::n_rec_types].astype(np.float)
+            assert np.allclose(np.mean(recs, axis=0), result["mean"][chan][rec_type])
+            assert np.allclose(np.var(recs, axis=0, ddof=1), result["variance"][chan][rec_type])
+            assert (np.min(recs, axis=0) == result["min"][chan][rec_type]).all()
+            assert (np.max(recs, axis=0) == result["max"][chan][rec_type]).all()
+
 def bufs_to_raw_array(bufs, params):
 
     raw_dat = [np.empty((params["records_per_acquisition"], params["samples_per_record"]),
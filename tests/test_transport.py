@@ -0,0 +1,174 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import cPickle as pickle
+import os
+import select
+import shutil
+import socket
+import tempfile
+import threading
+
+import numpy as np
+
+import alazar.processor as proc
+from alazar.board_mock import MockAlazar
+from alazar.exceptions import AlazarException
+from alazar.transport import (ProcessingServer, RemoteTransport, _ServerLink, _ACK, _ANSWER,
+                              _BUFFER, _CHALLENGE, _FAILURE, _START, _recv_frame,
+                              _send_frame)
+
+from nose.tools import raises
+
+AUTHKEY = "test key"
+
+class TestRemoteTransport(object):
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.servers = [ProcessingServer(os.path.join(self.tmp_dir, "server{}".format(i)),
+                                         AUTHKEY)
+                        for i in range(2)]
+        self.servers.append(ProcessingServer(("127.0.0.1", 0), AUTHKEY))
+        self.threads = [threading.Thread(target=server.serve_forever)
+                        for server in self.servers]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def teardown(self):
+        for (server, thread) in zip(self.servers, self.threads):
+            server.close()
+            thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def make_procs(self):
+        return [proc.Average(), proc.AverageN(4), proc.Raw(), proc.Chunk(2, 10, 20),
+                proc.Statistics(2)]
+
+    def test_same_as_local(self):
+        board = MockAlazar(25)
+        transport = RemoteTransport([server.address for server in self.servers], AUTHKEY,
+                                    window=2)
+        remote = board.acquire(256, 64, 4, processors=self.make_procs(), transport=transport)
+        local = board.acquire(256, 64, 4, processors=self.make_procs())
+        assert len(remote) == len(local)
+        for (remote_proc, local_proc) in zip(remote, local):
+            assert type(remote_proc) == type(local_proc)
+            check_same_result(remote_proc.get_result(), local_proc.get_result())
+
+    def test_sequence(self):
+        board = MockAlazar(13)
+        transport = RemoteTransport([server.address for server in self.servers[:2]],
+                                    AUTHKEY)
+        acquisitions = [dict(samples_per_record=256, records_per_acquisition=32,
+                             records_per_buffer=8, processors=[proc.Average(), proc.Raw()],
+                             transport=transport)
+                        for _ in range(3)]
+        results = list(board.acquire_sequence(acquisitions))
+        assert len(results) == 3
+        for (ave, raw) in results:
+            assert np.allclose(ave.get_result()[0], np.mean(raw.get_result()[0], axis=0))
+
+    def test_until_converged(self):
+        board = MockAlazar(13)
+        transport = RemoteTransport([server.address for server in self.servers], AUTHKEY,
+                                    window=1)
+        (ave, raw) = board.acquire(256, 4096, 8, processors=[proc.Average(target=1.0),
+                                                             proc.Raw()],
+                                   transport=transport)
+        assert ave.converged()
+        assert ave.records_processed < 4096
+        # the other server stops when it is told no more buffers are coming
+        assert raw.records_processed <= 4096
+        assert len(raw.get_result()[0]) == raw.records_processed
+
+    @raises(AlazarException)
+    def test_no_server(self):
+        transport = RemoteTransport([os.path.join(self.tmp_dir, "missing")], AUTHKEY)
+        MockAlazar(13).acquire(256, 64, 8, processors=[proc.Average()], transport=transport)
+
+    @raises(AlazarException)
+    def test_wrong_authkey(self):
+        transport = RemoteTransport([self.servers[0].address], "wrong key")
+        MockAlazar(13).acquire(256, 64, 8, processors=[proc.Average()], transport=transport)
+
+    def test_no_unpickling_before_authentication(self):
+        marker = os.path.join(self.tmp_dir, "unpickled")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.servers[0].address)
+            assert _recv_frame(sock)[0] == _CHALLENGE
+            # a pickle which creates a file when it is loaded
+            _send_frame(sock, _START, pickle.dumps(CreateFile(marker)))
+            # the server hangs up without reading the payload
+            assert select.select([sock], [], [], 5)[0]
+            try:
+                assert sock.recv(1) == b""
+            except socket.error:
+                # reset, since the payload was never read
+                pass
+        finally:
+            sock.close()
+        assert not os.path.exists(marker)
+
+    def test_wrong_answer(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.servers[0].address)
+            assert _recv_frame(sock)[0] == _CHALLENGE
+            _send_frame(sock, _ANSWER, b"x"*32)
+            assert _recv_frame(sock)[0] == _FAILURE
+        finally:
+            sock.close()
+
+class TestServerLink(object):
+
+    def test_ack_after_processing(self):
+        (board_sock, server_sock) = socket.socketpair()
+        try:
+            link = _ServerLink(server_sock, np.uint16)
+            for _ in range(3):
+                _send_frame(board_sock, _BUFFER, np.arange(16, dtype=np.uint16))
+            (buf, err) = link.get()
+            assert err is None and (buf == np.arange(16)).all()
+            # taking more buffers of the same batch acknowledges nothing
+            link.get_nowait()
+            assert not select.select([board_sock], [], [], 0.1)[0]
+            # asking for the next batch acknowledges the processed ones
+            link.get()
+            assert [_recv_frame(board_sock)[0] for _ in range(2)] == [_ACK, _ACK]
+            assert not select.select([board_sock], [], [], 0.1)[0]
+        finally:
+            board_sock.close()
+            server_sock.close()
+
+class CreateFile(object):
+    """Creates a file when it is unpickled."""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __reduce__(self):
+        return (open, (self.filename, "w"))
+
+def check_same_result(result, correct):
+    if isinstance(result, dict):
+        for key in correct:
+            check_same_result(result[key], correct[key])
+    elif isinstance(result, (list, tuple)):
+        assert len(result) == len(correct)
+        for (res, cor) in zip(result, correct):
+            check_same_result(res, cor)
+    else:
+        assert np.allclose(result, correct)
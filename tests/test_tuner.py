@@ -0,0 +1,73 @@
+# Copyright (C) 2015  Chris Macklin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import alazar.processor as proc
+from alazar.board_mock import mock_sample_format
+from alazar.exceptions import AlazarException
+from alazar.tuner import tune_buffer_geometry, measure_processing_rates, _time_processing
+
+from nose.tools import raises
+
+class TestTuner(object):
+
+    def test_geometry(self):
+        for board_type in [13, 25]:
+            yield self.check_geometry, board_type, 2**20
+
+    def check_geometry(self, board_type, memory_budget):
+        records_per_acquisition = 3*256
+        procs = [proc.Average(), proc.AverageN(3)]
+
+        geometry = tune_buffer_geometry(board_type, 1024, records_per_acquisition, procs,
+                                        memory_budget=memory_budget,
+                                        calibration_records=512)
+
+        records_per_buffer = geometry["records_per_buffer"]
+        bytes_per_sample = 1 if board_type == 13 else 2
+        bytes_per_buffer = records_per_buffer*1024*2*bytes_per_sample
+
+        assert records_per_acquisition % records_per_buffer == 0
+        assert geometry["buffer_count"] >= 2
+        assert geometry["buffer_count"]*bytes_per_buffer <= memory_budget
+        # the processors should not have been touched
+        assert procs[0].params is None
+
+    def test_candidates_fit_budget(self):
+        rates = measure_processing_rates(13, 1024, 1024, [proc.Average()],
+                                         memory_budget=64*1024*2,
+                                         calibration_records=256)
+        assert max(rates.keys()) <= 32
+        assert all(rate > 0 for rate in rates.values())
+
+    def test_rejected_length(self):
+        (bit_depth, dtype) = mock_sample_format(13)
+        del RecordingAverageN.timed[:]
+        # 32 buffers of 8 records don't divide into 3 record types
+        _time_processing([RecordingAverageN(3)], 256, 8, 32, 3*2**10, 2, dtype,
+                         bit_depth, repeats=1)
+        # the next divisor of the acquisition which does is timed, not all of it
+        assert RecordingAverageN.timed == [48*8]
+
+    @raises(AlazarException)
+    def test_budget_too_small(self):
+        tune_buffer_geometry(13, 1024, 128, [proc.Average()], memory_budget=1024)
+
+class RecordingAverageN(proc.AverageN):
+    """AverageN which records the length of each acquisition it accepts."""
+    timed = []
+
+    def initialize_proc(self, params):
+        super(RecordingAverageN, self).initialize_proc(params)
+        if not self.error:
+            RecordingAverageN.timed.append(params["records_per_acquisition"])